@@ -1,146 +1,447 @@
 # Audio.py
 
+import numpy as np
 import pygame
-from pydub import AudioSegment
-from io import BytesIO
 import os
+import threading
+import time
 import Main
-import Helpers
+import Consolidation
+import Effects
+import Engine
+import Latency
+import Library
+import Memory
+import Pool
+import Samples
+import Settings
+import Telemetry
+
+# Guards Main.sample_cache, which is also filled by the startup warm-up thread. It is held
+# only to look up and insert; a sample is processed outside it while the other threads
+# that want it wait on its event in _in_flight.
+_cache_lock = threading.Lock()
+_in_flight = {}        # cache key -> Event set once the sample has been processed
+_cache_generation = 0  # bumped whenever entries are dropped, so older results are not cached
+
+# The audio driver the user asked for; the GUI process switches to the dummy driver
+# when playback runs in the engine process
+_output_driver = os.environ.get('SDL_AUDIODRIVER')
+
+def set_audio_driver(driver):
+    """Choose the SDL audio driver used the next time the mixer is opened."""
+    if driver:
+        os.environ['SDL_AUDIODRIVER'] = driver
+    else:
+        os.environ.pop('SDL_AUDIODRIVER', None)
+
+def open_mixer(frequency, buffer):
+    """(Re)open the Pygame mixer with enough channels for sustain overlaps and loops."""
+    pygame.mixer.quit()
+    if Main.compact_memory:
+        # Mono 16-bit output, optionally at a lower rate, so every sound takes a fraction of the memory
+        pygame.mixer.init(frequency=Main.compact_frequency or frequency, size=-16, channels=1, buffer=buffer)
+    else:
+        pygame.mixer.init(frequency=frequency, buffer=buffer)
+    pygame.mixer.set_num_channels(Main.num_channels)
+    # Channel 0 is kept for the summed loop buffer, so find_channel never hands it out
+    pygame.mixer.set_reserved(1)
+    Main.mixer_frequency = pygame.mixer.get_init()[0]
+    Main.mixer_buffer = buffer
+
+def init_mixer(retune=False, on_ready=None):
+    """Initialize the mixer, using the persisted low-latency buffer or tuning a new one.
+
+    Tuning takes seconds. Given on_ready, it runs on a worker thread and on_ready() is
+    called on the Tk thread once the mixer is open; otherwise it blocks.
+    """
+    Settings.load()
+    set_audio_driver(_output_driver)
+    Main.low_latency_mode = Settings.get('low_latency_mode', Main.low_latency_mode)
+    Main.effects_enabled = Settings.get('effects_enabled', Main.effects_enabled)
+    Main.instrument_layers = Settings.get('instrument_layers', Main.instrument_layers)
+    if not Main.low_latency_mode:
+        Main.output_latency_ms = None
+        open_mixer(Main.mixer_frequency, Main.mixer_buffer)
+    elif retune or Settings.get('mixer_buffer') is None:
+        frequency = Settings.get('mixer_frequency', Main.mixer_frequency)
+        if on_ready:
+            Latency.tune_in_background(frequency, lambda buffer: mixer_ready(on_ready))
+            return
+        Latency.tune_buffer(frequency)
+    else:
+        Main.output_latency_ms = Settings.get('output_latency_ms')
+        open_mixer(Settings.get('mixer_frequency'), Settings.get('mixer_buffer'))
+    mixer_ready(on_ready)
+
+def mixer_ready(on_ready=None):
+    """Finish opening the mixer, handing it to the engine process if there is one."""
+    if Main.audio_engine == "process":
+        start_engine()
+    if on_ready:
+        on_ready()
+
+def start_engine():
+    """Hand the sound card to the engine process, keeping a silent mixer here to build sounds with."""
+    frequency, buffer = Main.mixer_frequency, Main.mixer_buffer
+    set_audio_driver('dummy')
+    open_mixer(frequency, buffer)
+    Engine.start(frequency, buffer, _output_driver)
+
+def restart_mixer(retune=False, on_done=None):
+    """Reopen the mixer with the current latency settings and reload every sound.
+
+    A retune runs in the background; on_done() is called once the sounds are reloaded.
+    """
+    Consolidation.release_all()
+    pygame.mixer.stop()
+    Engine.stop()
+    # Sounds belong to the mixer they were created with
+    with _cache_lock:
+        drop_cached(list(Main.sample_cache))
+    init_mixer(retune, on_ready=lambda: reload_after_restart(on_done))
+
+def reload_after_restart(on_done=None):
+    """Give the looping notes channels on the reopened mixer and reload the sounds."""
+    for note_info in Main.looping_notes.values():
+        note_info['channel'] = pygame.mixer.find_channel()
+        note_info['active_channels'] = []
+    Main.active_sustain_channels.clear()
+    if Main.running:
+        preload_sounds()
+        # A restarted engine process starts without any loops
+        if Engine.running():
+            for note_info in Main.looping_notes.values():
+                Engine.start_loop(note_info)
+    if on_done:
+        on_done()
+
+def set_pitch_shift_quality(quality):
+    """Change how derived notes are pitch-shifted and rebuild the ones already loaded."""
+    Main.pitch_shift_quality = quality
+    with _cache_lock:
+        Samples.drop_derived()
+        drop_cached([key for key in Main.sample_cache if any(Samples.is_derived(path) for path in cache_key_paths(key))])
+    if Main.running:
+        preload_sounds()
 
-# Initialize the mixer with more channels if needed
-pygame.mixer.set_num_channels(64)
+def set_effects_enabled(enabled):
+    """Turn the master effects on or off and reload the sounds with or without them."""
+    Main.effects_enabled = enabled
+    Settings.update(effects_enabled=enabled)
+    if Main.running:
+        preload_sounds()
+        Effects.start_bus_limiter()
 
-def convert_pydub_to_pygame(sound):
-    """Convert a pydub AudioSegment to a pygame Sound object."""
-    raw_data = BytesIO()
-    sound.export(raw_data, format="wav")
-    raw_data.seek(0)
-    return pygame.mixer.Sound(file=raw_data)
+def set_instrument_layers(layers):
+    """Play every key on these extra instruments too, as [{'instrument', 'gain', 'octave_offset'}]."""
+    Main.instrument_layers = [dict(layer) for layer in layers]
+    Settings.update(instrument_layers=Main.instrument_layers)
+    if Main.running:
+        preload_sounds()
+
+def set_low_latency_mode(enabled, on_done=None):
+    """Switch low-latency mode on or off, retuning the mixer buffer when it is turned on."""
+    Settings.update(low_latency_mode=enabled)
+    restart_mixer(retune=enabled, on_done=on_done)
+
+def process_streamed_sound(sound_path):
+    """Create attack, sustain and original sounds that are filled in while the sample decodes.
+
+    The sounds can be played straight away; their heads are decoded first.
+    """
+    total_frames = Samples.stream_length(sound_path)
+    attack_frames = min(Samples.ms_to_frames(Main.attack_duration), total_frames)
+    sustain_frames = total_frames - attack_frames
+    fade_in = Samples.ms_to_frames(Main.fade_in_duration)
+    fade_out = Samples.ms_to_frames(Main.fade_out_duration)
+
+    sounds = {
+        'attack': Samples.blank_sound(attack_frames),
+        'sustain': Samples.blank_sound(sustain_frames),
+        'original': Samples.blank_sound(total_frames)
+    }
+    # Views straight into each Sound's buffer
+    buffers = {name: pygame.sndarray.samples(sound) for name, sound in sounds.items()}
+    sounds['loop'] = sounds['original']
+
+    def write_chunk(start, chunk):
+        end = start + len(chunk)
+        buffers['original'][start:end] = Samples.to_mixer_array(chunk)
+        if start < attack_frames:
+            attack_end = min(end, attack_frames)
+            buffers['attack'][start:attack_end] = Samples.to_mixer_array(chunk[:attack_end - start])
+        if end > attack_frames:
+            offset = max(start, attack_frames)
+            positions = np.arange(offset, end) - attack_frames
+            gain = Samples.fade_gain(positions, sustain_frames, fade_in, fade_out)
+            sustain = chunk[offset - start:] * gain[:, None]
+            buffers['sustain'][offset - attack_frames:end - attack_frames] = Samples.to_mixer_array(sustain)
+
+    Samples.stream_decode(sound_path, write_chunk)
+    return sounds
+
+def split_frames(frames, dry_frames=None):
+    """Split float frames into the attack, sustain and original parts a note plays.
+
+    Frames longer than the dry_frames they were rendered from get a loop part of the dry length.
+    """
+    # Process sound for sustain and looping modes
+    attack_frames = Samples.ms_to_frames(Main.attack_duration)
+
+    # Apply fade-in and fade-out to the sustain portion
+    fade_in = Samples.ms_to_frames(Main.fade_in_duration)
+    fade_out = Samples.ms_to_frames(Main.fade_out_duration)
+    parts = {
+        'attack': frames[:attack_frames],
+        'sustain': Samples.apply_fades(frames[attack_frames:], fade_in, fade_out),
+        'original': frames
+    }
+    if dry_frames is not None and len(frames) > dry_frames:
+        # Loops retrigger at the dry length with the effect tail folded into their start
+        parts['loop'] = Effects.wrap_tail(frames, dry_frames)
+    return parts
+
+def make_sounds(parts, make_sound=Samples.make_sound):
+    """Convert the parts from split_frames to attack, sustain, original and loop pygame sounds."""
+    original = make_sound(parts['original'])
+    loop = make_sound(parts['loop']) if 'loop' in parts else original
+    return {'attack': make_sound(parts['attack']), 'sustain': make_sound(parts['sustain']), 'original': original, 'loop': loop}
+
+def split_sounds(frames, dry_frames=None):
+    """Split float frames into attack, sustain, original and loop pygame sounds in the mixer's format."""
+    return make_sounds(split_frames(frames, dry_frames))
+
+def process_sound(sound_path):
+    """Split a sample into attack, sustain and original pygame sounds in the mixer's format."""
+    # Effects need the whole sample, so they cannot be applied while it streams in, and the
+    # shared pool needs the finished sounds
+    if Samples.can_stream(sound_path) and Effects.sample_settings(sound_path) is None and not Main.shared_pool:
+        return process_streamed_sound(sound_path)
+    frames = Samples.load_normalized(sound_path)
+    return split_sounds(Effects.apply(frames, sound_path), len(frames))
+
+def process_layered_sound(sound_path, layers):
+    """Mix a sample with its layers at their gains into one set of sounds."""
+    parts = [Samples.load_normalized(sound_path)] + [Samples.load_normalized(path) * gain for path, gain in layers]
+    frames = np.zeros((max(len(part) for part in parts), parts[0].shape[1]), dtype=np.float32)
+    for part in parts:
+        frames[:len(part)] += part
+    # Leave headroom for the instruments to add up to, the same for every key of the layer set
+    frames /= 1.0 + sum(gain for _, gain in layers)
+    return split_sounds(Effects.apply(frames, (sound_path, tuple(layers))), len(frames))
+
+def note_cache_key(sound_path, layers=()):
+    """Return the sample cache key of a sample played with these instrument layers."""
+    if not layers:
+        return (sound_path, Main.attack_duration, Main.fade_in_duration, Main.fade_out_duration,
+                Effects.sample_settings(sound_path))
+    return (sound_path, Main.attack_duration, Main.fade_in_duration, Main.fade_out_duration,
+            Effects.sample_settings((sound_path, tuple(layers))), tuple(layers))
+
+def drop_cached(cache_keys):
+    """Remove entries from the sample cache; call with _cache_lock held.
+
+    Sounds still being processed were built from what is now stale, so they are not cached.
+    """
+    global _cache_generation
+    _cache_generation += 1
+    for cache_key in cache_keys:
+        Main.sample_cache.pop(cache_key, None)
+
+def cached_sounds(make_key, build):
+    """Return the cached sounds for make_key(), calling build() to process them if needed.
+
+    Only one thread builds a given key; the others wait for it instead of processing the
+    sample again. The key is made again after building, since a render over the CPU budget
+    comes back dry and is kept under the dry key.
+    """
+    while True:
+        cache_key = make_key()
+        with _cache_lock:
+            sounds = Main.sample_cache.get(cache_key)
+            if sounds is not None:
+                Telemetry.cache_lookup(True)
+                return sounds
+            pending = _in_flight.get(cache_key)
+            if pending is None:
+                Telemetry.cache_lookup(False)
+                pending = _in_flight[cache_key] = threading.Event()
+                generation = _cache_generation
+                break
+        pending.wait()
+    try:
+        sounds = Pool.load(cache_key)
+        if sounds is None:
+            sounds = build()
+            Pool.publish(make_key(), sounds)
+        with _cache_lock:
+            if generation == _cache_generation:
+                Main.sample_cache[make_key()] = sounds
+    finally:
+        with _cache_lock:
+            del _in_flight[cache_key]
+        pending.set()
+    return sounds
+
+def load_note_sounds(sound_path):
+    """Return the processed sounds for a sample, processing it only if it is not cached yet."""
+    return cached_sounds(lambda: note_cache_key(sound_path),
+                         lambda: prebuilt_sounds(sound_path) or process_sound(sound_path))
+
+def prebuilt_sounds(sound_path):
+    """Return a sample's sounds from a bank written by Build.py, or None if there is no matching bank."""
+    if Effects.sample_settings(sound_path) is not None:
+        return None
+    import Build
+    parts = Build.prebuilt_parts(sound_path)
+    # Bank arrays are already in the mixer's format
+    return make_sounds(parts, pygame.sndarray.make_sound) if parts else None
+
+def cache_key_paths(cache_key):
+    """List every sample path a sample cache entry was built from."""
+    layers = cache_key[5] if len(cache_key) > 5 else ()
+    return [cache_key[0]] + [path for path, _ in layers]
+
+def layer_paths(layers, folder, key, octave, input_key):
+    """Resolve the (sample path, gain) each extra instrument layer plays alongside a note in folder."""
+    paths = []
+    for layer in layers:
+        layer_folder = os.path.join(Main.base_folder, layer['instrument'])
+        if layer_folder == folder or layer['instrument'] not in Main.instrument_folders:
+            continue
+        path = Library.resolve(layer_folder, key, octave + layer.get('octave_offset', 0), input_key)
+        if path:
+            paths.append((path, layer.get('gain', 1.0)))
+    return paths
+
+def load_layered_sounds(sound_path, layers):
+    """Return the sounds for a sample played with instrument layers, pre-mixed once and cached.
+
+    A layered note is one set of sounds, so it costs a single voice like any other note.
+    """
+    if not layers:
+        return load_note_sounds(sound_path)
+    return cached_sounds(lambda: note_cache_key(sound_path, layers),
+                         lambda: process_layered_sound(sound_path, layers))
+
+def warm_bank(folder):
+    """Process and cache every sample of an instrument bank so starting the harp is instant."""
+    for input_key in Main.input_to_note:
+        sound_path = Library.resolve(folder, Main.current_key, Main.current_octave, input_key)
+        if sound_path:
+            load_layered_sounds(sound_path, layer_paths(Main.instrument_layers, folder, Main.current_key, Main.current_octave, input_key))
+    Samples.save_onset_manifest()
+    # Once per bank: usage() walks every loaded Sound
+    Memory.update_peak()
 
 def preload_sounds():
     """Preload all the sounds and process them for sustain and looping modes."""
+    if Main.mixer_tuning:
+        # The restart after tuning preloads everything with the settings of the moment
+        return
+    start = time.perf_counter()
     Main.sound_objects = {}
     Main.sustain_lengths = {}
+    Main.sound_paths = {}
+    Main.layer_sound_paths = {}
 
-    for input_key, note in Main.input_to_note.items():
-        octave = Main.current_octave
-        
-        if input_key == '=':
-            octave += 1
+    for input_key in Main.input_to_note:
+        load_key_sounds(input_key)
 
-        transposed_note, adjusted_octave = Helpers.transpose_note(note, Main.current_key, octave)
-        sound_file = f"{transposed_note}{adjusted_octave}.wav"
-        sound_path = os.path.join(Main.current_folder, sound_file)
-
-        # Check if the sound file exists
-        if not os.path.exists(sound_path):
-            print(f"Sound file not found: {sound_path}")
-            continue
-
-        sound = AudioSegment.from_wav(sound_path)
-
-        # Process sound for sustain and looping modes
-        attack_duration = Main.attack_duration
-        attack = sound[:attack_duration]
-        sustain = sound[attack_duration:]
+    # Preload sounds for looping notes, taking them out of the summed loop buffer once
+    # rather than one re-render per loop; they are merged again when the loops settle
+    Consolidation.release_all()
+    for note_id, note_info in Main.looping_notes.items():
+        key = note_info['key']
+        preload_sound_for_looping_note(note_id, key, instrument=note_info['created_instrument'])
 
-        # Apply fade-in and fade-out to the sustain portion
-        fade_in = Main.fade_in_duration
-        fade_out = Main.fade_out_duration
-        sustain = sustain.fade_in(fade_in).fade_out(fade_out)
+    # Keep the onsets of any newly analysed samples for the next launch
+    Samples.save_onset_manifest()
+    # Once per preload: usage() walks every loaded Sound
+    Memory.update_peak()
+    Telemetry.preload_duration(time.perf_counter() - start)
 
-        # Convert attack and sustain portions to pygame sounds
-        attack_sound = convert_pydub_to_pygame(attack)
-        sustain_sound = convert_pydub_to_pygame(sustain)
+def load_key_sounds(input_key):
+    """Load the sounds an input key plays with the current instrument, key and octave."""
+    sound_path = Library.resolve(Main.current_folder, Main.current_key, Main.current_octave, input_key)
+    Main.sound_paths[input_key] = sound_path
 
-        # Set volumes
-        attack_sound.set_volume(Main.volume)
-        sustain_sound.set_volume(Main.volume)
+    # Check if the sound file exists
+    if sound_path is None:
+        sound_name = Library.note_name(Main.current_key, Main.current_octave, input_key)
+        print(f"Sound file not found: {os.path.join(Main.current_folder, sound_name)}")
+        Main.sound_objects.pop(input_key, None)
+        return
 
-        # Store sounds in the dictionary
-        Main.sound_objects[input_key] = {
-            'attack': attack_sound,
-            'sustain': sustain_sound
-        }
+    layers = layer_paths(Main.instrument_layers, Main.current_folder, Main.current_key, Main.current_octave, input_key)
+    Main.layer_sound_paths[input_key] = [path for path, _ in layers]
+    sounds = load_layered_sounds(sound_path, layers)
 
-        # Store sustain sound length
-        Main.sustain_lengths[input_key] = sustain_sound.get_length() * 1000  # in milliseconds
+    # Set volumes
+    for sound in sounds.values():
+        sound.set_volume(Main.volume)
 
-        # Also store the original sound for non-sustain playback
-        original_sound = convert_pydub_to_pygame(sound)
-        original_sound.set_volume(Main.volume)
-        Main.sound_objects[input_key]['original'] = original_sound
+    # Store sounds in the dictionary
+    Main.sound_objects[input_key] = dict(sounds)
 
-    # Preload sounds for looping notes
-    for note_id, note_info in Main.looping_notes.items():
-        key = note_info['key']
-        preload_sound_for_looping_note(note_id, key, instrument=note_info['created_instrument'])
+    # Store sustain sound length
+    Main.sustain_lengths[input_key] = sounds['sustain'].get_length() * 1000  # in milliseconds
 
 def preload_sound_for_looping_note(note_id, key, instrument):
     """Preload sounds for a specific looping note based on its current settings."""
     note_info = Main.looping_notes[note_id]
+    # Phrases are rendered once and do not follow octave, key or instrument changes;
+    # while the mixer is being tuned, the restart after it preloads every note
+    if note_info.get('phrase') or Main.mixer_tuning:
+        return
+    # A re-locked note leaves the summed loop buffer until the loop set settles again
+    if note_id in Consolidation.group:
+        Consolidation.release(note_id)
     octave = Main.current_octave
     if note_info['octave_locked']:
         octave = note_info['locked_octave']
-    if key == '=':
-        octave += 1
 
     # Use locked key if key is locked
     used_key = Main.current_key
     if note_info.get('key_locked'):
         used_key = note_info['locked_key']
 
-    # Use locked instrument if instrument is locked
+    # Use locked instrument, and the layers locked with it, if instrument is locked
     instrument_folder = Main.current_folder
+    layers = Main.instrument_layers
     if note_info.get('instrument_locked'):
         instrument_folder = note_info['locked_instrument']
+        layers = note_info.get('locked_layers') or []
 
-    # Generate the transposed note
-    original_note = Main.input_to_note[key]
-    transposed_note, adjusted_octave = Helpers.transpose_note(original_note, used_key, octave)
-    if key == '=':
-        adjusted_octave += 1
-    sound_file = f"{transposed_note}{adjusted_octave}.wav"
-    sound_path = os.path.join(instrument_folder, sound_file)
+    sound_path = Library.resolve(instrument_folder, used_key, octave, key)
+    # Remember what the note resolved so a reload of its samples can find it
+    note_info['resolved_as'] = (instrument_folder, used_key, octave, key)
+    note_info['sound_path'] = sound_path
 
     # Check if the sound file exists
-    if not os.path.exists(sound_path):
-        print(f"Sound file not found for looping note: {sound_path}")
+    if sound_path is None:
+        sound_name = Library.note_name(used_key, octave, key)
+        print(f"Sound file not found for looping note: {os.path.join(instrument_folder, sound_name)}")
         return
 
-    sound = AudioSegment.from_wav(sound_path)
-
-    # Process sound for sustain and looping modes
-    attack_duration = Main.attack_duration
-    attack = sound[:attack_duration]
-    sustain = sound[attack_duration:]
-
-    # Apply fade-in and fade-out to the sustain portion
-    fade_in = Main.fade_in_duration
-    fade_out = Main.fade_out_duration
-    sustain = sustain.fade_in(fade_in).fade_out(fade_out)
-
-    # Convert attack and sustain portions to pygame sounds
-    attack_sound = convert_pydub_to_pygame(attack)
-    sustain_sound = convert_pydub_to_pygame(sustain)
+    layers = layer_paths(layers, instrument_folder, used_key, octave, key)
+    note_info['layer_paths'] = [path for path, _ in layers]
+    sounds = load_layered_sounds(sound_path, layers)
 
     # Set volumes
-    attack_sound.set_volume(Main.volume)
-    sustain_sound.set_volume(Main.volume)
+    for sound in sounds.values():
+        sound.set_volume(Main.volume)
 
     # Store sounds in the looping note's info
-    note_info['sounds'] = {
-        'attack': attack_sound,
-        'sustain': sustain_sound
-    }
+    note_info['sounds'] = dict(sounds)
 
     # Store sustain sound length
-    note_info['sustain_length'] = sustain_sound.get_length() * 1000  # in milliseconds
+    note_info['sustain_length'] = sounds['sustain'].get_length() * 1000  # in milliseconds
 
-    # Also store the original sound for non-sustain playback
-    original_sound = convert_pydub_to_pygame(sound)
-    original_sound.set_volume(Main.volume)
-    note_info['sounds']['original'] = original_sound
+    if Engine.running():
+        Engine.update_loop(note_info)
+    Consolidation.loop_changed()
 
 def choose_folder(folder_name):
     """Change the current instrument folder and preload sounds."""
@@ -167,6 +468,9 @@ def adjust_volume(value):
         sounds = note_info.get('sounds', {})
         for sound in sounds.values():
             sound.set_volume(Main.volume)
+    Consolidation.set_volume(Main.volume)
+    if Engine.running():
+        Engine.set_volume(Main.volume)
 
 def change_octave(octave):
     """Change the current octave."""
@@ -219,15 +523,25 @@ def choose_folder(folder_name):
         except Exception as e:
             print(f"Error updating advanced menu: {e}")
 
+def set_sustain_option(enabled):
+    """Turn sustain mode on or off."""
+    Main.sustain_option = enabled
+    if Main.running:
+        preload_sounds()
+
 def start_harp():
     """Initialize and start the harp application."""
     Main.running = True
     preload_sounds()
+    Effects.start_bus_limiter()
 
 def stop_harp():
     """Stop the harp application and clean up."""
     Main.running = False
+    Consolidation.release_all(restart=False)
     pygame.mixer.stop()
+    if Engine.running():
+        Engine.stop_all()
     # Stop all looping notes and cancel scheduled tasks
     for note_id in list(Main.looping_notes.keys()):
         import Looping  # Import here to avoid circular import
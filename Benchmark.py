@@ -0,0 +1,498 @@
+# Benchmark.py
+#
+# Headless benchmarks for the harp. Run with the dummy SDL audio driver, e.g.:
+#   python Benchmark.py compressed --instrument Harp
+#   python Benchmark.py loops --duration 30
+#   python Benchmark.py effects --seconds 20
+#   python Benchmark.py stress --rate 50 200 500
+
+import argparse
+import collections
+import contextlib
+import heapq
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import types
+
+# Benchmarks never need a real sound card
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+class HeadlessRoot:
+    """Stands in for the Tk root, running after() callbacks on time without a display."""
+
+    def __init__(self):
+        self.queue = []  # heap of (due time, sequence, callback)
+        self.cancelled = set()
+        self.sequence = 0
+
+    def after(self, delay, callback):
+        self.sequence += 1
+        heapq.heappush(self.queue, (time.perf_counter() + delay / 1000, self.sequence, callback))
+        return f"after#{self.sequence}"
+
+    def after_cancel(self, task_id):
+        self.cancelled.add(int(task_id.split('#')[1]))
+
+    def pending(self):
+        """Return how many callbacks are still scheduled."""
+        return len(self.queue) - len(self.cancelled)
+
+    def run(self, duration):
+        """Run due callbacks for duration seconds, sleeping in between like the Tk event loop."""
+        end = time.perf_counter() + duration
+        while True:
+            now = time.perf_counter()
+            if not self.queue or self.queue[0][0] > end:
+                time.sleep(max(end - now, 0))
+                return
+            due, sequence, callback = self.queue[0]
+            if due > now:
+                time.sleep(due - now)
+                continue
+            heapq.heappop(self.queue)
+            if sequence in self.cancelled:
+                self.cancelled.discard(sequence)
+                continue
+            callback()
+
+def use_headless_root():
+    """Install a HeadlessRoot as Main.root and return it."""
+    import Main
+    Main.root = HeadlessRoot()
+    return Main.root
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of values fall."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def current_rss_mb():
+    """Return the resident set size of this process in megabytes."""
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def evict_from_page_cache(paths):
+    """Ask the kernel to drop files from the page cache so the next read is cold."""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+def folder_samples(folder):
+    """List the sample files in a folder."""
+    import Samples
+    return [
+        os.path.join(folder, f) for f in sorted(os.listdir(folder))
+        if os.path.splitext(f)[1].lower() in Samples.sample_extensions
+    ]
+
+def load_folder_worker(folder):
+    """Load every sample in a folder cold and return timing and memory figures."""
+    import Audio
+    import Samples
+
+    paths = folder_samples(folder)
+    evict_from_page_cache(paths)
+    Audio.init_mixer()
+    baseline_rss = current_rss_mb()
+
+    start = time.perf_counter()
+    for path in paths:
+        Audio.load_note_sounds(path)
+    playable = time.perf_counter() - start
+    Samples.wait_for_streams()
+    loaded = time.perf_counter() - start
+
+    return {
+        'files': len(paths),
+        'disk_mb': sum(os.path.getsize(path) for path in paths) / 2 ** 20,
+        'playable_s': playable,
+        'loaded_s': loaded,
+        'rss_mb': current_rss_mb() - baseline_rss,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def run_worker(command, folder):
+    """Run a benchmark worker in a fresh interpreter so its memory figures are not shared."""
+    output = subprocess.run(
+        [sys.executable, __file__, command, '--worker', folder],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def compressed_benchmark(args):
+    """Compare cold-load time and memory of a WAV instrument folder against its compressed copy."""
+    if args.worker:
+        print(json.dumps(load_folder_worker(args.worker)))
+        return
+
+    import Main
+    wav_folder = os.path.join(Main.base_folder, args.instrument)
+    compressed_folder = args.compressed_folder or os.path.join("Compressed Samples", args.instrument)
+    if not os.path.isdir(compressed_folder):
+        print(f"{compressed_folder} not found; create it with: python Samples.py compress {args.instrument}")
+        return
+
+    results = {
+        'wav': run_worker('compressed', wav_folder),
+        'compressed': run_worker('compressed', compressed_folder)
+    }
+    print(f"{'path':<12}{'files':>6}{'disk MB':>10}{'playable s':>12}{'loaded s':>10}{'RSS MB':>9}{'peak MB':>9}")
+    for name, result in results.items():
+        print(
+            f"{name:<12}{result['files']:>6}{result['disk_mb']:>10.1f}{result['playable_s']:>12.2f}"
+            f"{result['loaded_s']:>10.2f}{result['rss_mb']:>9.1f}{result['peak_rss_mb']:>9.1f}"
+        )
+
+def record_retriggers(function, interval_of, fires):
+    """Wrap a Looping retrigger function so each call's intended and actual time is recorded."""
+    def recorded(key, note_id):
+        import Main
+        now = time.perf_counter()
+        if note_id in Main.looping_notes:
+            history = fires.setdefault(note_id, [])
+            interval = interval_of(Main.looping_notes[note_id]) / 1000
+            intended = history[-1][1] + interval if history else now
+            history.append((intended, now, interval))
+        return function(key, note_id)
+    return recorded
+
+def loop_timing_run(loop_count, sustain, duration):
+    """Loop loop_count notes for duration seconds and measure how their retriggers drift and jitter."""
+    import Main
+    import Audio
+    import Looping
+
+    root = use_headless_root()
+    Main.sustain_option = sustain
+    Main.max_loops = max(Main.max_loops, loop_count)
+    Main.looping_note_slots = [None] * Main.max_loops
+    Audio.start_harp()
+
+    fires = {}
+    original_normal = Looping.schedule_normal_loop_play
+    original_sustain = Looping.schedule_loop_sustain_play
+    Looping.schedule_normal_loop_play = record_retriggers(
+        original_normal, lambda note_info: int(note_info['sounds']['loop'].get_length() * 1000), fires
+    )
+    Looping.schedule_loop_sustain_play = record_retriggers(
+        original_sustain, lambda note_info: int(note_info['sustain_length'] / Main.max_overlaps), fires
+    )
+    keys = list(Main.input_to_note)
+    try:
+        for i in range(loop_count):
+            Looping.start_looping_note(f"bench{i}", keys[i % len(keys)])
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        root.run(duration)
+        cpu = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+    finally:
+        Looping.stop_all_loops()
+        Audio.stop_harp()
+        Looping.schedule_normal_loop_play = original_normal
+        Looping.schedule_loop_sustain_play = original_sustain
+
+    lateness = []
+    drift_per_minute = []
+    for history in fires.values():
+        lateness.extend((actual - intended) * 1000 for intended, actual, _ in history[1:])
+        if len(history) > 1:
+            # Drift against the ideal grid of the first fire plus whole intervals
+            first = history[0][1]
+            last = history[-1][1]
+            ideal_last = first + sum(interval for _, _, interval in history[:-1])
+            minutes = (last - first) / 60
+            if minutes > 0:
+                drift_per_minute.append((last - ideal_last) * 1000 / minutes)
+
+    return {
+        'loops': loop_count,
+        'mode': "sustain" if sustain else "normal",
+        'fires': sum(len(history) for history in fires.values()),
+        'drift_ms_per_min': sum(drift_per_minute) / len(drift_per_minute) if drift_per_minute else 0.0,
+        'jitter_p50_ms': percentile(lateness, 0.5),
+        'jitter_p95_ms': percentile(lateness, 0.95),
+        'jitter_p99_ms': percentile(lateness, 0.99),
+        'jitter_max_ms': max(lateness, default=0.0),
+        'cpu_percent': cpu * 100
+    }
+
+def loops_benchmark(args):
+    """Measure loop retrigger drift, jitter and CPU use as the number of loops grows."""
+    import Main
+    import Audio
+    import Helpers
+
+    Helpers.scan_instrument_folders()
+    Audio.init_mixer()
+    loop_counts = args.loops or [1, Main.max_loops // 2, Main.max_loops, Main.max_loops * 2]
+    results = []
+    for sustain in (False, True):
+        for loop_count in loop_counts:
+            results.append(loop_timing_run(loop_count, sustain, args.duration))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':<9}{'loops':>6}{'fires':>8}{'drift ms/min':>14}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'max ms':>8}{'CPU %':>7}")
+    for result in results:
+        print(
+            f"{result['mode']:<9}{result['loops']:>6}{result['fires']:>8}{result['drift_ms_per_min']:>14.1f}"
+            f"{result['jitter_p50_ms']:>8.2f}{result['jitter_p95_ms']:>8.2f}{result['jitter_p99_ms']:>8.2f}"
+            f"{result['jitter_max_ms']:>8.2f}{result['cpu_percent']:>7.1f}"
+        )
+
+def effects_run(name, effects, frequency, block, seconds):
+    """Stream seconds of noise through effects block by block and time each block."""
+    import numpy as np
+    import Effects
+    chain = Effects.EffectsChain(effects, block)
+    audio = np.random.default_rng(0).standard_normal((int(seconds * frequency), 2)).astype(np.float32) * 0.1
+    timings = []
+    for start in range(0, len(audio) - block + 1, block):
+        begin = time.perf_counter()
+        chain.process(audio[start:start + block])
+        timings.append(time.perf_counter() - begin)
+    block_seconds = block / frequency
+    return {
+        'effect': name,
+        'block': block,
+        'realtime_factor': len(timings) * block_seconds / sum(timings),
+        'block_p50_percent': percentile(timings, 0.5) / block_seconds * 100,
+        'block_p99_percent': percentile(timings, 0.99) / block_seconds * 100,
+        'block_max_percent': max(timings) / block_seconds * 100
+    }
+
+def effects_benchmark(args):
+    """Measure how many times faster than realtime each effect and the whole chain run."""
+    import Main
+    import Effects
+    frequency = Main.mixer_frequency
+    results = []
+    for block in args.block or [Main.effects_block]:
+        Main.effects_block = block
+        impulse = Effects.load_impulse(frequency, 2)
+        delay_frames = int(frequency * (Main.delay_ms or 350) / 1000)
+        release_frames = int(frequency * Main.limiter_release_ms / 1000)
+        runs = {
+            'reverb': lambda: [Effects.ConvolutionReverb(impulse, block, Main.reverb_mix)],
+            'delay': lambda: [Effects.Delay(delay_frames, 2, Main.delay_feedback, Main.delay_mix)],
+            'limiter': lambda: [Effects.Limiter(Main.limiter_threshold_db, release_frames)],
+        }
+        singles = list(runs.values())
+        runs['chain'] = lambda: [effect for make in singles for effect in make()]
+        for name, make in runs.items():
+            results.append(effects_run(name, make(), frequency, block, args.seconds))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'effect':<9}{'block':>6}{'realtime x':>12}{'p50 %':>8}{'p99 %':>8}{'max %':>8}")
+    for result in results:
+        print(
+            f"{result['effect']:<9}{result['block']:>6}{result['realtime_factor']:>12.1f}"
+            f"{result['block_p50_percent']:>8.1f}{result['block_p99_percent']:>8.1f}{result['block_max_percent']:>8.1f}"
+        )
+
+def stress_events(rate, duration, seed):
+    """Generate (time, action, argument) input events at rate per second across every beam.
+
+    Most events press or release a key; a few shift the octave, arm a loop or flip sustain mode.
+    """
+    import Main
+    rng = random.Random(seed)
+    keys = list(Main.input_to_note)
+    held = set()
+    events = []
+    for i in range(int(rate * duration)):
+        at = i / rate
+        roll = rng.random()
+        if roll < 0.02:
+            events.append((at, 'shift', rng.choice(['Shift_L', 'Shift_R'])))
+        elif roll < 0.04:
+            events.append((at, 'loop', None))
+        elif roll < 0.05:
+            events.append((at, 'sustain', None))
+        else:
+            key = rng.choice(keys)
+            events.append((at, 'release' if key in held else 'press', key))
+            held ^= {key}
+    # Let go of every beam at the end
+    events.extend((duration, 'release', key) for key in sorted(held))
+    return events
+
+def stress_run(rate, duration, seed, settle):
+    """Drive the key handlers with synthetic events and measure their cost and what they leave behind."""
+    import pygame
+    import Main
+    import Audio
+    import Looping
+    import Recording
+    import Telemetry
+
+    root = use_headless_root()
+    Main.sustain_option = False
+    Main.current_octave = 4
+    Audio.start_harp()
+    handlers = Recording.handlers()
+    event = lambda keysym, char: types.SimpleNamespace(keysym=keysym, char=char, velocity=None)
+    actions = {
+        'press': lambda key: Looping.key_press(event(key, key)),
+        'release': lambda key: Looping.key_release(event(key, key)),
+        'shift': lambda keysym: Looping.key_press(event(keysym, '')),
+        'loop': lambda _: handlers['activate_loop_mode'](),
+        'sustain': lambda _: handlers['set_sustain_option'](int(not Main.sustain_option)),
+    }
+
+    handler_cpu = collections.defaultdict(list)  # action -> CPU seconds per call
+    errors = collections.Counter()
+    samples = []  # (busy channels, sustain channels held, scheduled tasks, pending callbacks)
+    sampling = [None]
+
+    def fire(action, argument):
+        start = time.process_time()
+        try:
+            actions[action](argument)
+        except Exception as e:
+            # Tk would report the exception and keep running
+            errors[f"{action}: {type(e).__name__}: {e}"] += 1
+        handler_cpu[action].append(time.process_time() - start)
+
+    def sample():
+        samples.append((
+            Telemetry.active_voices(),
+            sum(len(channels) for channels in Main.active_sustain_channels.values()),
+            len(Main.scheduled_tasks),
+            root.pending()
+        ))
+        sampling[0] = root.after(100, sample)
+
+    dropped_before = Telemetry.notes_dropped
+    rss_before = current_rss_mb()
+    for at, action, argument in stress_events(rate, duration, seed):
+        root.after(int(at * 1000), lambda action=action, argument=argument: fire(action, argument))
+    sampling[0] = root.after(0, sample)
+    # The handlers print a line for most actions; the cost stays in, the output does not
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        root.run(duration)
+        cpu = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+        loops = len(Main.looping_notes)
+        Looping.stop_all_loops()
+        root.run(settle)
+    root.after_cancel(sampling[0])
+    final = (
+        Telemetry.active_voices(),
+        sum(len(channels) for channels in Main.active_sustain_channels.values()),
+        len(Main.scheduled_tasks),
+        root.pending()
+    )
+    Audio.stop_harp()
+
+    all_cpu = [seconds for timings in handler_cpu.values() for seconds in timings]
+    channels = pygame.mixer.get_num_channels()
+    return {
+        'rate': rate,
+        'events': len(all_cpu),
+        'cpu_percent': cpu * 100,
+        'handler_p50_ms': percentile(all_cpu, 0.5) * 1000,
+        'handler_p99_ms': percentile(all_cpu, 0.99) * 1000,
+        'handler_max_ms': max(all_cpu, default=0.0) * 1000,
+        'slowest_action': max(handler_cpu, key=lambda action: max(handler_cpu[action]), default=None),
+        'notes_dropped': Telemetry.notes_dropped - dropped_before,
+        'channels': channels,
+        'channels_exhausted_percent': 100 * sum(busy >= channels for busy, _, _, _ in samples) / max(len(samples), 1),
+        'peak_busy_channels': max((busy for busy, _, _, _ in samples), default=0),
+        'peak_sustain_channels': max((held for _, held, _, _ in samples), default=0),
+        'peak_scheduled_tasks': max((tasks for _, _, tasks, _ in samples), default=0),
+        'loops_at_end': loops,
+        'final_sustain_channels': final[1],
+        'final_scheduled_tasks': final[2],
+        'final_pending_callbacks': final[3],
+        'rss_growth_mb': current_rss_mb() - rss_before,
+        'peak_rss_mb': peak_rss_mb(),
+        'errors': dict(errors)
+    }
+
+def stress_benchmark(args):
+    """Hammer the input handlers at increasing event rates and report whether the harp keeps up."""
+    import Audio
+    import Helpers
+    import Library
+
+    Helpers.scan_instrument_folders()
+    Library.index()
+    if args.layout:
+        import Layout
+        Layout.use(args.layout)
+    Audio.init_mixer()
+    results = [stress_run(rate, args.duration, args.seed, args.settle) for rate in args.rate]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'rate/s':>7}{'events':>8}{'CPU %':>7}{'p50 ms':>8}{'p99 ms':>8}{'max ms':>8}{'dropped':>9}"
+          f"{'exhausted %':>13}{'sustain peak/end':>18}{'tasks peak/end':>16}{'RSS +MB':>9}")
+    for result in results:
+        print(
+            f"{result['rate']:>7}{result['events']:>8}{result['cpu_percent']:>7.1f}{result['handler_p50_ms']:>8.2f}"
+            f"{result['handler_p99_ms']:>8.2f}{result['handler_max_ms']:>8.2f}{result['notes_dropped']:>9}"
+            f"{result['channels_exhausted_percent']:>13.1f}"
+            f"{result['peak_sustain_channels']:>11}/{result['final_sustain_channels']:<6}"
+            f"{result['peak_scheduled_tasks']:>9}/{result['final_scheduled_tasks']:<6}{result['rss_growth_mb']:>9.1f}"
+        )
+        for error, count in result['errors'].items():
+            print(f"        {count} x {error}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Laser Harp benchmarks")
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    compressed_parser = benchmarks.add_parser('compressed', help="cold-load time and RSS of WAV vs compressed samples")
+    compressed_parser.add_argument('--instrument', default="Harp")
+    compressed_parser.add_argument('--compressed-folder', help="default: Compressed Samples/<instrument>")
+    compressed_parser.add_argument('--worker', help=argparse.SUPPRESS)
+    compressed_parser.set_defaults(run=compressed_benchmark)
+
+    loops_parser = benchmarks.add_parser('loops', help="loop retrigger drift, jitter and CPU use against loop count")
+    loops_parser.add_argument('--loops', type=int, nargs='+', help="loop counts to test (default: up to twice Main.max_loops)")
+    loops_parser.add_argument('--duration', type=float, default=20.0, help="seconds per run")
+    loops_parser.add_argument('--json', action='store_true', help="print raw results as JSON")
+    loops_parser.set_defaults(run=loops_benchmark)
+
+    effects_parser = benchmarks.add_parser('effects', help="realtime factor of the master effects chain")
+    effects_parser.add_argument('--seconds', type=float, default=20.0, help="seconds of audio to process")
+    effects_parser.add_argument('--block', type=int, nargs='+', help="block sizes to test (default: Main.effects_block)")
+    effects_parser.add_argument('--json', action='store_true', help="print raw results as JSON")
+    effects_parser.set_defaults(run=effects_benchmark)
+
+    stress_parser = benchmarks.add_parser('stress', help="input handler cost and leaks under rapid play")
+    stress_parser.add_argument('--rate', type=int, nargs='+', default=[50, 200, 500], help="input events per second")
+    stress_parser.add_argument('--duration', type=float, default=10.0, help="seconds of input per run")
+    stress_parser.add_argument('--settle', type=float, default=3.0, help="seconds to let sustains and fades finish afterwards")
+    stress_parser.add_argument('--seed', type=int, default=0, help="seed for the input sequence")
+    stress_parser.add_argument('--layout', help="beam layout to play (default: the keyboard layout)")
+    stress_parser.add_argument('--json', action='store_true', help="print raw results as JSON")
+    stress_parser.set_defaults(run=stress_benchmark)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# Build.py
+#
+# Builds the processed sound banks offline so a harp never decodes, resamples, trims or
+# splits a sample on site. Every instrument in Main.base_folder is built for every note
+# in Main.octave_range and every envelope asked for, spread over a process pool:
+#   python Build.py
+#   python Build.py Harp Piano --envelope 100:500:500 --envelope 50:250:800
+#   python Build.py --compact-memory --compact-frequency 22050
+# Each (instrument, envelope, mixer format) becomes one bank in Main.banks_folder holding
+# the attack, sustain and original of every sample already in the mixer's sample format.
+# Audio.load_note_sounds takes a sample from a bank when the bank matches the running
+# mixer and envelope and the sample has not changed since the bank was built. Banks hold
+# no master effects or instrument layers, which are still processed at runtime.
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+import Main
+
+_banks = {}  # bank path -> (header, arrays), or None where there is no usable bank
+
+def bank_settings(envelope=None, sample_format=None):
+    """Return the settings a bank is built for, by default those of the running mixer and envelope."""
+    import Samples
+    attack, fade_in, fade_out = envelope or (Main.attack_duration, Main.fade_in_duration, Main.fade_out_duration)
+    return {
+        'format': list(sample_format or Samples.mixer_format()),
+        'attack_duration': attack,
+        'fade_in_duration': fade_in,
+        'fade_out_duration': fade_out,
+        'compact_memory': Main.compact_memory,
+        'trim_silence': Main.trim_silence,
+        'pitch_shift_quality': Main.pitch_shift_quality,
+    }
+
+def bank_path(folder, settings):
+    """Return the bank file for an instrument folder and bank settings."""
+    frequency, _, channels = settings['format']
+    name = "{}-{}hz-{}ch-{}-{}-{}{}.npz".format(
+        os.path.basename(os.path.normpath(folder)), frequency, channels,
+        settings['attack_duration'], settings['fade_in_duration'], settings['fade_out_duration'],
+        "-compact" if settings['compact_memory'] else ""
+    )
+    return os.path.join(Main.banks_folder, name)
+
+def source_of(sound_path):
+    """Return the recorded file a sample is made from: itself, or the neighbour a derived note is shifted from."""
+    import Samples
+    if Samples.is_derived(sound_path):
+        folder, sound_file = os.path.split(sound_path)
+        return Samples.nearest_recorded_sample(folder, os.path.splitext(sound_file)[0])[0]
+    return sound_path
+
+def source_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+def open_bank(path):
+    """Read a bank's header and arrays once; returns None if the bank is missing or unreadable."""
+    if path not in _banks:
+        _banks[path] = None
+        if os.path.exists(path):
+            try:
+                arrays = np.load(path, allow_pickle=False)
+                _banks[path] = (json.loads(str(arrays['__bank__'])), arrays)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not read sound bank {path}: {e}")
+    return _banks[path]
+
+def prebuilt_parts(sound_path):
+    """Return a sample's attack, sustain and original arrays from its bank, or None.
+
+    None means there is no bank for the running settings, or the sample is not in it or
+    changed on disk after the bank was built.
+    """
+    if not Main.use_prebuilt_banks:
+        return None
+    settings = bank_settings()
+    bank = open_bank(bank_path(os.path.dirname(sound_path), settings))
+    if bank is None:
+        return None
+    header, arrays = bank
+    name = os.path.basename(sound_path)
+    entry = header['samples'].get(name)
+    if header['settings'] != settings or entry is None:
+        return None
+    source = source_of(sound_path)
+    if source is None or os.path.basename(source) != entry['source'] or source_stat(source) != entry['stat']:
+        return None
+    return {part: arrays[f"{name}/{part}"] for part in entry['parts']}
+
+def bank_samples(folder):
+    """List every sample an instrument plays in the octave range, derived notes included."""
+    import Library
+    paths = set()
+    for key in Main.keys:
+        for octave in Main.octave_range:
+            for input_key in Main.input_to_note:
+                path = Library.resolve(folder, key, octave, input_key)
+                if path:
+                    paths.add(path)
+    return sorted(paths)
+
+def init_worker(frequency, channels, overrides):
+    """Open a silent mixer in the format being built and take the parent's settings."""
+    # Workers never need a real sound card
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    import pygame
+    for name, value in overrides.items():
+        setattr(Main, name, value)
+    pygame.mixer.init(frequency=frequency, size=-16, channels=channels)
+
+def build_sample(sound_path, envelopes):
+    """Process one sample for every envelope; returns its arrays per envelope and the time it took."""
+    import Audio
+    import Samples
+    start = time.perf_counter()
+    frames = Samples.load_normalized(sound_path)
+    built = {}
+    for envelope in envelopes:
+        Main.attack_duration, Main.fade_in_duration, Main.fade_out_duration = envelope
+        parts = Audio.split_frames(frames)
+        built[envelope] = {part: Samples.to_mixer_array(data) for part, data in parts.items()}
+    source = source_of(sound_path)
+    return sound_path, built, os.path.basename(source), source_stat(source), time.perf_counter() - start
+
+def write_bank(path, settings, samples):
+    """Write one bank from {sample file name: (parts, source name, source stat)}."""
+    arrays = {}
+    header = {'settings': settings, 'samples': {}}
+    for name, (parts, source, stat) in samples.items():
+        header['samples'][name] = {'parts': sorted(parts), 'source': source, 'stat': stat}
+        for part, data in parts.items():
+            arrays[f"{name}/{part}"] = data
+    arrays['__bank__'] = np.array(json.dumps(header))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write a new file and swap it in so a running harp never reads half a bank
+    temporary = path + ".tmp"
+    with open(temporary, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temporary, path)
+    return os.path.getsize(path)
+
+def parse_envelope(text):
+    """Parse 'ATTACK:FADE_IN:FADE_OUT' in milliseconds."""
+    try:
+        attack, fade_in, fade_out = (int(value) for value in text.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected ATTACK:FADE_IN:FADE_OUT in ms, got {text!r}")
+    return attack, fade_in, fade_out
+
+def build(instruments, envelopes, frequency, channels, workers=None):
+    """Build the banks of the given instruments on a process pool and print a timing summary."""
+    import Library
+    start = time.perf_counter()
+    Library.index()
+    jobs = {os.path.join(Main.base_folder, instrument): bank_samples(os.path.join(Main.base_folder, instrument)) for instrument in instruments}
+    total = sum(len(paths) for paths in jobs.values())
+    remaining = {folder: len(paths) for folder, paths in jobs.items()}
+    built = {folder: {} for folder in jobs}
+    timings = {folder: 0.0 for folder in jobs}
+    overrides = {
+        name: getattr(Main, name) for name in [
+            'base_folder', 'compact_memory', 'trim_silence', 'pitch_shift_quality', 'derive_missing_notes',
+            'onset_manifest_file'
+        ]
+    }
+    written = 0
+    workers = workers or os.cpu_count()
+    print(f"Building {total} samples of {len(jobs)} instrument(s) for {len(envelopes)} envelope(s) on {workers} worker(s)")
+
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(workers, context, init_worker, (frequency, channels, overrides)) as pool:
+        futures = {pool.submit(build_sample, path, envelopes): folder for folder, paths in jobs.items() for path in paths}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            folder = futures[future]
+            sound_path, by_envelope, source, stat, seconds = future.result()
+            built[folder][os.path.basename(sound_path)] = (by_envelope, source, stat)
+            timings[folder] += seconds
+            print(f"[{done:>4}/{total}] {os.path.basename(folder):<12} {os.path.basename(sound_path):<16} {seconds * 1000:7.1f} ms", flush=True)
+
+            remaining[folder] -= 1
+            if remaining[folder]:
+                continue
+            # Write an instrument's banks as soon as its last sample is in
+            for envelope in envelopes:
+                settings = bank_settings(envelope, (frequency, -16, channels))
+                samples = {name: (parts[envelope], source, stat) for name, (parts, source, stat) in built[folder].items()}
+                written += write_bank(bank_path(folder, settings), settings, samples)
+            del built[folder]
+
+    elapsed = time.perf_counter() - start
+    work = sum(timings.values())
+    print("Build summary:")
+    for folder, seconds in timings.items():
+        print(f"  {os.path.basename(folder):<12} {len(jobs[folder]):4} samples {seconds:8.1f} s")
+    print(f"  {'total':<12} {total:4} samples {work:8.1f} s of work in {elapsed:.1f} s ({work / elapsed:.1f}x on {workers} workers)")
+    print(f"  wrote {len(jobs) * len(envelopes)} bank(s), {written / 2 ** 20:.1f} MB, to {Main.banks_folder}")
+
+def main(argv=None):
+    import Helpers
+    parser = argparse.ArgumentParser(description="Build Laser Harp sound banks ahead of time")
+    parser.add_argument('instruments', nargs='*', help="instrument folders (default: all)")
+    parser.add_argument('--envelope', type=parse_envelope, action='append', help="ATTACK:FADE_IN:FADE_OUT in ms, repeatable (default: the current envelope)")
+    parser.add_argument('--frequency', type=int, help="mixer rate to build for (default: Main.mixer_frequency)")
+    parser.add_argument('--compact-memory', action='store_true', help="build mono banks for compact memory mode")
+    parser.add_argument('--compact-frequency', type=int, help="mixer rate in compact memory mode, e.g. 22050")
+    parser.add_argument('--layout', help="beam layout whose notes to build")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument('--output', help="bank folder (default: Main.banks_folder)")
+    args = parser.parse_args(argv)
+
+    if args.compact_memory:
+        Main.compact_memory = True
+    if args.compact_frequency:
+        Main.compact_frequency = args.compact_frequency
+    if args.output:
+        Main.banks_folder = args.output
+    if args.layout:
+        import Layout
+        if not Layout.use(args.layout):
+            sys.exit(1)
+    frequency = args.frequency or (Main.compact_memory and Main.compact_frequency) or Main.mixer_frequency
+    channels = 1 if Main.compact_memory else 2
+    envelopes = args.envelope or [(Main.attack_duration, Main.fade_in_duration, Main.fade_out_duration)]
+    build(args.instruments or Helpers.scan_instrument_folders(), envelopes, frequency, channels, args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# Consolidation.py
+#
+# Pre-mixes normal (non-sustain) loops into one summed buffer that a single channel
+# repeats with loops=-1, so channel and timer use stay flat as loop layers pile up.
+# Loops are merged once the loop set has been stable for Main.consolidation_settle_ms
+# and only while the least common multiple of their periods (rounded to
+# Main.consolidation_grid_ms) fits in Main.consolidation_max_ms. Each layer is added to
+# or subtracted from the sum on its own, so a change does not re-render the whole group.
+
+import collections
+import math
+import time
+import numpy as np
+import pygame
+import Main
+import Effects
+import Helpers
+
+# Consolidated loops: note id -> {'sound', 'period', 'offset', 'gain'} with times in ms
+# relative to _epoch
+group = {}
+period_ms = 0      # length of the summed buffer
+mix = None         # float frames of one period, with _epoch at frame 0
+_epoch = 0.0
+CHANNEL = 0        # reserved for the summed buffer by Audio.open_mixer
+_channel = None
+_settle_task = None
+
+def enabled():
+    """Check whether loops are consolidated; the engine process schedules its own loops."""
+    import Engine
+    return Main.consolidate_loops and not Engine.running()
+
+def set_enabled(value):
+    """Turn loop consolidation on or off."""
+    Main.consolidate_loops = value
+    if value:
+        loop_changed()
+    else:
+        release_all()
+
+def loop_period(note_info):
+    """Return a loop's retrigger period in ms, rounded to the consolidation grid."""
+    length = int(note_info['sounds']['loop'].get_length() * 1000)
+    grid = max(Main.consolidation_grid_ms, 1)
+    return max(round(length / grid) * grid, grid)
+
+def ms_to_frames(milliseconds):
+    return int(round(milliseconds * pygame.mixer.get_init()[0] / 1000))
+
+def loop_changed():
+    """Consolidate again once the loop set has stopped changing for a while."""
+    global _settle_task
+    if not enabled() or Main.root is None:
+        return
+    if _settle_task:
+        Main.root.after_cancel(_settle_task)
+    _settle_task = Helpers.after(Main.consolidation_settle_ms, consolidate)
+
+def layer(entry, length_ms):
+    """Render one loop's retriggers across length_ms, each cut at its period like a retriggered channel."""
+    import Samples
+    frames = Samples.sound_frames(entry['sound'])[:ms_to_frames(entry['period'])] * entry['gain']
+    total = ms_to_frames(length_ms)
+    output = np.zeros((total, frames.shape[1]), dtype=np.float32)
+    for k in range(length_ms // entry['period']):
+        start = ms_to_frames(entry['offset'] + k * entry['period']) % total
+        # Wrap the end of a copy to the start of the buffer
+        count = min(len(frames), total - start)
+        output[start:start + count] += frames[:count]
+        output[:len(frames) - count] += frames[count:]
+    return output
+
+def add(note_id, note_info):
+    """Merge a loop into the summed buffer if its period fits; returns True if it was merged."""
+    global period_ms, mix, _epoch
+    period = loop_period(note_info)
+    length = period if not group else period_ms * period // math.gcd(period_ms, period)
+    if length > Main.consolidation_max_ms:
+        return False
+
+    now = time.perf_counter()
+    if not group:
+        _epoch = now
+        period_ms = length
+        mix = np.zeros((ms_to_frames(length), pygame.mixer.get_init()[2]), dtype=np.float32)
+    elif length != period_ms:
+        # The sum repeats every period_ms, so a longer common period is whole copies of it
+        mix = np.tile(mix, (length // period_ms, 1))[:ms_to_frames(length)]
+        period_ms = length
+
+    # Keep the loop's phase: its next retrigger is one period after its last one
+    last_play = note_info.get('last_play', now)
+    entry = {
+        'sound': note_info['sounds']['loop'],
+        'period': period,
+        'offset': ((last_play - _epoch) * 1000) % period,
+        'gain': Helpers.velocity_gain(note_info.get('velocity', Main.default_velocity)),
+    }
+    mix += layer(entry, period_ms)
+    group[note_id] = entry
+    note_info['consolidated'] = True
+    return True
+
+def consolidate():
+    """Merge every compatible normal loop that is still playing on its own."""
+    global _settle_task
+    _settle_task = None
+    if not enabled():
+        return
+    candidates = [
+        (note_id, note_info) for note_id, note_info in Main.looping_notes.items()
+        if note_id not in group and not note_info['sustain_option'] and 'sounds' in note_info
+    ]
+    # Try the most common periods first so the buffer holds as many loops as it can
+    periods = collections.Counter(loop_period(note_info) for _, note_info in candidates)
+    candidates.sort(key=lambda candidate: -periods[loop_period(candidate[1])])
+    merged = []
+    for note_id, note_info in candidates:
+        if add(note_id, note_info):
+            merged.append(note_info)
+    if not merged:
+        return
+    play()
+    # The summed buffer now carries these loops, including the copies still ringing
+    for note_info in merged:
+        if note_info.get('task_id'):
+            Main.root.after_cancel(note_info['task_id'])
+            note_info['task_id'] = None
+        if note_info['channel']:
+            note_info['channel'].stop()
+    print(f"Consolidated {len(group)} loop(s) into one {period_ms / 1000:.2f} s buffer")
+
+def play():
+    """(Re)start the summed buffer on its channel at the current point of its period."""
+    global _channel
+    import Samples
+    if not group:
+        if _channel:
+            _channel.stop()
+        return
+    position = ms_to_frames(((time.perf_counter() - _epoch) * 1000) % period_ms) % len(mix)
+    sound = Samples.make_sound(np.roll(mix, -position, axis=0))
+    sound.set_volume(Main.volume)
+    if _channel is None:
+        _channel = pygame.mixer.Channel(CHANNEL)
+    with Effects.bus_lock:
+        _channel.set_volume(Effects.bus_gain)
+        _channel.play(sound, loops=-1)
+
+def resume(note_id, entry, restart):
+    """Hand a loop back to its own timer, retriggering it in phase with the summed buffer."""
+    import Looping
+    note_info = Main.looping_notes.get(note_id)
+    if note_info is None:
+        return
+    note_info['consolidated'] = False
+    if restart:
+        elapsed = (time.perf_counter() - _epoch) * 1000
+        delay = int((entry['offset'] - elapsed) % entry['period'])
+        key = note_info['key']
+        note_info['task_id'] = Helpers.after(delay, lambda: Looping.schedule_normal_loop_play(key, note_id))
+
+def release(note_id, restart=True):
+    """Take a loop out of the summed buffer, optionally resuming it on its own channel."""
+    global mix, period_ms
+    entry = group.pop(note_id)
+    if group:
+        mix -= layer(entry, period_ms)
+    else:
+        mix = None
+        period_ms = 0
+    play()
+    resume(note_id, entry, restart)
+
+def release_all(restart=True):
+    """Return every consolidated loop to its own channel and stop the summed buffer."""
+    global mix, period_ms, _channel
+    for note_id, entry in list(group.items()):
+        resume(note_id, entry, restart)
+    group.clear()
+    if _channel:
+        _channel.stop()
+    mix = None
+    period_ms = 0
+    _channel = None
+
+def set_volume(volume):
+    """Apply the master volume to the summed buffer."""
+    if _channel and _channel.get_sound():
+        _channel.get_sound().set_volume(volume)
@@ -0,0 +1,353 @@
+# Effects.py
+#
+# Master effects chain: partitioned FFT convolution reverb, feedback delay and a peak
+# limiter, processed in fixed-size blocks with NumPy.
+#
+# pygame does not expose the mixed output, so the chain is run over each sample when it
+# is loaded (see Audio.process_sound). Reverb and delay are linear, so the sum of the
+# processed voices equals the processed mix; the limiter keeps each rendered sample in
+# range. A sample whose render takes more than Main.effects_cpu_budget of its own duration
+# plays dry from then on, so one slow chain cannot hold up loading a whole bank.
+#
+# The bus limiter below then guards the sum: a timer thread looks every
+# Main.bus_limiter_interval_ms at what each playing voice will reach before the next look,
+# from the voice's envelope at the time it has been playing, and turns the channels down
+# when the sum would pass the limiter threshold. Loops play the render folded back to the
+# dry length (see wrap_tail), so a reverb or delay tail does not change how often they
+# retrigger.
+
+import math
+import os
+import threading
+import time
+import weakref
+import numpy as np
+import pygame
+import Main
+
+class ConvolutionReverb:
+    """Uniformly partitioned overlap-save convolution with an impulse response."""
+
+    def __init__(self, impulse, block, mix):
+        self.block = block
+        self.mix = mix
+        self.channels = impulse.shape[1]
+        count = max(math.ceil(len(impulse) / block), 1)
+        padded = np.zeros((count * block, self.channels), dtype=np.float32)
+        padded[:len(impulse)] = impulse
+        # One spectrum per partition, each zero-padded to two blocks
+        partitions = padded.reshape(count, block, self.channels)
+        self.spectra = np.fft.rfft(partitions, n=2 * block, axis=1).astype(np.complex64)
+        self.tail_frames = len(impulse)
+        self.reset()
+
+    def reset(self):
+        self.previous = np.zeros((self.block, self.channels), dtype=np.float32)
+        self.history = np.zeros_like(self.spectra)  # frequency-domain delay line
+        self.position = 0
+
+    def process(self, block):
+        spectrum = np.fft.rfft(np.concatenate([self.previous, block]), axis=0)
+        self.previous = block
+        self.position = (self.position + 1) % len(self.history)
+        self.history[self.position] = spectrum
+        # Partition p is multiplied with the input from p blocks ago
+        order = (self.position - np.arange(len(self.history))) % len(self.history)
+        wet = np.fft.irfft((self.history[order] * self.spectra).sum(axis=0), n=2 * self.block, axis=0)
+        return block + self.mix * wet[self.block:].astype(np.float32)
+
+class Delay:
+    """Feedback delay line."""
+
+    def __init__(self, frames, channels, feedback, mix):
+        self.frames = frames
+        self.channels = channels
+        self.feedback = feedback
+        self.mix = mix
+        # Echoes until they fall below -60 dB
+        repeats = math.ceil(math.log(0.001) / math.log(feedback)) if 0 < feedback < 1 else 1
+        self.tail_frames = frames * repeats
+        self.reset()
+
+    def reset(self):
+        self.line = np.zeros((self.frames, self.channels), dtype=np.float32)
+        self.position = 0
+
+    def process(self, block):
+        output = np.empty_like(block)
+        start = 0
+        # Work in pieces no longer than the delay so each piece only reads older input
+        while start < len(block):
+            count = min(self.frames - self.position, len(block) - start)
+            piece = block[start:start + count]
+            delayed = self.line[self.position:self.position + count].copy()
+            self.line[self.position:self.position + count] = piece + self.feedback * delayed
+            output[start:start + count] = piece + self.mix * delayed
+            self.position = (self.position + count) % self.frames
+            start += count
+        return output
+
+class Limiter:
+    """Peak limiter with instant attack and a linear release."""
+
+    def __init__(self, threshold_db, release_frames):
+        self.threshold = 10 ** (threshold_db / 20)
+        self.release = 1 / max(release_frames, 1)  # gain recovered per frame
+        self.tail_frames = 0
+        self.reset()
+
+    def reset(self):
+        self.gain = 1.0
+
+    def process(self, block):
+        peaks = np.max(np.abs(block), axis=1)
+        required = np.minimum(1.0, self.threshold / np.maximum(peaks, 1e-9))
+        # gain[n] = min(required[n], gain[n - 1] + release), solved for the whole block at once
+        steps = self.release * np.arange(1, len(block) + 1)
+        gain = steps + np.minimum.accumulate(np.minimum(required - steps, self.gain))
+        gain = np.minimum(gain, 1.0).astype(np.float32)
+        self.gain = float(gain[-1])
+        return np.clip(block * gain[:, None], -self.threshold, self.threshold)
+
+class EffectsChain:
+    """Runs effects over audio in blocks."""
+
+    def __init__(self, effects, block):
+        self.effects = effects
+        self.block = block
+        self.tail_frames = sum(effect.tail_frames for effect in effects)
+
+    def reset(self):
+        for effect in self.effects:
+            effect.reset()
+
+    def process(self, block):
+        """Process one block."""
+        for effect in self.effects:
+            block = effect.process(block)
+        return block
+
+    def render(self, frames):
+        """Run a whole sample through the chain from a clean state, including its tail."""
+        self.reset()
+        total = len(frames) + self.tail_frames
+        count = math.ceil(total / self.block)
+        padded = np.zeros((count * self.block, frames.shape[1]), dtype=np.float32)
+        padded[:len(frames)] = frames
+        output = np.empty_like(padded)
+        for i in range(count):
+            block = padded[i * self.block:(i + 1) * self.block]
+            output[i * self.block:(i + 1) * self.block] = self.process(block)
+        return trim_tail(output[:total])
+
+_chain = None
+_chain_settings = None
+
+# (sample, settings) pairs whose render went over Main.effects_cpu_budget
+over_budget = set()
+
+# Bus limiter
+bus_gain = 1.0                           # gain applied to every channel on top of its voice gain
+bus_lock = threading.Lock()              # held while channel volumes are set
+_envelopes = weakref.WeakKeyDictionary()  # Sound -> (window frames, peak level of each window)
+_voices = {}                             # channel index -> (Sound, time it was first seen playing)
+_bus_thread = None
+
+def settings():
+    """Return the effect settings a chain is built from, or None if effects are off."""
+    if not Main.effects_enabled:
+        return None
+    return (
+        Main.reverb_impulse_file, Main.reverb_time, Main.reverb_mix,
+        Main.delay_ms, Main.delay_feedback, Main.delay_mix,
+        Main.limiter_threshold_db, Main.limiter_release_ms,
+        Main.effects_block
+    )
+
+def sample_settings(sample):
+    """Return the effect settings a sample is rendered with, None if it plays dry."""
+    current = settings()
+    return None if (sample, current) in over_budget else current
+
+def synthetic_impulse(seconds, frequency, channels):
+    """Return a room-like impulse response: decorrelated noise decaying by 60 dB over seconds."""
+    rng = np.random.default_rng(0)
+    length = max(int(seconds * frequency), 1)
+    decay = np.exp(-6.91 * np.arange(length) / length)[:, None]
+    return (rng.standard_normal((length, channels)) * decay).astype(np.float32)
+
+def load_impulse(frequency, channels):
+    """Load Main.reverb_impulse_file at the mixer format, or build a synthetic one, normalized to unit energy."""
+    import Samples
+    if Main.reverb_impulse_file and os.path.exists(Main.reverb_impulse_file):
+        impulse, source_format = Samples.read_sample(Main.reverb_impulse_file)
+        impulse = Samples.remix(Samples.resample(impulse, source_format[0], frequency), channels)
+    else:
+        if Main.reverb_impulse_file:
+            print(f"Impulse response {Main.reverb_impulse_file} not found; using a synthetic room.")
+        impulse = synthetic_impulse(Main.reverb_time, frequency, channels)
+    energy = np.sqrt(np.sum(np.square(impulse), axis=0, keepdims=True))
+    return (impulse / np.maximum(energy, 1e-9)).astype(np.float32)
+
+def build_chain(frequency, channels):
+    """Build the effects chain from the current settings."""
+    block = Main.effects_block
+    effects = []
+    if Main.reverb_mix > 0:
+        effects.append(ConvolutionReverb(load_impulse(frequency, channels), block, Main.reverb_mix))
+    if Main.delay_ms > 0 and Main.delay_mix > 0:
+        effects.append(Delay(int(frequency * Main.delay_ms / 1000), channels, Main.delay_feedback, Main.delay_mix))
+    effects.append(Limiter(Main.limiter_threshold_db, int(frequency * Main.limiter_release_ms / 1000)))
+    return EffectsChain(effects, block)
+
+def chain():
+    """Return the chain for the current settings and mixer, rebuilding it when they change."""
+    global _chain, _chain_settings
+    import Samples
+    frequency, _, channels = Samples.mixer_format()
+    current = (settings(), frequency, channels)
+    if _chain is None or current != _chain_settings:
+        _chain = build_chain(frequency, channels)
+        _chain_settings = current
+    return _chain
+
+def trim_tail(frames, threshold_db=-70):
+    """Drop the inaudible end of a rendered tail."""
+    level = np.max(np.abs(frames), axis=1)
+    audible = np.flatnonzero(level > 10 ** (threshold_db / 20))
+    return frames[:audible[-1] + 1] if len(audible) else frames[:1]
+
+def apply(frames, sample=None):
+    """Run a sample's float frames through the effects chain if effects are enabled.
+
+    If the render takes more than Main.effects_cpu_budget of the sample's duration, the
+    sample is returned dry and plays dry from then on (see sample_settings).
+    """
+    import Samples
+    current = sample_settings(sample)
+    if current is None:
+        return frames
+    start = time.perf_counter()
+    rendered = chain().render(frames)
+    elapsed = time.perf_counter() - start
+    duration = len(frames) / Samples.mixer_format()[0]
+    if sample is not None and elapsed > Main.effects_cpu_budget * duration:
+        over_budget.add((sample, current))
+        print(f"Effects took {elapsed * 1000:.0f} ms for {duration * 1000:.0f} ms of {sample}; it plays dry.")
+        return frames
+    return rendered
+
+def wrap_tail(frames, length):
+    """Fold the part of a render past length back onto its start, as a loop of that period hears it."""
+    loop = frames[:length].copy()
+    for start in range(length, len(frames), length):
+        piece = frames[start:start + length]
+        loop[:len(piece)] += piece
+    return loop
+
+def sound_envelope(sound, window):
+    """Return the peak level, 0.0 to 1.0, of each window frames of a Sound, measuring it the first time."""
+    known = _envelopes.get(sound)
+    if known is not None and known[0] == window:
+        return known[1]
+    import Samples
+    size = Samples.mixer_format()[1]
+    data = pygame.sndarray.samples(sound)
+    if size == 32:
+        level = np.abs(data.astype(np.float32))
+    else:
+        half_range = 2 ** (abs(size) - 1)
+        centre = half_range if size > 0 else 0
+        level = np.abs(data.astype(np.int32) - centre).astype(np.float32) / half_range
+    if level.ndim > 1:
+        level = level.max(axis=1)
+    count = max(math.ceil(len(level) / window), 1)
+    padded = np.zeros(count * window, dtype=np.float32)
+    padded[:len(level)] = level
+    envelope = padded.reshape(count, window).max(axis=1)
+    _envelopes[sound] = (window, envelope)
+    return envelope
+
+def voice_level(index, sound, now, window):
+    """Return the most a voice reaches from now until the next look, from its envelope.
+
+    A voice is timed from the look it was first seen at, wrapping around for loops, so
+    the two windows either side of that point are taken to cover the time in between.
+    """
+    seen = _voices.get(index)
+    if seen is None or seen[0] is not sound:
+        seen = _voices[index] = (sound, now)
+    envelope = sound_envelope(sound, window)
+    position = int((now - seen[1]) * 1000 / Main.bus_limiter_interval_ms)
+    positions = np.arange(position - 1, position + 2) % len(envelope)
+    return float(envelope[positions].max())
+
+def scale_channels(ratio):
+    """Multiply the volume of every playing channel by ratio."""
+    for index in range(pygame.mixer.get_num_channels()):
+        channel = pygame.mixer.Channel(index)
+        if channel.get_busy():
+            channel.set_volume(min(channel.get_volume() * ratio, 1.0))
+
+def limit_bus():
+    """Turn every channel down while the voices would sum past the limiter threshold; call with bus_lock held."""
+    global bus_gain
+    import Samples
+    threshold = 10 ** (Main.limiter_threshold_db / 20)
+    window = max(Samples.ms_to_frames(Main.bus_limiter_interval_ms), 1)
+    now = time.perf_counter()
+    level = 0.0
+    for index in range(pygame.mixer.get_num_channels()):
+        channel = pygame.mixer.Channel(index)
+        sound = channel.get_sound()
+        if sound is None or not channel.get_busy():
+            _voices.pop(index, None)
+            continue
+        level += voice_level(index, sound, now, window) * sound.get_volume() * channel.get_volume()
+    # The level without the current gain reduction
+    level /= bus_gain
+    target = min(1.0, threshold / level) if level > 0 else 1.0
+    if target < bus_gain:
+        gain = target
+    else:
+        # Recover over Main.limiter_release_ms
+        gain = min(target, bus_gain + Main.bus_limiter_interval_ms / max(Main.limiter_release_ms, 1))
+    if gain != bus_gain:
+        scale_channels(gain / bus_gain)
+        bus_gain = gain
+
+def reset_bus():
+    """Put the channels back to their voice gains; call with bus_lock held."""
+    global bus_gain
+    if bus_gain != 1.0 and pygame.mixer.get_init():
+        scale_channels(1.0 / bus_gain)
+    bus_gain = 1.0
+    _voices.clear()
+
+def run_bus_limiter():
+    """Limit the bus on a timer thread, so Tk stalls do not leave it unlimited, until effects or the harp stop."""
+    global _bus_thread
+    while True:
+        time.sleep(Main.bus_limiter_interval_ms / 1000)
+        with bus_lock:
+            if settings() is None or not Main.running:
+                reset_bus()
+                _bus_thread = None
+                return
+            # The engine process plays the voices, or the mixer is being reopened
+            if Main.audio_engine == "process" or Main.mixer_tuning or not pygame.mixer.get_init():
+                _voices.clear()
+                continue
+            try:
+                limit_bus()
+            except pygame.error as e:
+                # The mixer was closed under us; the next look sees it
+                print(f"Bus limiter skipped a pass: {e}")
+
+def start_bus_limiter():
+    """Start the bus limiter if effects are on and it is not running yet."""
+    global _bus_thread
+    with bus_lock:
+        if _bus_thread is None and settings() is not None:
+            _bus_thread = threading.Thread(target=run_bus_limiter, daemon=True)
+            _bus_thread.start()
@@ -0,0 +1,450 @@
+# Engine.py
+#
+# Runs playback, sustain retriggering and loop scheduling in a separate process so GUI
+# stalls on the Tk thread cannot interrupt the audio. The GUI keeps building Sounds as
+# usual (on a silent dummy mixer), copies each one into shared memory once, and sends
+# note and loop commands over a shared-memory ring buffer.
+
+import atexit
+import heapq
+import multiprocessing
+import os
+import struct
+import time
+import weakref
+from multiprocessing import shared_memory
+import Main
+import Helpers
+
+# Command opcodes (GUI -> engine)
+REGISTER = 1       # a=sound id, b=byte count, name=shared memory block
+PLAY = 2           # a=sound id, z=gain, w=attack fade ms
+SUSTAIN_START = 3  # a=key id, b=attack sound id, c=sustain sound id, x=retrigger interval ms, y=fade ms, z=gain, w=attack fade ms
+SUSTAIN_STOP = 4   # a=key id, x=delay ms, y=fade ms
+LOOP_START = 5     # a=loop id, b=sound id, c=1 for sustain loops, x=retrigger interval ms, z=gain
+LOOP_UPDATE = 6    # same fields as LOOP_START, keeps the loop's timing
+LOOP_STOP = 7      # a=loop id, y=fade ms
+VOLUME = 8         # x=volume
+STOP_ALL = 9
+QUIT = 10
+UNREGISTER = 11    # a=sound id
+
+# Event opcodes (engine -> GUI)
+DROPPED = 1        # a=number of notes dropped because no channel was free
+
+poll_interval = 0.001   # seconds the engine sleeps between ring polls
+ring_capacity = 4096    # records per ring
+max_restarts = 3        # times a dead engine is restarted before playback falls back to the GUI
+
+# GUI-side state
+_process = None
+_commands = None
+_events = None
+_sound_ids = {}         # id(Sound) -> engine sound id, for Sounds still alive here
+_released = []          # engine sound ids of Sounds freed here, to unregister on the next send
+_next_sound_id = 0
+_key_ids = {}
+_start_args = None      # (frequency, buffer, driver) the engine was started with
+_restarts = 0
+
+class CommandRing:
+    """Single-producer, single-consumer ring of fixed-size records in shared memory."""
+
+    HEADER = struct.Struct('<QQQ')           # capacity, head (next write), tail (next read)
+    RECORD = struct.Struct('<BIIIffff32s')   # opcode, a, b, c, x, y, z, w, name
+
+    def __init__(self, name=None, capacity=ring_capacity):
+        if name is None:
+            size = self.HEADER.size + capacity * self.RECORD.size
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.HEADER.pack_into(self.shm.buf, 0, capacity, 0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.capacity = self.HEADER.unpack_from(self.shm.buf, 0)[0]
+
+    def push(self, opcode, a=0, b=0, c=0, x=0.0, y=0.0, z=0.0, w=0.0, name=""):
+        """Append a record, returning False if the ring is full."""
+        _, head, tail = self.HEADER.unpack_from(self.shm.buf, 0)
+        if head - tail >= self.capacity:
+            return False
+        offset = self.HEADER.size + (head % self.capacity) * self.RECORD.size
+        self.RECORD.pack_into(self.shm.buf, offset, opcode, a, b, c, x, y, z, w, name.encode('ascii'))
+        # Publish the record only after it is fully written
+        struct.pack_into('<Q', self.shm.buf, 8, head + 1)
+        return True
+
+    def pop_all(self):
+        """Remove and return every record written so far."""
+        _, head, tail = self.HEADER.unpack_from(self.shm.buf, 0)
+        records = []
+        while tail < head:
+            offset = self.HEADER.size + (tail % self.capacity) * self.RECORD.size
+            *fields, name = self.RECORD.unpack_from(self.shm.buf, offset)
+            records.append((*fields, name.rstrip(b"\0").decode('ascii')))
+            tail += 1
+        struct.pack_into('<Q', self.shm.buf, 16, tail)
+        return records
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+class AudioEngine:
+    """Plays sounds and keeps sustains and loops going inside the engine process."""
+
+    def __init__(self, events):
+        import pygame
+        self.pygame = pygame
+        self.events = events
+        self.sounds = {}
+        self.volume = 1.0
+        self.sustains = {}   # key id -> {'sustain', 'interval', 'channels'}
+        self.loops = {}      # loop id -> {'sound', 'sustain', 'interval', 'channel', 'channels'}
+        self.timers = []     # heap of (due, sequence, action, target id, generation)
+        self.sequence = 0
+        self.generation = 0  # bumped on stop so stale timers are ignored
+        self.dropped = 0
+
+    def schedule(self, due, action, target):
+        self.sequence += 1
+        heapq.heappush(self.timers, (due, self.sequence, action, target, self.generation))
+
+    def channel(self):
+        channel = self.pygame.mixer.find_channel()
+        if channel is None:
+            self.dropped += 1
+        return channel
+
+    def voice(self, sound, gain, fade_ms=0, channel=None):
+        """Play a sound at a per-voice gain on the given or a free channel, returning the channel."""
+        channel = channel or self.channel()
+        if channel:
+            # A fade-in ramps to the volume the channel has when it starts, so set it first
+            channel.set_volume(gain)
+            channel.play(sound, fade_ms=int(fade_ms))
+        return channel
+
+    def busy(self, channels):
+        """Forget channels that have finished playing."""
+        return [channel for channel in channels if channel.get_busy()]
+
+    def fade(self, channels, fade_ms):
+        for channel in channels:
+            if fade_ms > 0:
+                channel.fadeout(int(fade_ms))
+            else:
+                channel.stop()
+        channels.clear()
+
+    def known(self, opcode, a, b, c):
+        """Check that every sound a command names has been registered."""
+        if opcode == PLAY:
+            return a in self.sounds
+        if opcode == SUSTAIN_START:
+            return b in self.sounds and c in self.sounds
+        if opcode in (LOOP_START, LOOP_UPDATE):
+            return b in self.sounds
+        return True
+
+    def execute(self, opcode, a, b, c, x, y, z, w, name):
+        """Carry out one command; returns False when the engine should exit."""
+        now = time.perf_counter()
+        if opcode == REGISTER:
+            block = shared_memory.SharedMemory(name=name)
+            sound = self.pygame.mixer.Sound(buffer=bytes(block.buf[:b]))
+            block.close()
+            block.unlink()
+            sound.set_volume(self.volume)
+            self.sounds[a] = sound
+        elif opcode == UNREGISTER:
+            # Channels, sustains and loops still playing it keep their own reference
+            self.sounds.pop(a, None)
+        elif not self.known(opcode, a, b, c):
+            # The sound's REGISTER never made it into the ring
+            self.dropped += 1
+        elif opcode == PLAY:
+            self.voice(self.sounds[a], z, w)
+        elif opcode == SUSTAIN_START:
+            # A key pressed again before its release finished fades its old sustain now
+            if a in self.sustains:
+                self.fade(self.sustains[a]['channels'], y)
+            sustain = {'sustain': self.sounds[c], 'interval': x / 1000, 'gain': z, 'channels': [], 'active': True}
+            self.sustains[a] = sustain
+            self.voice(self.sounds[b], z, w)
+            self.schedule(now + self.sounds[b].get_length(), 'sustain', a)
+        elif opcode == SUSTAIN_STOP:
+            if a in self.sustains:
+                self.sustains[a]['active'] = False
+                self.schedule(now + x / 1000, 'release', (a, y))
+        elif opcode in (LOOP_START, LOOP_UPDATE):
+            loop = self.loops.get(a)
+            if opcode == LOOP_UPDATE and loop is None:
+                return True
+            if loop is None:
+                loop = {'channel': self.channel(), 'channels': []}
+                self.loops[a] = loop
+                self.schedule(now, 'loop', a)
+            loop.update(sound=self.sounds[b], sustain=bool(c), interval=x / 1000, gain=z)
+        elif opcode == LOOP_STOP:
+            loop = self.loops.pop(a, None)
+            if loop:
+                self.fade([loop['channel']] if loop['channel'] else [], y)
+                self.fade(loop['channels'], y)
+        elif opcode == VOLUME:
+            self.volume = x
+            for sound in self.sounds.values():
+                sound.set_volume(x)
+        elif opcode == STOP_ALL:
+            self.pygame.mixer.stop()
+            self.sustains.clear()
+            self.loops.clear()
+            self.generation += 1
+        elif opcode == QUIT:
+            return False
+        return True
+
+    def run_due(self):
+        """Run every timer that is due, keeping retriggers on a fixed grid so they do not drift."""
+        now = time.perf_counter()
+        while self.timers and self.timers[0][0] <= now:
+            due, _, action, target, generation = heapq.heappop(self.timers)
+            if generation != self.generation:
+                continue
+            if action == 'sustain':
+                sustain = self.sustains.get(target)
+                if sustain and sustain['active']:
+                    channel = self.voice(sustain['sustain'], sustain['gain'])
+                    if channel:
+                        sustain['channels'] = self.busy(sustain['channels']) + [channel]
+                    self.schedule(due + sustain['interval'], 'sustain', target)
+            elif action == 'release':
+                key_id, fade_ms = target
+                sustain = self.sustains.get(key_id)
+                if sustain and not sustain['active']:
+                    self.fade(sustain['channels'], fade_ms)
+                    del self.sustains[key_id]
+            elif action == 'loop':
+                loop = self.loops.get(target)
+                if loop is None:
+                    continue
+                if loop['sustain']:
+                    channel = self.voice(loop['sound'], loop['gain'])
+                    if channel:
+                        loop['channels'] = self.busy(loop['channels']) + [channel]
+                else:
+                    if loop['channel'] is None:
+                        loop['channel'] = self.channel()
+                    if loop['channel']:
+                        self.voice(loop['sound'], loop['gain'], channel=loop['channel'])
+                self.schedule(due + max(loop['interval'], poll_interval), 'loop', target)
+
+        if self.dropped:
+            self.events.push(DROPPED, self.dropped)
+            self.dropped = 0
+
+def engine_main(command_ring, event_ring, frequency, buffer, channels, driver, size=-16, output_channels=2):
+    """Entry point of the engine process."""
+    # The GUI process runs a silent dummy mixer; the engine uses the real driver
+    if driver:
+        os.environ['SDL_AUDIODRIVER'] = driver
+    else:
+        os.environ.pop('SDL_AUDIODRIVER', None)
+    import pygame
+    # Sounds arrive as raw buffers, so the sample format must match the GUI's mixer
+    pygame.mixer.init(frequency=frequency, size=size, channels=output_channels, buffer=buffer)
+    pygame.mixer.set_num_channels(channels)
+
+    commands = CommandRing(command_ring)
+    events = CommandRing(event_ring)
+    engine = AudioEngine(events)
+    parent = multiprocessing.parent_process()
+    try:
+        while parent is None or parent.is_alive():
+            for record in commands.pop_all():
+                try:
+                    if not engine.execute(*record):
+                        return
+                except Exception as e:
+                    # One bad command must not take playback down with it
+                    print(f"Audio engine could not run command {record[0]}: {e}")
+            engine.run_due()
+            time.sleep(poll_interval)
+    finally:
+        commands.close()
+        events.close()
+        pygame.mixer.quit()
+
+def start(frequency, buffer, driver):
+    """Start the engine process; the GUI's own mixer should already be open on the dummy driver."""
+    global _process, _commands, _events, _start_args
+    stop()
+    _start_args = (frequency, buffer, driver)
+    _commands = CommandRing()
+    _events = CommandRing()
+    import pygame
+    context = multiprocessing.get_context('spawn')
+    _, size, output_channels = pygame.mixer.get_init()
+    _process = context.Process(
+        target=engine_main,
+        args=(_commands.name, _events.name, frequency, buffer, Main.num_channels, driver, size, output_channels),
+        daemon=True
+    )
+    _process.start()
+    send(VOLUME, x=Main.volume)
+    print(f"Audio engine started in process {_process.pid}")
+
+@atexit.register
+def stop():
+    """Stop the engine process and release the rings."""
+    global _process, _commands, _events
+    if _process is None:
+        return
+    if _process.is_alive():
+        send(QUIT)
+    _process.join(timeout=2)
+    if _process.is_alive():
+        _process.terminate()
+    _commands.close(unlink=True)
+    _events.close(unlink=True)
+    _process = _commands = _events = None
+    _sound_ids.clear()
+    _released.clear()
+
+def running():
+    """Check whether playback is handled by the engine process, restarting it if it died."""
+    if _process is not None and not _process.is_alive():
+        restart()
+    return _process is not None
+
+def restart():
+    """Replace an engine process that died, or play on the GUI's mixer once it keeps dying."""
+    global _restarts
+    print(f"Audio engine process exited with code {_process.exitcode}")
+    stop()
+    if _restarts < max_restarts:
+        _restarts += 1
+        start(*_start_args)
+        # The new engine starts without the loops the old one was playing
+        for note_info in Main.looping_notes.values():
+            if 'sounds' in note_info:
+                start_loop(note_info)
+        return
+    import Audio
+    print("Audio engine keeps exiting; playing on the GUI's mixer instead")
+    Main.audio_engine = "inline"
+    # Reopened on the real driver once the current command has finished
+    Main.root.after(0, Audio.restart_mixer)
+
+def send(opcode, a=0, b=0, c=0, x=0.0, y=0.0, z=0.0, w=0.0, name=""):
+    """Send a command to the engine, waiting briefly if the ring is full; returns whether it was sent."""
+    poll_events()
+    while _released and opcode != UNREGISTER:
+        send(UNREGISTER, _released.pop())
+    deadline = time.perf_counter() + 0.05
+    while not _commands.push(opcode, a, b, c, x, y, z, w, name):
+        if time.perf_counter() > deadline:
+            print("Audio engine command ring is full; command dropped.")
+            return False
+        time.sleep(poll_interval)
+    return True
+
+def poll_events():
+    """Pick up events reported by the engine."""
+    import Telemetry
+    for event in _events.pop_all():
+        if event[0] == DROPPED:
+            for _ in range(event[1]):
+                Telemetry.note_dropped()
+
+def sound_id(sound):
+    """Return the engine's id for a Sound, copying it to the engine through shared memory the first time.
+
+    Returns None if the engine could not be told about it; the caller drops the note.
+    """
+    global _next_sound_id
+    import pygame
+    known = _sound_ids.get(id(sound))
+    if known:
+        return known
+    data = pygame.sndarray.samples(sound)
+    block = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    block.buf[:data.nbytes] = data.tobytes()
+    _next_sound_id += 1
+    identifier = _next_sound_id
+    sent = send(REGISTER, identifier, data.nbytes, name=block.name)
+    block.close()
+    if not sent:
+        # Nobody will copy it, so it is removed here; a later note tries again
+        block.unlink()
+        return None
+    # The engine unlinks the block once it has copied it
+    _sound_ids[id(sound)] = identifier
+    # Once the Sound is dropped here, e.g. with its sample cache entry, the engine drops its copy
+    weakref.finalize(sound, release_sound, id(sound), identifier)
+    return identifier
+
+def release_sound(sound_key, identifier):
+    """Forget a freed Sound; it may be freed on any thread, so the engine is told on the next send."""
+    if _sound_ids.get(sound_key) == identifier:
+        del _sound_ids[sound_key]
+        _released.append(identifier)
+
+def key_id(key):
+    """Return a stable number for an input key."""
+    return _key_ids.setdefault(key, len(_key_ids) + 1)
+
+def dropped():
+    import Telemetry
+    Telemetry.note_dropped()
+
+def play(sound, gain=1.0, fade_ms=0):
+    identifier = sound_id(sound)
+    if identifier is None:
+        dropped()
+        return
+    send(PLAY, identifier, z=gain, w=fade_ms)
+
+def start_sustain(key, sounds, sustain_length, gain=1.0, fade_ms=0):
+    """Play the attack, then keep retriggering the sustain sound until stop_sustain."""
+    interval = sustain_length / Main.max_overlaps
+    attack, sustain = sound_id(sounds['attack']), sound_id(sounds['sustain'])
+    if attack is None or sustain is None:
+        dropped()
+        return
+    send(SUSTAIN_START, key_id(key), attack, sustain, interval, Main.fade_out_duration, gain, fade_ms)
+
+def stop_sustain(key):
+    """Fade out a key's sustain after Main.sustain_interval."""
+    send(SUSTAIN_STOP, key_id(key), x=Main.sustain_interval, y=Main.fade_out_duration)
+
+def loop_command(opcode, note_info):
+    if note_info['sustain_option']:
+        sound = note_info['sounds']['sustain']
+        interval = note_info['sustain_length'] / Main.max_overlaps
+    else:
+        sound = note_info['sounds']['loop']
+        interval = sound.get_length() * 1000
+    gain = Helpers.velocity_gain(note_info.get('velocity', Main.default_velocity))
+    identifier = sound_id(sound)
+    if identifier is None:
+        dropped()
+        return
+    send(opcode, note_info['slot'], identifier, int(note_info['sustain_option']), interval, z=gain)
+
+def start_loop(note_info):
+    loop_command(LOOP_START, note_info)
+
+def update_loop(note_info):
+    """Switch a running loop to the note's reloaded sounds."""
+    loop_command(LOOP_UPDATE, note_info)
+
+def stop_loop(note_info):
+    send(LOOP_STOP, note_info['slot'], y=Main.fade_out_duration)
+
+def set_volume(volume):
+    send(VOLUME, x=volume)
+
+def stop_all():
+    send(STOP_ALL)
@@ -4,9 +4,18 @@ import os
 import tkinter as tk
 from tkinter import ttk
 import Main
-import Audio
-import Looping
 import Helpers
+import Recording
+
+# Audio and Looping pull in pygame, so they are only loaded once the first frame is drawn
+Audio = Helpers.lazy_import("Audio")
+Looping = Helpers.lazy_import("Looping")
+Latency = Helpers.lazy_import("Latency")
+Memory = Helpers.lazy_import("Memory")
+Phrases = Helpers.lazy_import("Phrases")
+Consolidation = Helpers.lazy_import("Consolidation")
+Profiler = Helpers.lazy_import("Profiler")
+Layout = Helpers.lazy_import("Layout")
 
 def octave_buttons():
     """Create octave switcher buttons."""
@@ -21,7 +30,7 @@ def octave_buttons():
         octave_button = tk.Button(
             octave_buttons_frame,
             text=f"Octave {octave}",
-            command=lambda o=octave: Audio.change_octave(o),
+            command=lambda o=octave: Recording.perform('change_octave', o),
             width=20,
             activebackground="blue",
             activeforeground="white"
@@ -29,6 +38,11 @@ def octave_buttons():
         octave_button.grid(row=i * 2, column=0, pady=padding_y, sticky='nsw')
         octave_buttons_frame.grid_rowconfigure(i * 2, weight=1)
 
+def on_volume_change(value):
+    """Apply a volume slider change, skipping the callback from setting its initial value."""
+    if float(value) != Main.volume:
+        Recording.perform('adjust_volume', value)
+
 def volume_slider():
     """Create volume slider."""
     tk.Label(main_frame, text="Volume").grid(row=0, column=1, pady=padding_y)
@@ -37,7 +51,7 @@ def volume_slider():
         from_=1,
         to=0,
         orient='vertical',
-        command=Audio.adjust_volume,
+        command=on_volume_change,
         resolution=.01,
         width=padding_y * 4,
         activebackground="blue",
@@ -61,7 +75,7 @@ def instrument_buttons():
             instrument_button_frame,
             text=f"{instrument}",
             width=20,
-            command=lambda i=instrument: Audio.choose_folder(i),
+            command=lambda i=instrument: Recording.perform('choose_folder', i),
             activebackground="blue",
             activeforeground="white"
         )
@@ -94,17 +108,24 @@ def advanced_menu():
     key_dropdown.set(Main.current_key)
     key_dropdown.bind(
         "<<ComboboxSelected>>",
-        lambda e: Audio.change_key(key_dropdown.get())
+        lambda e: Recording.perform('change_key', key_dropdown.get())
     )
     key_dropdown.pack(pady=padding_y)
 
+    tk.Label(controls_frame, text="Pitch Shift Quality").pack(pady=padding_y)
+    quality_dropdown = ttk.Combobox(controls_frame, values=Main.pitch_shift_qualities, state="readonly")
+    quality_dropdown.set(Main.pitch_shift_quality)
+    quality_dropdown.bind(
+        "<<ComboboxSelected>>",
+        lambda e: Audio.set_pitch_shift_quality(quality_dropdown.get())
+    )
+    quality_dropdown.pack(pady=padding_y)
+
     # Sustain option
     sustain_var = tk.BooleanVar(value=Main.sustain_option)
 
     def update_sustain():
-        Main.sustain_option = sustain_var.get()
-        if Main.running:
-            Audio.preload_sounds()
+        Recording.perform('set_sustain_option', int(sustain_var.get()))
 
     sustain_check = tk.Checkbutton(
         controls_frame,
@@ -114,14 +135,96 @@ def advanced_menu():
     )
     sustain_check.pack(pady=padding_y)
 
-    # Loop button
-    def activate_loop_mode():
-        Main.loop_mode = True
+    # Low-latency mode and output latency report
+    latency_var = tk.BooleanVar(value=Main.low_latency_mode)
+    latency_label = tk.Label(controls_frame, text=Latency.latency_summary())
+
+    def latency_changing():
+        # Tuning runs in the background; the controls wait for it
+        latency_check.config(state=tk.DISABLED)
+        retune_button.config(state=tk.DISABLED)
+        latency_label.config(text="Tuning the mixer buffer...")
 
+    def latency_changed():
+        if latency_label.winfo_exists():
+            latency_check.config(state=tk.NORMAL)
+            retune_button.config(state=tk.NORMAL)
+            latency_label.config(text=Latency.latency_summary())
+
+    def update_low_latency():
+        latency_changing()
+        Audio.set_low_latency_mode(latency_var.get(), on_done=latency_changed)
+
+    def retune_latency():
+        latency_changing()
+        Audio.restart_mixer(retune=True, on_done=latency_changed)
+
+    latency_check = tk.Checkbutton(
+        controls_frame,
+        text="Low Latency Mode",
+        variable=latency_var,
+        command=update_low_latency
+    )
+    latency_check.pack(pady=padding_y)
+    latency_label.pack(pady=padding_y)
+    retune_button = tk.Button(
+        controls_frame,
+        text="Retune Buffer",
+        command=retune_latency
+    )
+    retune_button.pack(pady=padding_y)
+
+    # Master effects (reverb, delay, limiter)
+    effects_var = tk.BooleanVar(value=Main.effects_enabled)
+    tk.Checkbutton(
+        controls_frame,
+        text="Master Effects",
+        variable=effects_var,
+        command=lambda: Audio.set_effects_enabled(effects_var.get())
+    ).pack(pady=padding_y)
+
+    # Instrument layers: extra instruments every key also plays
+    def describe_layers():
+        if not Main.instrument_layers:
+            return "Layers: none"
+        return "Layers: " + ", ".join(
+            f"{layer['instrument']} x{layer['gain']:.2f} {layer['octave_offset']:+d} oct" for layer in Main.instrument_layers
+        )
+
+    def add_layer():
+        if not layer_dropdown.get():
+            return
+        layer = {
+            'instrument': layer_dropdown.get(),
+            'gain': float(layer_gain.get()),
+            'octave_offset': int(layer_offset.get())
+        }
+        Audio.set_instrument_layers(Main.instrument_layers + [layer])
+        layer_label.config(text=describe_layers())
+
+    def clear_layers():
+        Audio.set_instrument_layers([])
+        layer_label.config(text=describe_layers())
+
+    tk.Label(controls_frame, text="Layer Instrument").pack(pady=padding_y)
+    layer_dropdown = ttk.Combobox(controls_frame, values=Main.instrument_folders, state="readonly")
+    layer_dropdown.pack(pady=padding_y)
+    layer_gain = tk.Scale(controls_frame, from_=0, to=1, resolution=.05, orient='horizontal', label="Layer Gain")
+    layer_gain.set(0.5)
+    layer_gain.pack(pady=padding_y)
+    layer_offset = ttk.Combobox(controls_frame, values=[-2, -1, 0, 1, 2], state="readonly", width=5)
+    layer_offset.set(0)
+    layer_offset.pack(pady=padding_y)
+    tk.Button(controls_frame, text="Add Layer", command=add_layer).pack(pady=padding_y)
+    tk.Button(controls_frame, text="Clear Layers", command=clear_layers).pack(pady=padding_y)
+    layer_label = tk.Label(controls_frame, text=describe_layers())
+    layer_label.pack(pady=padding_y)
+
+    # Loop button
     loop_button = tk.Button(
         controls_frame,
         text="Loop Next Note",
-        command=activate_loop_mode
+        command=lambda: Recording.perform('activate_loop_mode')
     )
     loop_button.pack(pady=padding_y)
 
@@ -129,10 +232,81 @@ def advanced_menu():
     stop_all_button = tk.Button(
         controls_frame,
         text="Stop All Loops",
-        command=Looping.stop_all_loops
+        command=lambda: Recording.perform('stop_all_loops')
     )
     stop_all_button.pack(pady=padding_y)
 
+    # Phrase looper: record a riff and loop it as one voice
+    def toggle_phrase():
+        if Phrases.recording:
+            Recording.perform('stop_phrase')
+        else:
+            Recording.perform('start_phrase')
+        phrase_button.config(text="Stop Phrase" if Phrases.recording else "Record Phrase")
+
+    phrase_button = tk.Button(
+        controls_frame,
+        text="Stop Phrase" if Phrases.recording else "Record Phrase",
+        command=toggle_phrase
+    )
+    phrase_button.pack(pady=padding_y)
+
+    # Pre-mix normal loops into one summed buffer
+    consolidate_var = tk.BooleanVar(value=Main.consolidate_loops)
+    tk.Checkbutton(
+        controls_frame,
+        text="Consolidate Loops",
+        variable=consolidate_var,
+        command=lambda: Consolidation.set_enabled(consolidate_var.get())
+    ).pack(pady=padding_y)
+
+    # Performance recording and replay
+    def toggle_recording():
+        if Recording.active:
+            Recording.stop_recording()
+        else:
+            Recording.start_recording()
+        record_button.config(text="Stop Recording" if Recording.active else "Start Recording")
+
+    def replay_latest():
+        path = Recording.latest_recording()
+        if path and not Recording.active:
+            Recording.replay(path)
+
+    record_button = tk.Button(
+        controls_frame,
+        text="Stop Recording" if Recording.active else "Start Recording",
+        command=toggle_recording
+    )
+    record_button.pack(pady=padding_y)
+    tk.Button(
+        controls_frame,
+        text="Replay Last Recording",
+        command=replay_latest
+    ).pack(pady=padding_y)
+
+    # Profile the running harp to find the cause of stutters
+    def toggle_profiling():
+        Profiler.toggle()
+        profile_button.config(text="Stop Profiling" if Profiler.active else "Start Profiling")
+
+    profile_button = tk.Button(
+        controls_frame,
+        text="Stop Profiling" if Profiler.active else "Start Profiling",
+        command=toggle_profiling
+    )
+    profile_button.pack(pady=padding_y)
+
+    # Memory held by loaded sound banks
+    tk.Label(controls_frame, text="Memory Usage").pack(pady=padding_y)
+    memory_label = tk.Label(controls_frame, text=Memory.report(), justify='left')
+    memory_label.pack(pady=padding_y)
+    tk.Button(
+        controls_frame,
+        text="Refresh Memory Usage",
+        command=lambda: memory_label.config(text=Memory.report())
+    ).pack(pady=padding_y)
+
     # Right side: Looping notes display
     looping_frame = tk.Frame(advanced_frame)
     looping_frame.grid(row=0, column=1, sticky='nsew')
@@ -155,7 +329,7 @@ def advanced_menu():
             slot_frame,
             text="Instrument Lock",
             variable=instrument_lock_var,
-            command=lambda idx=i: Looping.toggle_instrument_lock(idx)
+            command=lambda idx=i: Recording.perform('toggle_instrument_lock', idx)
         )
         instrument_lock_check.pack(side='right', padx=padding_x/2)
 
@@ -165,7 +339,7 @@ def advanced_menu():
             slot_frame,
             text="Key Lock",
             variable=key_lock_var,
-            command=lambda idx=i: Looping.toggle_key_lock(idx)
+            command=lambda idx=i: Recording.perform('toggle_key_lock', idx)
         )
         key_lock_check.pack(side='right', padx=padding_x/2)
 
@@ -175,7 +349,7 @@ def advanced_menu():
             slot_frame,
             text="Octave Lock",
             variable=octave_lock_var,
-            command=lambda idx=i: Looping.toggle_octave_lock(idx)
+            command=lambda idx=i: Recording.perform('toggle_octave_lock', idx)
         )
         octave_lock_check.pack(side='right', padx=padding_x/2)
 
@@ -183,7 +357,7 @@ def advanced_menu():
         stop_loop_button = tk.Button(
             slot_frame,
             text="Stop",
-            command=lambda idx=i: Looping.stop_loop_by_slot(idx)
+            command=lambda idx=i: Recording.perform('stop_loop_by_slot', idx)
         )
         stop_loop_button.pack(side='right', padx=padding_x/2)
 
@@ -203,14 +377,14 @@ def advanced_menu():
     lock_all_instruments_button = tk.Button(
         instrument_lock_buttons_frame,
         text="Lock All Instruments",
-        command=Looping.lock_all_instruments
+        command=lambda: Recording.perform('lock_all_instruments')
     )
     lock_all_instruments_button.pack(side='left', padx=padding_x/2)
 
     unlock_all_instruments_button = tk.Button(
         instrument_lock_buttons_frame,
         text="Unlock All Instruments",
-        command=Looping.unlock_all_instruments
+        command=lambda: Recording.perform('unlock_all_instruments')
     )
     unlock_all_instruments_button.pack(side='right', padx=padding_x/2)
 
@@ -222,14 +396,14 @@ def advanced_menu():
     lock_all_octaves_button = tk.Button(
         octave_lock_buttons_frame,
         text="Lock All Octaves",
-        command=Looping.lock_all_octaves
+        command=lambda: Recording.perform('lock_all_octaves')
     )
     lock_all_octaves_button.pack(side='left', padx=padding_x/2)
 
     unlock_all_octaves_button = tk.Button(
         octave_lock_buttons_frame,
         text="Unlock All Octaves",
-        command=Looping.unlock_all_octaves
+        command=lambda: Recording.perform('unlock_all_octaves')
     )
     unlock_all_octaves_button.pack(side='right', padx=padding_x/2)
 
@@ -240,14 +414,14 @@ def advanced_menu():
     lock_all_keys_button = tk.Button(
         key_lock_buttons_frame,
         text="Lock All Keys",
-        command=Looping.lock_all_keys
+        command=lambda: Recording.perform('lock_all_keys')
     )
     lock_all_keys_button.pack(side='left', padx=padding_x/2)
 
     unlock_all_keys_button = tk.Button(
         key_lock_buttons_frame,
         text="Unlock All Keys",
-        command=Looping.unlock_all_keys
+        command=lambda: Recording.perform('unlock_all_keys')
     )
     unlock_all_keys_button.pack(side='right', padx=padding_x/2)
 
@@ -293,7 +467,14 @@ def update_looping_notes_display(event=None):
         octave_lock_var = slot_info['octave_lock_var']
         key_lock_var = slot_info['key_lock_var']
         instrument_lock_var = slot_info['instrument_lock_var']
-        if note_id is not None:
+        if note_id is not None and Main.looping_notes[note_id].get('phrase'):
+            note_info = Main.looping_notes[note_id]
+            length = note_info['sounds']['original'].get_length()
+            slot_label.config(text=f"Slot {i+1}: Phrase ({note_info['phrase']} notes, {length:.1f} s)")
+            octave_lock_var.set(False)
+            key_lock_var.set(False)
+            instrument_lock_var.set(False)
+        elif note_id is not None:
             note_info = Main.looping_notes[note_id]
             key = note_info['key']
             original_note = Main.input_to_note[key]
@@ -302,8 +483,7 @@ def update_looping_notes_display(event=None):
                 octave = note_info['locked_octave']
             else:
                 octave = Main.current_octave
-            if key == '=':
-                octave += 1
+            octave += Layout.octave_offset(key)
             # Use locked key if key is locked
             used_key = note_info['locked_key'] if note_info['key_locked'] else Main.current_key
             # Use locked instrument if instrument is locked
@@ -344,8 +524,8 @@ def stop_harp():
     root.unbind("<KeyPress>")
     root.unbind("<KeyRelease>")
 
-def main_menu():
-    """Set up the main GUI layout."""
+def main_menu(on_first_frame=None):
+    """Set up the main GUI layout, calling on_first_frame once the window has been drawn."""
     global start_button
     global root
     root = tk.Tk()
@@ -394,4 +574,9 @@ def main_menu():
         width=20
     ).pack(side=tk.RIGHT, padx=padding_x)
 
-    root.mainloop()
\ No newline at end of file
+    if on_first_frame:
+        # Draw the window before running the deferred startup work
+        root.update()
+        root.after(0, on_first_frame)
+
+    root.mainloop()
@@ -1,7 +1,12 @@
 # Helpers.py
 
+import importlib.util
 import os
+import sys
+import time
 import Main
+import Library
+import Telemetry
 
 def transpose_note(note, key, octave, locked_key=None):
     """Transpose a note based on the current key or locked key, adjusting the octave if necessary."""
@@ -18,9 +23,71 @@ def transpose_note(note, key, octave, locked_key=None):
 
 def get_note_identifier(key, octave, instrument=None):
     """Generate a unique identifier for a note based on its transposed note, octave, and instrument."""
-    original_note = Main.input_to_note[key]
-    transposed_note, adjusted_octave = transpose_note(original_note, Main.current_key, octave)
-    if key == '=':
-        adjusted_octave += 1
     instrument_part = f"_{os.path.basename(instrument)}" if instrument else ""
-    return f"{transposed_note}{adjusted_octave}{instrument_part}"
\ No newline at end of file
+    return f"{Library.note_name(Main.current_key, octave, key)}{instrument_part}"
+
+def note_number(note, octave):
+    """Return the number of semitones a note lies above C0."""
+    return octave * len(Main.keys) + Main.keys.index(note)
+
+def parse_note_name(name):
+    """Split a sample name such as 'C#4' into its note and octave, or return None if it is not a note."""
+    note, octave = name.rstrip("0123456789"), name[len(name.rstrip("0123456789")):]
+    if note not in Main.keys or not octave:
+        return None
+    return note, int(octave)
+
+def velocity_gain(velocity):
+    """Return the per-voice gain for a velocity."""
+    return velocity ** Main.velocity_curve
+
+def velocity_fade_in(velocity):
+    """Return the attack fade-in in milliseconds for a velocity, if velocity shapes the attack."""
+    if not Main.velocity_shapes_attack:
+        return 0
+    return int(Main.velocity_attack_ms * (1 - velocity))
+
+_held = []  # callbacks that came due while the mixer was being tuned
+
+def after(delay, callback):
+    """Schedule a callback on the Tk loop, recording how late it actually runs.
+
+    Callbacks that come due while the mixer buffer is being tuned are held until
+    release_held(), since they play on the mixer.
+    """
+    due = time.perf_counter() + delay / 1000
+
+    def run():
+        if Main.mixer_tuning:
+            _held.append(run)
+            return
+        Telemetry.after_lateness(max(time.perf_counter() - due, 0.0))
+        callback()
+
+    return Main.root.after(delay, run)
+
+def release_held():
+    """Run the callbacks held while the mixer was being tuned."""
+    held = _held[:]
+    _held.clear()
+    for run in held:
+        run()
+
+def scan_instrument_folders():
+    """List the instrument folders available under the base sample folder."""
+    Main.instrument_folders = [
+        f for f in os.listdir(Main.base_folder) if os.path.isdir(os.path.join(Main.base_folder, f))
+    ]
+    return Main.instrument_folders
+
+def lazy_import(name):
+    """Import a module whose body only runs the first time one of its attributes is used."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
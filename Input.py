@@ -2,6 +2,7 @@
 
 import Main
 import Audio
+import Layout
 import Looping
 
 def key_press(event):
@@ -14,10 +15,7 @@ def key_press(event):
     elif keysym == 'Shift_R':
         handle_shift('right')
     elif key in Main.input_to_note:
-        octave = Main.current_octave
-        if key == '=':
-            octave += 1
-        note_id = Audio.get_note_identifier(key, octave)
+        note_id = Layout.note_id(key)
         if Main.loop_mode:
             Looping.handle_loop_mode(note_id, key)
         else:
@@ -67,10 +65,7 @@ def key_release(event):
     if key in Main.input_to_note:
         if key in Main.key_status:
             Main.key_status[key] = False
-            octave = Main.current_octave
-            if key == '=':
-                octave += 1
-            note_id = Audio.get_note_identifier(key, octave)
+            note_id = Layout.note_id(key)
             if Main.sustain_option:
                 # If the note is looping, do not stop it
                 if note_id in Main.looping_notes:
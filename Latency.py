@@ -0,0 +1,120 @@
+# Latency.py
+
+import queue
+import threading
+import time
+import pygame
+import Main
+import Settings
+
+# Buffer sizes tried in low-latency mode, smallest first
+buffer_candidates = [128, 256, 512, 1024, 2048, 4096]
+
+# Probe Settings
+probe_duration = 250      # milliseconds of audio per probe
+probe_runs = 3
+probe_voices = 32         # Simultaneous voices, so the mixer is loaded like a busy performance
+underrun_tolerance = 2.0  # Allowed playback overshoot, in buffer periods
+timing_slack = 5.0        # milliseconds of allowance for polling and scheduling jitter
+poll_interval = 50        # milliseconds between checks for a background tuning to finish
+
+_tuned = queue.Queue()
+
+def buffer_period(buffer, frequency):
+    """Return the duration of one mixer buffer in milliseconds."""
+    return buffer / frequency * 1000
+
+def probe_playback():
+    """Play a silent probe on many channels and return the mean and worst overshoot in milliseconds.
+
+    When the audio callback cannot keep up, the mixer consumes the probe more slowly than real
+    time, so the probe finishes late by more than a buffer period.
+    """
+    frequency, size, channels = pygame.mixer.get_init()
+    frame_bytes = abs(size) // 8 * channels
+    frames = int(frequency * probe_duration / 1000)
+    probe = pygame.mixer.Sound(buffer=bytes(frames * frame_bytes))
+
+    overshoots = []
+    for _ in range(probe_runs):
+        playing = []
+        start = time.perf_counter()
+        for _ in range(probe_voices):
+            channel = pygame.mixer.find_channel()
+            if channel:
+                channel.play(probe)
+                playing.append(channel)
+        while any(channel.get_busy() for channel in playing):
+            time.sleep(0.001)
+        elapsed = (time.perf_counter() - start) * 1000
+        overshoots.append(max(0.0, elapsed - probe_duration))
+    return sum(overshoots) / len(overshoots), max(overshoots)
+
+def tune_buffer(frequency=None):
+    """Find the smallest mixer buffer that plays without underruns, open the mixer with it and persist it."""
+    import Audio  # Import here to avoid circular import
+    frequency = frequency or Main.mixer_frequency
+
+    for buffer in buffer_candidates:
+        Audio.open_mixer(frequency, buffer)
+        period = buffer_period(buffer, frequency)
+        mean_overshoot, worst_overshoot = probe_playback()
+        if worst_overshoot <= period * underrun_tolerance + timing_slack:
+            break
+        print(f"Buffer of {buffer} frames underruns (probe overshoot {worst_overshoot:.1f} ms), backing off.")
+
+    # The largest candidate is kept even if it still struggles
+    Main.output_latency_ms = period + mean_overshoot
+    Settings.update(
+        mixer_frequency=frequency,
+        mixer_buffer=buffer,
+        output_latency_ms=Main.output_latency_ms
+    )
+    print(f"Mixer buffer tuned to {buffer} frames at {frequency} Hz ({Main.output_latency_ms:.1f} ms latency).")
+    return buffer
+
+def tune_in_background(frequency, on_done):
+    """Tune the buffer on a worker thread so the Tk loop keeps running, then call on_done(buffer) on it.
+
+    Main.mixer_tuning is set meanwhile; audio callbacks check it and leave the mixer alone.
+    """
+    if Main.root is None:
+        on_done(tune_buffer(frequency))
+        return
+    Main.mixer_tuning = True
+
+    def work():
+        buffer = None
+        try:
+            buffer = tune_buffer(frequency)
+        except Exception as e:
+            print(f"Could not tune the mixer buffer: {e}")
+        finally:
+            _tuned.put(buffer)
+
+    threading.Thread(target=work, daemon=True).start()
+    Main.root.after(poll_interval, lambda: finish_tuning(frequency, on_done))
+
+def finish_tuning(frequency, on_done):
+    """Hand a finished background tuning to on_done on the Tk thread."""
+    import Audio
+    import Helpers
+    try:
+        buffer = _tuned.get_nowait()
+    except queue.Empty:
+        Main.root.after(poll_interval, lambda: finish_tuning(frequency, on_done))
+        return
+    if buffer is None:
+        # Fall back to the configured buffer so the harp still has a mixer
+        Audio.open_mixer(frequency, Main.mixer_buffer)
+    Main.mixer_tuning = False
+    on_done(buffer)
+    Helpers.release_held()
+
+def latency_summary():
+    """Describe the current output latency for display in the GUI."""
+    period = buffer_period(Main.mixer_buffer, Main.mixer_frequency)
+    text = f"Buffer: {Main.mixer_buffer} frames @ {Main.mixer_frequency} Hz ({period:.1f} ms)"
+    if Main.output_latency_ms is not None:
+        text += f"\nMeasured output latency: {Main.output_latency_ms:.1f} ms"
+    return text
@@ -0,0 +1,112 @@
+# Layout.py
+#
+# Beam layouts: which input key each beam sends and which note it plays. The default is
+# the 13-key keyboard layout in Main.input_to_note; other layouts are JSON files in
+# Main.layouts_folder, chosen with Main.layout or --layout. A layout lists its beams,
+#   {"beams": [{"input": "`", "note": "C", "octave": 0}, ...]}
+# or builds them from a scale repeated over several octaves,
+#   {"scale": ["C", "D", "E", "G", "A"], "octaves": 3, "top": true, "inputs": "`1234567890-=qwe"}
+# where "top" adds the scale's first note one octave above the last and an optional
+# "first_octave" starts lower. Octaves are relative to the current octave. Layouts
+# compile into a dispatch table indexed by beam number that holds each beam's note id
+# for the current key, octave and instrument.
+
+import json
+import os
+import Main
+
+# Dispatch table
+beams = []          # beam number -> input key
+beam_index = {}     # input key -> beam number
+_note_ids = []      # beam number -> note id for the settings in _compiled_for
+_compiled_for = None
+
+def layout_path(name):
+    """Return the file a layout name refers to."""
+    if os.path.exists(name):
+        return name
+    return os.path.join(Main.layouts_folder, name if name.endswith(".json") else name + ".json")
+
+def beams_from(layout):
+    """Return a layout's beams as (input key, note, octave) tuples in beam order."""
+    if 'beams' in layout:
+        return [(beam['input'], beam['note'], beam.get('octave', 0)) for beam in layout['beams']]
+    scale = layout['scale']
+    first = layout.get('first_octave', 0)
+    last = first + layout.get('octaves', 1)
+    notes = [(note, octave) for octave in range(first, last) for note in scale]
+    if layout.get('top'):
+        notes.append((scale[0], last))
+    if len(layout['inputs']) < len(notes):
+        raise ValueError(f"{len(notes)} beams but only {len(layout['inputs'])} inputs")
+    return [(input_key, note, octave) for input_key, (note, octave) in zip(layout['inputs'], notes)]
+
+def load(name):
+    """Read and check a layout file, returning its beams."""
+    with open(layout_path(name)) as f:
+        result = beams_from(json.load(f))
+    inputs = [input_key for input_key, _, _ in result]
+    if len(set(inputs)) != len(inputs):
+        raise ValueError("an input key is used by more than one beam")
+    for input_key, note, octave in result:
+        if note not in Main.keys:
+            raise ValueError(f"beam {input_key!r} plays unknown note {note!r}")
+        if not isinstance(octave, int):
+            raise ValueError(f"beam {input_key!r} has octave {octave!r}, not a whole number")
+    return result
+
+def apply(result):
+    """Make a list of beams the harp's input keys."""
+    import Library
+    # Key presses are matched in upper case
+    Main.input_to_note = {input_key.upper(): note for input_key, note, _ in result}
+    Main.input_octaves = {input_key.upper(): octave for input_key, _, octave in result if octave}
+    # Names and resolutions were computed for the previous layout
+    Library.note_names.clear()
+    Library.resolution.clear()
+    for folder in list(Library.instruments):
+        Library.index_folder(folder)
+    reset()
+
+def use(name):
+    """Switch to the named layout, keeping the current one if it cannot be loaded."""
+    try:
+        result = load(name)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Could not load layout {name}: {e}")
+        return False
+    apply(result)
+    print(f"Using layout {name}: {len(result)} beams")
+    return True
+
+def reset():
+    """Drop the dispatch table so it is rebuilt from the current layout."""
+    global _compiled_for
+    beams.clear()
+    beam_index.clear()
+    _note_ids.clear()
+    _compiled_for = None
+
+def compile_table():
+    """Build the dispatch table for the current key, octave and instrument."""
+    global _compiled_for
+    import Library
+    beams[:] = list(Main.input_to_note)
+    beam_index.clear()
+    beam_index.update((input_key, beam) for beam, input_key in enumerate(beams))
+    instrument = os.path.basename(Main.current_folder)
+    _note_ids[:] = [
+        f"{Library.note_name(Main.current_key, Main.current_octave, input_key)}_{instrument}"
+        for input_key in beams
+    ]
+    _compiled_for = (Main.current_key, Main.current_octave, Main.current_folder)
+
+def note_id(input_key):
+    """Return the note id an input key plays, rebuilding the table only when the settings changed."""
+    if _compiled_for != (Main.current_key, Main.current_octave, Main.current_folder):
+        compile_table()
+    return _note_ids[beam_index[input_key]]
+
+def octave_offset(input_key):
+    """Return how many octaves above the current octave an input key plays."""
+    return Main.input_octaves.get(input_key, 0)
@@ -0,0 +1,228 @@
+# Library.py
+#
+# Indexes the sample library once so that resolving a note never touches the filesystem.
+# index() lists every instrument folder and precomputes which sample each
+# (instrument, key, octave, input key) plays; analyse() records each sample's format,
+# duration and loudness in Main.library_manifest_file and reports library problems.
+#
+# Usage: python Library.py [--detail]
+
+import argparse
+import json
+import os
+import threading
+import Main
+import Helpers
+
+# Indexed instrument folders, keyed by folder path as used in Main.current_folder:
+#   {'samples': {sample name: path}, 'notes': {note number: path}}
+instruments = {}
+
+# (instrument folder, key, octave, input key) -> sample path, or None if nothing can be played
+resolution = {}
+
+# (key, octave, input key) -> sample name such as 'C#4', including the input key's octave offset
+note_names = {}
+
+# Format, duration and loudness per sample path, persisted in Main.library_manifest_file
+manifest = None
+_manifest_dirty = False
+_manifest_lock = threading.Lock()
+
+loudness_outlier_db = 12  # samples this far from their instrument's median level are reported
+
+def note_name(key, octave, input_key):
+    """Return the name of the sample an input key plays in a key and octave."""
+    table_key = (key, octave, input_key)
+    name = note_names.get(table_key)
+    if name is None:
+        played_octave = octave + Main.input_octaves.get(input_key, 0)
+        transposed_note, adjusted_octave = Helpers.transpose_note(Main.input_to_note[input_key], key, played_octave)
+        name = f"{transposed_note}{adjusted_octave}"
+        note_names[table_key] = name
+    return name
+
+def index_folder(folder):
+    """List one instrument folder and record its samples, preferring formats in Samples.sample_extensions order."""
+    import Samples
+    by_name = {}
+    for sound_file in os.listdir(folder):
+        name, extension = os.path.splitext(sound_file)
+        extension = extension.lower()
+        if extension not in Samples.sample_extensions:
+            continue
+        if extension in Samples.compressed_extensions and Samples.soundfile is None:
+            continue
+        current = by_name.get(name)
+        rank = Samples.sample_extensions.index(extension)
+        if current is None or rank < current[0]:
+            by_name[name] = (rank, os.path.join(folder, sound_file))
+
+    samples = {name: path for name, (_, path) in by_name.items()}
+    notes = {}
+    for name, path in samples.items():
+        parsed = Helpers.parse_note_name(name)
+        if parsed:
+            notes[Helpers.note_number(*parsed)] = path
+    instruments[folder] = {'samples': samples, 'notes': notes}
+
+    # Precompute every note the harp can ask this instrument for
+    for key in Main.keys:
+        for octave in Main.octave_range:
+            for input_key in Main.input_to_note:
+                resolution[(folder, key, octave, input_key)] = resolve_name(folder, note_name(key, octave, input_key))
+
+def index():
+    """Scan every instrument folder and build the resolution table."""
+    instruments.clear()
+    resolution.clear()
+    for instrument in Helpers.scan_instrument_folders():
+        index_folder(os.path.join(Main.base_folder, instrument))
+    return instruments
+
+def remove_folder(folder):
+    """Forget an instrument folder that no longer exists."""
+    instruments.pop(folder, None)
+    for table_key in [table_key for table_key in resolution if table_key[0] == folder]:
+        del resolution[table_key]
+
+def resolve_name(folder, name):
+    """Resolve a sample name in an indexed folder, falling back to a derived note like Samples.resolve_sample."""
+    import Samples
+    entry = instruments.get(folder)
+    if entry is None:
+        return Samples.resolve_sample(folder, name)
+    path = entry['samples'].get(name)
+    if path or not Main.derive_missing_notes or Helpers.parse_note_name(name) is None or not entry['notes']:
+        return path
+    return os.path.join(folder, name + Samples.derived_extension)
+
+def resolve(folder, key, octave, input_key):
+    """Return the sample an input key plays for an instrument, key and octave."""
+    table_key = (folder, key, octave, input_key)
+    if table_key in resolution:
+        return resolution[table_key]
+    return resolve_name(folder, note_name(key, octave, input_key))
+
+def recorded_notes(folder):
+    """Return the note numbers and paths recorded in an indexed folder, or None if it is not indexed."""
+    entry = instruments.get(folder)
+    return entry['notes'] if entry else None
+
+def missing_notes(folder):
+    """List the notes in the octave range an instrument has no recording of."""
+    entry = instruments[folder]
+    return [
+        f"{note}{octave}" for octave in Main.octave_range for note in Main.keys
+        if f"{note}{octave}" not in entry['samples']
+    ]
+
+def load_manifest():
+    """Load the library manifest from disk the first time it is needed."""
+    global manifest
+    if manifest is None:
+        manifest = {}
+        if os.path.exists(Main.library_manifest_file):
+            try:
+                with open(Main.library_manifest_file) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Could not read library manifest {Main.library_manifest_file}: {e}")
+    return manifest
+
+def save_manifest():
+    """Write the library manifest to disk if new samples were analysed."""
+    global _manifest_dirty
+    with _manifest_lock:
+        if not _manifest_dirty:
+            return
+        try:
+            with open(Main.library_manifest_file, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            _manifest_dirty = False
+        except OSError as e:
+            print(f"Could not save library manifest {Main.library_manifest_file}: {e}")
+
+def analyse_sample(path):
+    """Return a sample's manifest entry, decoding it only if it changed since it was last analysed."""
+    global _manifest_dirty
+    import numpy as np
+    import Samples
+    stat = os.stat(path)
+    with _manifest_lock:
+        entry = load_manifest().get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry
+
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    try:
+        frames, source_format = Samples.read_sample(path)
+        peak = float(np.max(np.abs(frames))) if len(frames) else 0.0
+        rms = float(np.sqrt(np.mean(np.square(frames)))) if len(frames) else 0.0
+        entry.update(
+            format=list(source_format),
+            duration=len(frames) / source_format[0],
+            peak_db=float(20 * np.log10(max(peak, 1e-6))),
+            rms_db=float(20 * np.log10(max(rms, 1e-6)))
+        )
+    except Exception as e:
+        entry['error'] = str(e)
+    with _manifest_lock:
+        manifest[path] = entry
+        _manifest_dirty = True
+    return entry
+
+def analyse(folders=None):
+    """Record the format, duration and loudness of every indexed sample."""
+    for folder in folders or list(instruments):
+        for path in instruments[folder]['samples'].values():
+            analyse_sample(path)
+    save_manifest()
+
+def problems(folder):
+    """List the issues found in an analysed instrument folder."""
+    issues = []
+    missing = missing_notes(folder)
+    if missing:
+        action = "derived by pitch shifting" if Main.derive_missing_notes and instruments[folder]['notes'] else "silent"
+        issues.append(f"{len(missing)} missing note(s), {action}: {' '.join(missing)}")
+
+    entries = {path: load_manifest().get(path, {}) for path in instruments[folder]['samples'].values()}
+    for path, entry in sorted(entries.items()):
+        if 'error' in entry:
+            issues.append(f"{os.path.basename(path)} cannot be read: {entry['error']}")
+    levels = sorted(entry['rms_db'] for entry in entries.values() if 'rms_db' in entry)
+    if levels:
+        median = levels[len(levels) // 2]
+        for path, entry in sorted(entries.items()):
+            if 'rms_db' in entry and abs(entry['rms_db'] - median) > loudness_outlier_db:
+                issues.append(f"{os.path.basename(path)} is {entry['rms_db'] - median:+.1f} dB from the instrument's median level")
+    formats = {tuple(entry['format']) for entry in entries.values() if 'format' in entry}
+    if len(formats) > 1:
+        import Samples
+        issues.append("mixed formats: " + ", ".join(Samples.describe_format(f) for f in sorted(formats)))
+    return issues
+
+def report(detail=False):
+    """Describe the library, listing only the instruments with problems unless detail is set."""
+    lines = []
+    for folder in sorted(instruments):
+        issues = problems(folder)
+        if not issues and not detail:
+            continue
+        entries = [load_manifest().get(path, {}) for path in instruments[folder]['samples'].values()]
+        durations = [entry['duration'] for entry in entries if 'duration' in entry]
+        summary = f"{os.path.basename(folder)}: {len(entries)} sample(s)"
+        if durations:
+            summary += f", {min(durations):.1f}-{max(durations):.1f} s"
+        lines.append(summary)
+        lines.extend(f"  {issue}" for issue in issues)
+    return "\n".join(lines) if lines else "Sample library: no problems found."
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index and check the sample library")
+    parser.add_argument('--detail', action='store_true', help="describe every instrument, not only those with problems")
+    args = parser.parse_args()
+    index()
+    analyse()
+    print(report(args.detail))
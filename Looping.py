@@ -2,31 +2,64 @@
 
 import Main
 import Audio
+import Consolidation
+import Effects
+import Engine
 import Helpers
+import Layout
+import Phrases
+import Recording
+import Telemetry
 import pygame
 import time
 import os
 
 def key_press(event):
-    """Handle key press events."""
+    """Handle key press events; beam sensors may add a velocity between 0.0 and 1.0 to the event."""
+    if Main.mixer_tuning:
+        # The mixer is being reopened by the buffer tuning
+        return
+    velocity = getattr(event, 'velocity', None)
+    if velocity is None:
+        velocity = Main.default_velocity
+    Recording.record('key_press', event.keysym, event.char, velocity)
     keysym = event.keysym
     key = event.char.upper()  # Ensure key is uppercase
-    current_time = time.time()
+    # A replay keeps the recorded spacing, however fast it runs
+    current_time = time.time() if Recording.replay_time is None else Recording.replay_time
 
     if keysym == 'Shift_L':
         handle_shift('left', current_time)
     elif keysym == 'Shift_R':
         handle_shift('right', current_time)
     elif key in Main.input_to_note:
-        octave = Main.current_octave
-        if key == '=':
-            octave += 1
-        # Pass the current instrument to get a unique note_id
-        unique_note_id = Helpers.get_note_identifier(key, octave, Main.current_folder)
+        Main.key_velocity[key] = min(max(float(velocity), 0.0), 1.0)
+        # The dispatch table holds each beam's note id for the current key, octave and instrument
+        unique_note_id = Layout.note_id(key)
         if Main.loop_mode:
             handle_loop_mode(unique_note_id, key)
         else:
-            handle_normal_key_press(unique_note_id, key, octave)
+            handle_normal_key_press(unique_note_id, key, Main.current_octave)
+
+def key_gain(key):
+    """Return the gain of the voices a key plays."""
+    return Helpers.velocity_gain(Main.key_velocity.get(key, Main.default_velocity))
+
+def play_voice(sound, gain=1.0, fade_ms=0, channel=None):
+    """Play a sound at a per-voice gain on the given or a free channel, returning the channel.
+
+    The gain is applied to the channel, so one Sound serves every velocity.
+    """
+    if channel is None:
+        channel = pygame.mixer.find_channel()
+    if channel is None:
+        Telemetry.note_dropped()
+        return None
+    # A fade-in ramps to the volume the channel has when it starts, so set it first
+    with Effects.bus_lock:
+        channel.set_volume(gain * Effects.bus_gain)
+        channel.play(sound, fade_ms=fade_ms)
+    return channel
 
 def handle_shift(direction, current_time):
     """Handle octave changes with shift keys."""
@@ -49,11 +82,15 @@ def handle_shift(direction, current_time):
             else:
                 print("Cannot increase octave further.")
 
+def activate_loop_mode():
+    """Loop the next note that is played."""
+    Main.loop_mode = True
+
 def handle_loop_mode(note_id, key):
     """Handle looping mode key presses."""
     if note_id in Main.looping_notes:
         # Note is already looping, stop looping it
-        stop_looping_note_by_key(note_id, key, Main.current_octave)
+        stop_looping_note_by_key(note_id, key, Main.current_octave, Main.current_folder, Main.sustain_option)
     else:
         # Check if max loops reached
         if len(Main.looping_notes) >= Main.max_loops:
@@ -72,32 +109,44 @@ def handle_normal_key_press(note_id, key, octave):
 
     matching_note_id = find_matching_looping_note_id(key, octave, instrument, sustain_option)
     if matching_note_id:
-        stop_looping_note_by_key(matching_note_id, key, octave)
+        stop_looping_note_by_key(matching_note_id, key, octave, instrument, sustain_option)
     else:
         if not Main.key_status.get(key, False):
             Main.key_status[key] = True
-            if Main.sustain_option:
+            velocity = Main.key_velocity.get(key, Main.default_velocity)
+            Phrases.note_on(key, Main.sound_objects[key], Helpers.velocity_gain(velocity),
+                            Helpers.velocity_fade_in(velocity), Main.sustain_option)
+            if Main.sustain_option and Engine.running():
+                # The engine plays the attack and retriggers the sustain itself
+                Engine.start_sustain(key, Main.sound_objects[key], Main.sustain_lengths[key],
+                                     Helpers.velocity_gain(velocity), Helpers.velocity_fade_in(velocity))
+            elif Main.sustain_option:
                 # Play attack sound, then schedule sustain playback
                 sounds = Main.sound_objects[key]
-                sounds['attack'].play()
+                play_voice(sounds['attack'], Helpers.velocity_gain(velocity), Helpers.velocity_fade_in(velocity))
                 attack_length = int(sounds['attack'].get_length() * 1000)
-                Main.root.after(attack_length, lambda: schedule_sustain_play(key))
+                Helpers.after(attack_length, lambda: schedule_sustain_play(key))
             else:
                 # Play the original sound once
                 sounds = Main.sound_objects[key]
-                sounds['original'].play()
+                if Engine.running():
+                    Engine.play(sounds['original'], Helpers.velocity_gain(velocity), Helpers.velocity_fade_in(velocity))
+                else:
+                    play_voice(sounds['original'], Helpers.velocity_gain(velocity), Helpers.velocity_fade_in(velocity))
 
 def key_release(event):
     """Handle key release events."""
-    key = event.char
+    if Main.mixer_tuning:
+        return
+    Recording.record('key_release', event.keysym, event.char)
+    key = event.char.upper()
     keysym = event.keysym
 
     if key in Main.input_to_note:
         if key in Main.key_status:
             Main.key_status[key] = False
+            Phrases.note_off(key)
             octave = Main.current_octave
-            if key == '=':
-                octave += 1
             instrument = Main.current_folder  # Current instrument folder
             sustain_option = Main.sustain_option  # Current sustain setting
 
@@ -105,13 +154,15 @@ def key_release(event):
             matching_note_id = find_matching_looping_note_id(key, octave, instrument, sustain_option)
             if matching_note_id:
                 pass
+            elif Engine.running():
+                Engine.stop_sustain(key)
             else:
                 # Cancel scheduled sustain plays
                 if key in Main.scheduled_tasks:
                     Main.root.after_cancel(Main.scheduled_tasks[key])
                     del Main.scheduled_tasks[key]
                 # Schedule to stop the sustain sound after sustain_interval
-                task_id = Main.root.after(Main.sustain_interval, lambda: stop_sustain_sound(key))
+                task_id = Helpers.after(Main.sustain_interval, lambda: stop_sustain_sound(key))
                 Main.scheduled_tasks[key] = task_id
 
 def schedule_sustain_play(key):
@@ -124,11 +175,11 @@ def schedule_sustain_play(key):
         interval = int(sustain_length / Main.max_overlaps)
 
         # Schedule the next sustain play
-        task_id = Main.root.after(interval, lambda: schedule_sustain_play(key))
+        task_id = Helpers.after(interval, lambda: schedule_sustain_play(key))
         Main.scheduled_tasks[key] = task_id
     else:
         # If the key is no longer pressed, schedule to stop the sustain sound
-        task_id = Main.root.after(Main.sustain_interval, lambda: stop_sustain_sound(key))
+        task_id = Helpers.after(Main.sustain_interval, lambda: stop_sustain_sound(key))
         Main.scheduled_tasks[key] = task_id
 
 def play_sustain_sound(key):
@@ -136,9 +187,8 @@ def play_sustain_sound(key):
     sounds = Main.sound_objects[key]
     sustain_sound = sounds['sustain']
     # Play sustain sound without looping
-    channel = pygame.mixer.find_channel()
+    channel = play_voice(sustain_sound, key_gain(key))
     if channel:
-        channel.play(sustain_sound)
         # Store the channel
         if key not in Main.active_sustain_channels:
             Main.active_sustain_channels[key] = []
@@ -158,14 +208,19 @@ def stop_sustain_sound(key):
     if key in Main.scheduled_tasks:
         del Main.scheduled_tasks[key]
 
-def start_looping_note(note_id, key):
-    """Start looping a note and assign it to an available slot."""
-    # Find an available slot
+def start_looping_note(note_id, key, state=None):
+    """Start looping a note and assign it to an available slot.
+
+    state holds saved note settings, such as locks, for a loop restored from a session.
+    """
+    # Find an available slot, preferring the one a restored loop was in
     try:
         slot_index = Main.looping_note_slots.index(None)
     except ValueError:
         print("No available looping note slots.")
         return
+    if state and state.get('slot') in range(Main.max_loops) and Main.looping_note_slots[state['slot']] is None:
+        slot_index = state['slot']
 
     # Set up note information, including an available channel for playback
     note_info = {
@@ -182,7 +237,11 @@ def start_looping_note(note_id, key):
         'created_instrument': Main.current_folder,
         'active_channels': [],
         'channel': pygame.mixer.find_channel(),
+        'velocity': Main.key_velocity.get(key, Main.default_velocity),
     }
+    if state:
+        note_info.update(state)
+        note_info['slot'] = slot_index
 
     # Add note_info to looping notes
     Main.looping_notes[note_id] = note_info
@@ -191,26 +250,82 @@ def start_looping_note(note_id, key):
     Audio.preload_sound_for_looping_note(note_id, key, instrument=Main.current_folder)
 
     # Schedule sustain or normal loop playback
-    if Main.sustain_option:
-        task_id = Main.root.after(0, lambda: schedule_loop_sustain_play(key, note_id))
+    if Engine.running():
+        Engine.start_loop(note_info)
+        task_id = None
+    elif note_info['sustain_option']:
+        task_id = Helpers.after(0, lambda: schedule_loop_sustain_play(key, note_id))
     else:
-        task_id = Main.root.after(0, lambda: schedule_normal_loop_play(key, note_id))
+        task_id = Helpers.after(0, lambda: schedule_normal_loop_play(key, note_id))
     note_info['task_id'] = task_id
     Main.looping_note_slots[slot_index] = note_id
+    Consolidation.loop_changed()
 
     # Update the GUI to reflect the new looping note
     if Main.advanced_menu_window and Main.advanced_menu_window.winfo_exists():
         Main.advanced_menu_window.event_generate('<<UpdateLoopingNotesDisplay>>', when='tail')
 
+def start_phrase_loop(note_id, sound, note_count):
+    """Loop a rendered phrase as a single voice in a free slot."""
+    try:
+        slot_index = Main.looping_note_slots.index(None)
+    except ValueError:
+        print("No available looping note slots.")
+        return
+
+    # A phrase plays like a normal loop of one sound; it has no key or locks to follow
+    note_info = {
+        'key': None,
+        'slot': slot_index,
+        'phrase': note_count,
+        'octave_locked': False,
+        'locked_octave': Main.current_octave,
+        'sustain_option': False,
+        'key_locked': False,
+        'locked_key': None,
+        'instrument_locked': False,
+        'locked_instrument': None,
+        'created_octave': Main.current_octave,
+        'created_instrument': Main.current_folder,
+        'active_channels': [],
+        'channel': pygame.mixer.find_channel(),
+        'velocity': 1.0,  # Note velocities are already mixed into the phrase
+        'sounds': {'original': sound, 'loop': sound},
+        'sustain_length': 0,
+    }
+    Main.looping_notes[note_id] = note_info
+
+    if Engine.running():
+        Engine.start_loop(note_info)
+        task_id = None
+    else:
+        task_id = Helpers.after(0, lambda: schedule_normal_loop_play(None, note_id))
+    note_info['task_id'] = task_id
+    Main.looping_note_slots[slot_index] = note_id
+    Consolidation.loop_changed()
+
+    # Update the GUI to reflect the new looping phrase
+    if Main.advanced_menu_window and Main.advanced_menu_window.winfo_exists():
+        Main.advanced_menu_window.event_generate('<<UpdateLoopingNotesDisplay>>', when='tail')
+
 def schedule_normal_loop_play(key, note_id):
     """Schedule the next playback of the original sound for normal looping."""
     if note_id in Main.looping_notes:
         note_info = Main.looping_notes[note_id]
+        if note_info.get('consolidated'):
+            # The summed loop buffer plays this note now
+            return
         sounds = note_info['sounds']
-        channel = note_info['channel']
-        channel.play(sounds['original'])
-        sound_length = int(sounds['original'].get_length() * 1000)
-        task_id = Main.root.after(sound_length, lambda: schedule_normal_loop_play(key, note_id))
+        # The note may have started while every channel was busy
+        if note_info['channel'] is None:
+            note_info['channel'] = pygame.mixer.find_channel()
+        if note_info['channel']:
+            play_voice(sounds['loop'], Helpers.velocity_gain(note_info['velocity']), channel=note_info['channel'])
+            note_info['last_play'] = time.perf_counter()
+        else:
+            Telemetry.note_dropped()
+        sound_length = int(sounds['loop'].get_length() * 1000)
+        task_id = Helpers.after(sound_length, lambda: schedule_normal_loop_play(key, note_id))
         note_info['task_id'] = task_id
     else:
         # If the note is no longer looping, do nothing
@@ -227,16 +342,15 @@ def schedule_loop_sustain_play(key, note_id):
         interval = int(sustain_length / Main.max_overlaps)
 
         # Schedule the next sustain play
-        task_id = Main.root.after(interval, lambda: schedule_loop_sustain_play(key, note_id))
+        task_id = Helpers.after(interval, lambda: schedule_loop_sustain_play(key, note_id))
         note_info['task_id'] = task_id
 
 def play_sustain_sound_loop(note_info):
     """Play the sustain sound for a looping note."""
     sustain_sound = note_info['sounds']['sustain']
     # Play sustain sound without looping
-    channel = pygame.mixer.find_channel()
+    channel = play_voice(sustain_sound, Helpers.velocity_gain(note_info['velocity']))
     if channel:
-        channel.play(sustain_sound)
         # Store the channel
         note_info['active_channels'].append(channel)
 
@@ -270,6 +384,10 @@ def stop_looping_note(note_id):
 
         if task_id:
             Main.root.after_cancel(task_id)
+        if Engine.running():
+            Engine.stop_loop(note_info)
+        if note_id in Consolidation.group:
+            Consolidation.release(note_id, restart=False)
 
         if channel:
             if Main.fade_out_duration > 0:
@@ -291,6 +409,7 @@ def stop_looping_note(note_id):
 
         # Free the slot
         Main.looping_note_slots[slot_index] = None
+        Consolidation.loop_changed()
 
         # Update the GUI display
         if Main.advanced_menu_window and Main.advanced_menu_window.winfo_exists():
@@ -417,9 +536,11 @@ def toggle_instrument_lock(slot_index):
         note_info['instrument_locked'] = not note_info.get('instrument_locked', False)
         if note_info['instrument_locked']:
             note_info['locked_instrument'] = Main.current_folder
+            note_info['locked_layers'] = [dict(layer) for layer in Main.instrument_layers]
             print(f"Instrument locked for note {note_id} at instrument {os.path.basename(note_info['locked_instrument'])}")
         else:
             note_info['locked_instrument'] = None
+            note_info['locked_layers'] = None
             print(f"Instrument unlocked for note {note_id}")
         # Reload sound with the locked or current instrument
         Audio.preload_sound_for_looping_note(note_id, note_info['key'], note_info['locked_instrument'] if note_info['instrument_locked'] else Main.current_folder)
@@ -433,6 +554,7 @@ def lock_all_instruments():
         if not note_info.get('instrument_locked', False):
             note_info['instrument_locked'] = True
             note_info['locked_instrument'] = Main.current_folder
+            note_info['locked_layers'] = [dict(layer) for layer in Main.instrument_layers]
             Audio.preload_sound_for_looping_note(note_id, note_info['key'], instrument=note_info['locked_instrument'])
 
     # Update GUI display to reflect locking status
@@ -445,6 +567,7 @@ def unlock_all_instruments():
     for note_id, note_info in Main.looping_notes.items():
         note_info['instrument_locked'] = False
         note_info['locked_instrument'] = None
+        note_info['locked_layers'] = None
         Audio.preload_sound_for_looping_note(note_id, note_info['key'], instrument=note_info['created_instrument'])
 
     # Immediate GUI update
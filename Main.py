@@ -1,13 +1,11 @@
-# dependencies: pip install pygame pydub
+# dependencies: pip install pygame pydub numpy
+# optional: pip install soundfile (FLAC/Ogg instrument folders)
 
 # Main.py
 
-import pygame
 import os
-import Gui
-
-# Initialize Pygame mixer
-pygame.mixer.init()
+import sys
+import tempfile
 
 # Global Variables
 running = False
@@ -15,14 +13,43 @@ running = False
 # Paths and Folders
 base_folder = "Sound Samples/"
 current_folder = os.path.join(base_folder, "Harp")
-instrument_folders = [
-    f for f in os.listdir(base_folder) if os.path.isdir(os.path.join(base_folder, f))
-]
+instrument_folders = []  # Filled by Helpers.scan_instrument_folders() at startup
+# Extra instruments every key also plays, pre-mixed into one sound per note:
+#   [{'instrument': "Vibraphone", 'gain': 0.6, 'octave_offset': 0}]
+instrument_layers = []
+library_manifest_file = "library.json"  # Sample formats, durations and loudness (see Library.py)
+watch_samples = True      # Reload samples that change on disk while running (see Watcher.py)
+watch_poll_interval = 1.0  # seconds between folder scans where inotify is unavailable
+banks_folder = "banks"    # Sound banks processed ahead of time by Build.py
+use_prebuilt_banks = True # Take sounds from a matching bank instead of processing the samples
+shared_pool = False       # Share processed sounds with other harp instances on this machine (see Pool.py)
+shared_pool_mb = 256      # Most shared memory the pool's blocks may take
+pool_registry_file = os.path.join(tempfile.gettempdir(), "laser-harp-pool.json")
+
+# Settings persisted between runs (see Settings.py)
+settings_file = "settings.json"
 
 # Audio Settings
 volume = 0.5
 sound_objects = {}
 sustain_lengths = {}
+sound_paths = {}          # Sample path each input key currently plays
+layer_sound_paths = {}    # Sample paths of the instrument layers mixed into each input key
+sample_cache = {}         # Processed sounds keyed by sample path and envelope settings
+normalized_cache_mb = 64  # Float copies of samples kept for reprocessing; least recently used go first
+
+# Compact Memory Mode for low-RAM hosts
+compact_memory = False    # Mono 16-bit sounds, with no float copies of the samples kept
+compact_frequency = None  # e.g. 22050 to also lower the sample rate in compact mode; None keeps mixer_frequency
+
+# Mixer Settings
+num_channels = 64
+mixer_frequency = 44100
+mixer_buffer = 512        # frames per audio callback
+low_latency_mode = False  # Tune the mixer buffer down to the smallest size this machine sustains
+output_latency_ms = None  # Latency measured by the last buffer tuning, if any
+mixer_tuning = False      # The buffer is being tuned on a worker thread; nothing else may use the mixer
+audio_engine = "inline"   # "inline" plays on the Tk thread; "process" moves playback into Engine.py
 
 # Key Mappings and Notes
 input_to_note = {
@@ -40,13 +67,39 @@ input_to_note = {
     '-': "B",
     '=': "C"
 }
+input_octaves = {'=': 1}  # Input keys that play above the current octave
+layout = None             # Beam layout file in layouts_folder; None keeps the keyboard layout above (see Layout.py)
+layouts_folder = "layouts"
 keys = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
 current_key = "C"
 
 # Octave Settings
-octave_range = [2, 3, 4, 5]
+octave_range = [1, 2, 3, 4, 5, 6]  # Notes outside the recorded octaves are derived by pitch shifting
 current_octave = 3
 
+# Silence Trimming
+trim_silence = True       # Cut leading silence and silent tails so attack/sustain split at the real onset
+onset_manifest_file = "onsets.json"
+
+# Pitch Shifting
+derive_missing_notes = True   # Fill in missing notes by resampling the nearest recorded note
+pitch_shift_quality = "high"  # "fast" (linear interpolation) or "high" (band-limited FFT)
+pitch_shift_qualities = ["fast", "high"]
+
+# Master Effects (see Effects.py)
+effects_enabled = False
+reverb_impulse_file = None     # WAV/FLAC impulse response; None uses a synthetic room
+reverb_time = 1.8              # seconds for the synthetic room to decay by 60 dB
+reverb_mix = 0.3               # 0 turns the reverb off
+delay_ms = 0                   # 0 turns the delay off
+delay_feedback = 0.35
+delay_mix = 0.25
+limiter_threshold_db = -1.0
+limiter_release_ms = 80
+effects_block = 1024           # frames per processing block
+effects_cpu_budget = 0.5       # share of a sample's duration its render may take before it plays dry
+bus_limiter_interval_ms = 10    # how often the summed level of the playing voices is checked
+
 # Sustain and Overlap Settings
 fade_in_duration = 500    # milliseconds
 fade_out_duration = 500   # milliseconds
@@ -55,12 +108,39 @@ sustain_interval = 1000   # milliseconds
 sustain_option = False
 max_overlaps = 10
 
+# Velocity: how hard or high a beam is broken, from 0.0 to 1.0
+default_velocity = 1.0           # Used for keyboard input, which has no velocity
+velocity_curve = 2.0             # Per-voice gain is velocity ** velocity_curve
+velocity_shapes_attack = False   # Give quieter notes a softer attack
+velocity_attack_ms = 40          # Fade-in of the quietest notes when velocity shapes the attack
+key_velocity = {}                # Velocity each key was last pressed with, for its sustain and loops
+
 # Looping Notes Settings
 loop_mode = False         # Indicates if loop mode is active
 max_loops = 15             # Maximum number of looping notes
 looping_notes = {}
 looping_note_slots = [None] * max_loops  # Initialize slots based on max_loops
 
+# Loop Consolidation (see Consolidation.py)
+consolidate_loops = False      # Pre-mix normal loops into one summed buffer on a single voice
+consolidation_settle_ms = 2000 # How long the loop set must stay unchanged before loops are merged
+consolidation_grid_ms = 10     # Loop periods are rounded to this grid when finding a common period
+consolidation_max_ms = 16000   # Longest summed buffer; loops whose common period is longer play on their own
+
+# Telemetry: 'unix:<path>' or 'tcp:<host>:<port>' to publish runtime metrics (see Telemetry.py)
+telemetry_address = None
+
+# Performance Recording (see Recording.py)
+recordings_folder = "recordings"
+
+# Session Snapshot (see Session.py)
+session_folder = "session"
+session_save_interval_ms = 1000  # How often the session is checked for changes and saved
+
+# Profiling (see Profiler.py)
+profiles_folder = "profiles"
+profile_sample_interval_ms = 5   # How often the sampling thread records every thread's stack
+
 # GUI and Event Handling
 root = None
 advanced_menu_window = None  # Reference to the advanced menu window
@@ -88,4 +168,5 @@ DEBOUNCE_TIME = 0.1  # 100ms
 last_press_time = {}
 
 if __name__ == "__main__":
-    Gui.main_menu()
\ No newline at end of file
+    import Startup
+    Startup.run(sys.argv[1:])
@@ -0,0 +1,112 @@
+# Memory.py
+
+import os
+import pygame
+import Main
+import Pool
+import Samples
+
+# Highest total seen by usage(), in bytes
+peak_bytes = 0
+
+def sound_bytes(sound):
+    """Return the size of a pygame Sound's sample buffer without copying it."""
+    return pygame.sndarray.samples(sound).nbytes
+
+def split_path(path):
+    """Return the instrument and note name a sample path belongs to."""
+    folder, sound_file = os.path.split(path)
+    return os.path.basename(folder), os.path.splitext(sound_file)[0]
+
+def usage():
+    """Account for the memory held by loaded sounds, per instrument, note and variant.
+
+    Buffers shared between the cache, the live keys and looping notes are counted once in
+    the total; 'live_keys' and 'looping_notes' report what each of those holds on to.
+    """
+    global peak_bytes
+    instruments = {}
+    counted = set()
+    total = 0
+
+    def add(path, variant, size):
+        instrument, note = split_path(path)
+        instrument_usage = instruments.setdefault(instrument, {'total': 0, 'notes': {}})
+        note_usage = instrument_usage['notes'].setdefault(note, {})
+        note_usage[variant] = note_usage.get(variant, 0) + size
+        instrument_usage['total'] += size
+
+    # Processed pygame sounds
+    for cache_key, sounds in list(Main.sample_cache.items()):
+        for variant, sound in sounds.items():
+            if id(sound) in counted:
+                continue
+            counted.add(id(sound))
+            size = sound_bytes(sound)
+            add(cache_key[0], variant, size)
+            total += size
+
+    # Normalized float frames kept for reprocessing
+    for cache_key, frames in list(Samples.sample_cache.items()):
+        add(cache_key[0], 'normalized', frames.nbytes)
+        total += frames.nbytes
+
+    # Sounds held outside the cache, e.g. after it was cleared
+    live_keys = 0
+    for sounds in Main.sound_objects.values():
+        for sound in sounds.values():
+            size = sound_bytes(sound)
+            live_keys += size
+            if id(sound) not in counted:
+                counted.add(id(sound))
+                total += size
+
+    looping_notes = {}
+    for note_id, note_info in list(Main.looping_notes.items()):
+        looping_notes[note_id] = 0
+        for sound in note_info.get('sounds', {}).values():
+            size = sound_bytes(sound)
+            looping_notes[note_id] += size
+            if id(sound) not in counted:
+                counted.add(id(sound))
+                total += size
+
+    peak_bytes = max(peak_bytes, total)
+    return {
+        'total': total,
+        'peak': peak_bytes,
+        'instruments': instruments,
+        'live_keys': live_keys,
+        'looping_notes': looping_notes
+    }
+
+def update_peak():
+    """Refresh the peak after the loaded sounds changed."""
+    usage()
+
+def format_bytes(size):
+    """Format a byte count in megabytes."""
+    return f"{size / 2 ** 20:.1f} MB"
+
+def report(detail=False):
+    """Describe memory usage as text, optionally with a line per note."""
+    current = usage()
+    lines = [
+        f"Total: {format_bytes(current['total'])} (peak {format_bytes(current['peak'])})",
+        f"Live keys: {format_bytes(current['live_keys'])}",
+        f"Looping notes: {format_bytes(sum(current['looping_notes'].values()))} in {len(current['looping_notes'])} note(s)"
+    ]
+    if Pool.enabled():
+        # The blocks are an extra copy the Sounds above do not share
+        lines.append(f"Shared pool: {format_bytes(Pool.size())} in /dev/shm (limit {Main.shared_pool_mb} MB)")
+    for instrument, instrument_usage in sorted(current['instruments'].items()):
+        variants = {}
+        for note_usage in instrument_usage['notes'].values():
+            for variant, size in note_usage.items():
+                variants[variant] = variants.get(variant, 0) + size
+        variant_text = ", ".join(f"{variant} {format_bytes(size)}" for variant, size in sorted(variants.items()))
+        lines.append(f"{instrument}: {format_bytes(instrument_usage['total'])} ({variant_text})")
+        if detail:
+            for note, note_usage in sorted(instrument_usage['notes'].items()):
+                lines.append(f"  {note}: {format_bytes(sum(note_usage.values()))}")
+    return "\n".join(lines)
@@ -0,0 +1,134 @@
+# Phrases.py
+#
+# Records a phrase of live notes and renders it into a single sound that loops in one
+# slot, so a riff costs one voice and one timer instead of one per note. The phrase
+# lasts from start_phrase() to stop_phrase(); tails ringing past the end wrap around
+# to the start so the loop is seamless.
+
+import time
+import numpy as np
+import Main
+
+# Phrase Recording State
+recording = False
+_start_time = 0.0
+_events = []     # one dict per note played while recording
+_held = {}       # input key -> its event while the key is down
+_count = 0       # phrases rendered so far, for their ids
+
+def start_phrase():
+    """Start capturing the notes played on the live keys."""
+    global recording, _start_time
+    _events.clear()
+    _held.clear()
+    _start_time = time.perf_counter()
+    recording = True
+    print("Recording phrase...")
+
+def note_on(key, sounds, gain, fade_in, sustain):
+    """Capture a note that was just played, with the sounds and gain it was played at."""
+    if not recording:
+        return
+    event = {
+        'start': time.perf_counter() - _start_time,
+        'sounds': dict(sounds),
+        'gain': gain,
+        'fade_in': fade_in,
+        'sustain': sustain,
+        'sustain_length': Main.sustain_lengths.get(key, 0),
+        'release': None
+    }
+    _events.append(event)
+    _held[key] = event
+
+def note_off(key):
+    """Capture the release of a key."""
+    event = _held.pop(key, None)
+    if recording and event:
+        event['release'] = time.perf_counter() - _start_time
+
+def add_wrapped(mix, start, frames):
+    """Add frames into the loop buffer at start, wrapping anything past its end to the beginning."""
+    total = len(mix)
+    start %= total
+    while len(frames):
+        count = min(total - start, len(frames))
+        mix[start:start + count] += frames[:count]
+        frames = frames[count:]
+        start = 0
+
+def release_envelope(length, stop, fade_out):
+    """Return a gain that is 1 until stop, then falls to 0 over fade_out frames, like Channel.fadeout."""
+    positions = np.arange(length)
+    if fade_out <= 0:
+        return (positions < stop).astype(np.float32)
+    return np.clip(1 - (positions - stop) / fade_out, 0.0, 1.0).astype(np.float32)
+
+def render_event(mix, event, frequency, end):
+    """Mix one captured note into the loop buffer as the live key would have played it."""
+    import Samples
+    start = int(event['start'] * frequency)
+    fade_in = int(event['fade_in'] * frequency / 1000)
+
+    if not event['sustain']:
+        frames = Samples.sound_frames(event['sounds']['original']) * event['gain']
+        if fade_in:
+            frames[:fade_in] *= np.linspace(0, 1, min(fade_in, len(frames)), dtype=np.float32)[:, None]
+        add_wrapped(mix, start, frames)
+        return
+
+    # Attack, then sustain copies every sustain_length / max_overlaps until the release
+    # (plus Main.sustain_interval), when every copy still ringing fades out
+    release = event['release'] if event['release'] is not None else end
+    stop = int((release + Main.sustain_interval / 1000) * frequency)
+    fade_out = int(Main.fade_out_duration * frequency / 1000)
+    attack = Samples.sound_frames(event['sounds']['attack']) * event['gain']
+    if fade_in:
+        attack[:fade_in] *= np.linspace(0, 1, min(fade_in, len(attack)), dtype=np.float32)[:, None]
+    add_wrapped(mix, start, attack)
+
+    sustain = Samples.sound_frames(event['sounds']['sustain']) * event['gain']
+    interval = max(int(event['sustain_length'] / Main.max_overlaps * frequency / 1000), 1)
+    position = start + len(attack)
+    while position < stop:
+        envelope = release_envelope(len(sustain), stop - position, fade_out)
+        add_wrapped(mix, position, sustain * envelope[:, None])
+        position += interval
+
+def stop_phrase():
+    """Stop recording and loop the rendered phrase in a free slot; returns its note id."""
+    global recording, _count
+    import Looping
+    import Samples
+    if not recording:
+        return None
+    recording = False
+    length = time.perf_counter() - _start_time
+    if not _events:
+        print("Phrase is empty; nothing to loop.")
+        return None
+
+    frequency, _, channels = Samples.mixer_format()
+    mix = np.zeros((max(int(length * frequency), 1), channels), dtype=np.float32)
+    for event in _events:
+        render_event(mix, event, frequency, length)
+    # Scale down rather than clip if the notes add up past full scale
+    peak = float(np.max(np.abs(mix)))
+    if peak > 1.0:
+        mix /= peak
+
+    _count += 1
+    note_id = f"phrase{_count}"
+    sound = Samples.make_sound(mix)
+    sound.set_volume(Main.volume)
+    Looping.start_phrase_loop(note_id, sound, len(_events))
+    print(f"Looping phrase of {len(_events)} note(s), {length:.2f} s")
+    _events.clear()
+    return note_id
+
+def toggle_phrase():
+    """Start a phrase, or stop and loop the one being recorded."""
+    if recording:
+        stop_phrase()
+    else:
+        start_phrase()
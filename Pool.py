@@ -0,0 +1,214 @@
+# Pool.py
+#
+# Shares processed sounds between harp instances on one machine. With Main.shared_pool
+# on (--shared-pool), the first instance to process a sample publishes its attack,
+# sustain and original, in the mixer's format, as a shared memory block. Instances that
+# need the same sample later attach to that block and read it instead of decoding and
+# processing it. Blocks are named after the sample cache key, the mixer and envelope
+# settings and the source files' size and mtime, so instances with other settings never
+# pick up each other's sounds.
+#
+# pygame copies the samples of every Sound it makes, even from a buffer, so the Sounds
+# cannot play from the blocks: each instance still holds its own playing copy and the
+# blocks are one more copy in /dev/shm. The pool saves decoding and processing time, not
+# memory; Main.shared_pool_mb caps what the blocks may take.
+# The registry in Main.pool_registry_file counts the instances using the pool and the
+# size of each block; the last instance to leave unlinks every block. Instances that died
+# without leaving are not counted.
+
+import atexit
+import hashlib
+import json
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import Main
+
+try:
+    import fcntl  # Needed to lock the registry; the pool is unavailable without it
+except ImportError:
+    fcntl = None
+
+HEADER = struct.Struct('<III')  # ready flag, offset and length of the JSON part table after the samples
+ALIGNMENT = 16
+
+joined = False
+attached = 0   # sounds read from the pool
+published = 0  # sounds this instance added to it
+
+def enabled():
+    return Main.shared_pool and joined
+
+def block_name(cache_key):
+    """Return the shared memory block name of a sample cache entry for the running settings."""
+    import Audio
+    import Build
+    sources = [Build.source_of(path) for path in Audio.cache_key_paths(cache_key)]
+    description = json.dumps([
+        repr(cache_key), Build.bank_settings(),
+        [Build.source_stat(path) if path else None for path in sources]
+    ])
+    return "lhp-" + hashlib.sha1(description.encode()).hexdigest()[:24]
+
+def untrack(block):
+    """Keep Python from unlinking a block when this process exits; the registry does that."""
+    resource_tracker.unregister(block._name, 'shared_memory')
+
+def update_registry(change):
+    """Apply change(registry) to the registry under an exclusive lock and return the result."""
+    with open(Main.pool_registry_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            registry = json.loads(f.read() or "{}")
+        except ValueError:
+            registry = {}
+        registry.setdefault('instances', [])
+        registry.setdefault('blocks', {})  # block name -> bytes
+        registry['instances'] = [pid for pid in registry['instances'] if alive(pid)]
+        change(registry)
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(registry))
+        return registry
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def join():
+    """Start using the pool; returns the number of instances now using it."""
+    global joined
+    if fcntl is None:
+        print("The shared sample pool needs fcntl, which this platform does not have")
+        return 0
+    try:
+        registry = update_registry(lambda registry: registry['instances'].append(os.getpid()))
+    except OSError as e:
+        print(f"Could not join the shared sample pool at {Main.pool_registry_file}: {e}")
+        return 0
+    joined = True
+    atexit.register(leave)
+    print(f"Shared sample pool: {len(registry['instances'])} instance(s), {len(registry['blocks'])} sound(s)")
+    return len(registry['instances'])
+
+def leave():
+    """Stop using the pool, unlinking every block if no other instance is using it."""
+    global joined
+    if not joined:
+        return
+
+    def remove(registry):
+        registry['instances'] = [pid for pid in registry['instances'] if pid != os.getpid()]
+        if registry['instances']:
+            return
+        for name in registry['blocks']:
+            try:
+                block = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                continue
+            # unlink() also untracks the block
+            block.close()
+            block.unlink()
+        registry['blocks'] = {}
+
+    try:
+        update_registry(remove)
+    except OSError as e:
+        print(f"Could not leave the shared sample pool: {e}")
+    joined = False
+
+def load(cache_key):
+    """Return the sounds of a sample cache entry made from the pool, or None if it is not there."""
+    global attached
+    if not enabled():
+        return None
+    import pygame
+    import Audio
+    try:
+        block = shared_memory.SharedMemory(name=block_name(cache_key))
+    except (FileNotFoundError, OSError):
+        return None
+    untrack(block)
+    try:
+        ready, table_offset, table_length = HEADER.unpack_from(block.buf, 0)
+        # A block still being written is treated as missing
+        if not ready:
+            return None
+        table = json.loads(bytes(block.buf[table_offset:table_offset + table_length]))
+        parts = {}
+        try:
+            for part, (offset, shape, dtype) in table.items():
+                parts[part] = np.frombuffer(block.buf, np.dtype(dtype), int(np.prod(shape)), offset).reshape(shape)
+            result = Audio.make_sounds(parts, pygame.sndarray.make_sound)
+        finally:
+            # The Sounds hold copies; the views must go before the block can be closed
+            parts.clear()
+        attached += 1
+        return result
+    finally:
+        block.close()
+
+def size():
+    """Return the bytes the pool's blocks take in shared memory."""
+    if not enabled():
+        return 0
+    return sum(update_registry(lambda registry: None)['blocks'].values())
+
+def publish(cache_key, sounds):
+    """Add the sounds of a sample cache entry to the pool unless another instance already did."""
+    global published
+    if not enabled():
+        return
+    import pygame
+    # Dry sounds play the original as their loop
+    parts = {part: sound for part, sound in sounds.items() if part != 'loop' or sound is not sounds['original']}
+    arrays = {part: pygame.sndarray.samples(sound) for part, sound in parts.items()}
+
+    table = {}
+    offset = ALIGNMENT
+    for part, data in arrays.items():
+        table[part] = [offset, list(data.shape), data.dtype.str]
+        offset += -(-data.nbytes // ALIGNMENT) * ALIGNMENT
+    encoded = json.dumps(table).encode()
+
+    name = block_name(cache_key)
+    block_size = offset + len(encoded)
+    try:
+        block = shared_memory.SharedMemory(name=name, create=True, size=block_size)
+    except FileExistsError:
+        return
+    except OSError as e:
+        print(f"Could not add a sound to the shared sample pool: {e}")
+        return
+
+    def reserve(registry):
+        if sum(registry['blocks'].values()) + block_size <= Main.shared_pool_mb * 2 ** 20:
+            registry['blocks'][name] = block_size
+
+    try:
+        # Registered before it is written so a crash part way through cannot leak it
+        if name not in update_registry(reserve)['blocks']:
+            # The pool is full; this instance keeps its sounds to itself
+            block.unlink()
+            return
+        untrack(block)
+        for part, data in arrays.items():
+            target = np.ndarray(data.shape, data.dtype, buffer=block.buf, offset=table[part][0])
+            target[...] = data
+            del target
+        del arrays
+        block.buf[offset:offset + len(encoded)] = encoded
+        # Mark the block ready only after everything is written
+        HEADER.pack_into(block.buf, 0, 1, offset, len(encoded))
+        published += 1
+    except OSError as e:
+        print(f"Could not register a sound in the shared sample pool: {e}")
+    finally:
+        block.close()
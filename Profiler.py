@@ -0,0 +1,112 @@
+# Profiler.py
+#
+# On-demand profiling of the running harp. start() enables cProfile on the Tk thread
+# and a sampling thread that records every thread's stack every
+# Main.profile_sample_interval_ms; stop() writes, tagged with the instrument, loop count
+# and sustain mode:
+#   <name>.prof    per-function timings (python -m pstats <name>.prof)
+#   <name>.folded  collapsed stacks for flamegraph.pl or speedscope
+#   <name>.txt     the tags and the slowest functions by cumulative time
+# Nothing is hooked while the profiler is off.
+
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import Main
+
+active = False
+_profile = None
+_sampler = None
+_stop = threading.Event()
+_stacks = collections.Counter()  # collapsed stack -> samples
+_started_at = 0.0
+_start_tags = None
+
+def tags():
+    """Describe the state the harp is in, for naming and labelling a profile."""
+    return {
+        'instrument': os.path.basename(Main.current_folder) if Main.current_folder else "none",
+        'loops': len(Main.looping_notes),
+        'sustain': "sustain" if Main.sustain_option else "normal",
+    }
+
+def collapse(frame):
+    """Return a frame's stack as 'outermost;...;innermost' with one file:function entry per frame."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def sample(interval):
+    """Count the stack of every other thread until profiling stops."""
+    own = threading.get_ident()
+    while not _stop.wait(interval):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != own:
+                _stacks[f"{names.get(ident, ident)};{collapse(frame)}"] += 1
+
+def start():
+    """Start profiling the Tk thread and sampling every thread's stack."""
+    global active, _profile, _sampler, _started_at, _start_tags
+    if active:
+        return
+    _stacks.clear()
+    _stop.clear()
+    _start_tags = tags()
+    _started_at = time.time()
+    _profile = cProfile.Profile()
+    _profile.enable()
+    _sampler = threading.Thread(target=sample, args=(Main.profile_sample_interval_ms / 1000,), daemon=True)
+    _sampler.start()
+    active = True
+    print("Profiling started")
+
+def stop():
+    """Stop profiling and save the results; returns the path of the summary file."""
+    global active, _profile, _sampler
+    if not active:
+        return None
+    _profile.disable()
+    _stop.set()
+    _sampler.join()
+    active = False
+
+    os.makedirs(Main.profiles_folder, exist_ok=True)
+    name = "profile-{}-{}-{}loops-{}".format(
+        time.strftime("%Y%m%d-%H%M%S", time.localtime(_started_at)),
+        _start_tags['instrument'].replace(" ", "_"), _start_tags['loops'], _start_tags['sustain']
+    )
+    base = os.path.join(Main.profiles_folder, name)
+    _profile.dump_stats(base + ".prof")
+    with open(base + ".folded", 'w') as f:
+        for stack, count in sorted(_stacks.items()):
+            f.write(f"{stack} {count}\n")
+
+    summary = io.StringIO()
+    summary.write(f"Profiled {time.time() - _started_at:.1f} s from {time.ctime(_started_at)}\n")
+    summary.write(f"At start: {_start_tags}\n")
+    summary.write(f"At stop:  {tags()}\n")
+    summary.write(f"Stack samples: {sum(_stacks.values())} every {Main.profile_sample_interval_ms} ms\n\n")
+    pstats.Stats(_profile, stream=summary).sort_stats('cumulative').print_stats(40)
+    with open(base + ".txt", 'w') as f:
+        f.write(summary.getvalue())
+
+    _profile = None
+    _sampler = None
+    print(f"Profile saved to {base}.txt, .prof and .folded")
+    return base + ".txt"
+
+def toggle():
+    """Start profiling, or stop and save the running profile."""
+    if active:
+        stop()
+    else:
+        start()
@@ -0,0 +1,206 @@
+# Recording.py
+#
+# Performance logs are a header followed by one record per event:
+#   uint32 microseconds since the previous event, uint8 event code, uint8 payload length, payload
+# The payload is the event's arguments as UTF-8 text separated by NUL bytes.
+
+import os
+import struct
+import sys
+import time
+from types import SimpleNamespace
+import Main
+
+LOG_MAGIC = b"LHRP\x01"
+RECORD_HEADER = struct.Struct('<IBB')
+MAX_DELTA = 2 ** 32 - 1
+
+# Event codes, names and argument types; the codes are part of the file format
+EVENTS = [
+    (1, 'key_press', (str, str, float)), # keysym, char, velocity (absent in older logs)
+    (2, 'key_release', (str, str)),
+    (3, 'change_octave', (int,)),
+    (4, 'change_key', (str,)),
+    (5, 'choose_folder', (str,)),
+    (6, 'set_sustain_option', (int,)),
+    (7, 'adjust_volume', (float,)),
+    (8, 'activate_loop_mode', ()),
+    (9, 'stop_loop_by_slot', (int,)),
+    (10, 'stop_all_loops', ()),
+    (11, 'toggle_octave_lock', (int,)),
+    (12, 'toggle_key_lock', (int,)),
+    (13, 'toggle_instrument_lock', (int,)),
+    (14, 'lock_all_octaves', ()),
+    (15, 'unlock_all_octaves', ()),
+    (16, 'lock_all_keys', ()),
+    (17, 'unlock_all_keys', ()),
+    (18, 'lock_all_instruments', ()),
+    (19, 'unlock_all_instruments', ()),
+    (20, 'start_phrase', ()),
+    (21, 'stop_phrase', ()),
+]
+EVENT_CODES = {name: code for code, name, _ in EVENTS}
+EVENT_NAMES = {code: (name, types) for code, name, types in EVENTS}
+
+# Recording State
+active = False
+recording_path = None
+_log_file = None
+_last_event_time = 0.0
+replay_time = None  # Recorded time of the event being replayed, in place of the clock
+
+def handlers():
+    """Map event names to the handlers that live input and replay both go through."""
+    import Audio
+    import Looping
+    import Phrases
+    return {
+        'key_press': lambda keysym, char, velocity=None: Looping.key_press(SimpleNamespace(keysym=keysym, char=char, velocity=velocity)),
+        'key_release': lambda keysym, char: Looping.key_release(SimpleNamespace(keysym=keysym, char=char)),
+        'change_octave': Audio.change_octave,
+        'change_key': Audio.change_key,
+        'choose_folder': Audio.choose_folder,
+        'set_sustain_option': lambda enabled: Audio.set_sustain_option(bool(enabled)),
+        'adjust_volume': Audio.adjust_volume,
+        'activate_loop_mode': Looping.activate_loop_mode,
+        'stop_loop_by_slot': Looping.stop_loop_by_slot,
+        'stop_all_loops': Looping.stop_all_loops,
+        'toggle_octave_lock': Looping.toggle_octave_lock,
+        'toggle_key_lock': Looping.toggle_key_lock,
+        'toggle_instrument_lock': Looping.toggle_instrument_lock,
+        'lock_all_octaves': Looping.lock_all_octaves,
+        'unlock_all_octaves': Looping.unlock_all_octaves,
+        'lock_all_keys': Looping.lock_all_keys,
+        'unlock_all_keys': Looping.unlock_all_keys,
+        'lock_all_instruments': Looping.lock_all_instruments,
+        'unlock_all_instruments': Looping.unlock_all_instruments,
+        'start_phrase': Phrases.start_phrase,
+        'stop_phrase': Phrases.stop_phrase,
+    }
+
+def start_recording(path=None):
+    """Start logging every performance event to a binary file."""
+    global active, recording_path, _log_file, _last_event_time
+    if active:
+        stop_recording()
+    if path is None:
+        os.makedirs(Main.recordings_folder, exist_ok=True)
+        path = os.path.join(Main.recordings_folder, time.strftime("session-%Y%m%d-%H%M%S.lhr"))
+    _log_file = open(path, 'wb')
+    _log_file.write(LOG_MAGIC)
+    _last_event_time = time.perf_counter()
+    recording_path = path
+    active = True
+
+    # Start with the current settings so a replay begins from the same state
+    record('choose_folder', os.path.basename(Main.current_folder))
+    record('change_key', Main.current_key)
+    record('change_octave', Main.current_octave)
+    record('set_sustain_option', int(Main.sustain_option))
+    record('adjust_volume', Main.volume)
+    print(f"Recording performance to {path}")
+
+def stop_recording():
+    """Stop logging and close the log file."""
+    global active, _log_file
+    if not active:
+        return
+    active = False
+    _log_file.close()
+    _log_file = None
+    print(f"Recording saved to {recording_path}")
+
+def record(name, *args):
+    """Append one event to the log if a recording is running."""
+    global _last_event_time
+    if not active:
+        return
+    now = time.perf_counter()
+    delta = min(int((now - _last_event_time) * 1e6), MAX_DELTA)
+    _last_event_time = now
+    payload = "\0".join(str(arg) for arg in args).encode('utf-8')
+    # Cut on a character boundary so a long folder name cannot leave half a character
+    payload = payload[:255].decode('utf-8', 'ignore').encode('utf-8')
+    _log_file.write(RECORD_HEADER.pack(delta, EVENT_CODES[name], len(payload)))
+    _log_file.write(payload)
+
+def perform(name, *args):
+    """Record a GUI action and then carry it out."""
+    record(name, *args)
+    handlers()[name](*args)
+
+def read_log(path):
+    """Read a performance log into a list of (seconds since start, event name, arguments)."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(LOG_MAGIC):
+        raise ValueError(f"{path} is not a performance log")
+
+    events = []
+    offset = len(LOG_MAGIC)
+    elapsed = 0.0
+    while offset + RECORD_HEADER.size <= len(data):
+        delta, code, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        payload = data[offset:offset + length].decode('utf-8')
+        offset += length
+        elapsed += delta / 1e6
+        name, types = EVENT_NAMES[code]
+        values = payload.split("\0") if types else []
+        events.append((elapsed, name, [convert(value) for convert, value in zip(types, values)]))
+    return events
+
+def replay(path, realtime=True, on_done=None):
+    """Feed a performance log back through the live handlers.
+
+    In realtime the events are spaced out with Main.root.after as they were recorded;
+    otherwise they are dispatched back to back as fast as possible.
+    """
+    events = read_log(path)
+    event_handlers = handlers()
+
+    def dispatch(elapsed, name, args):
+        # Time-based debouncing such as the shift cooldown sees the recorded spacing
+        global replay_time
+        replay_time = elapsed
+        try:
+            event_handlers[name](*args)
+        finally:
+            replay_time = None
+
+    # The recorded times start at zero, so shifts from before the replay must not count
+    Main.last_shift_l_time = Main.last_shift_r_time = float('-inf')
+    if not realtime:
+        for elapsed, name, args in events:
+            dispatch(elapsed, name, args)
+        if on_done:
+            on_done()
+        return
+
+    start = time.perf_counter()
+
+    def step(index):
+        elapsed = time.perf_counter() - start
+        while index < len(events) and events[index][0] <= elapsed:
+            dispatch(*events[index])
+            index += 1
+        if index < len(events):
+            delay = int((events[index][0] - (time.perf_counter() - start)) * 1000)
+            Main.root.after(max(delay, 0), lambda: step(index))
+        elif on_done:
+            on_done()
+
+    step(0)
+
+def latest_recording():
+    """Return the most recent log in the recordings folder, if any."""
+    if not os.path.isdir(Main.recordings_folder):
+        return None
+    logs = [os.path.join(Main.recordings_folder, f) for f in os.listdir(Main.recordings_folder) if f.endswith(".lhr")]
+    return max(logs, key=os.path.getmtime) if logs else None
+
+if __name__ == "__main__":
+    # Usage: python Recording.py <log file>
+    # Prints the events in a performance log
+    for elapsed, name, args in read_log(sys.argv[1]):
+        print(f"{elapsed:10.3f}s  {name}({', '.join(repr(arg) for arg in args)})")
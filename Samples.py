@@ -0,0 +1,498 @@
+# Samples.py
+
+import argparse
+import collections
+import json
+import math
+import os
+import threading
+import numpy as np
+import pygame
+import Main
+import Helpers
+
+try:
+    import soundfile  # Optional: needed for FLAC and Ogg instrument folders
+except ImportError:
+    soundfile = None
+
+# Sample file types in lookup order; compressed files need soundfile
+sample_extensions = [".wav", ".flac", ".ogg"]
+compressed_extensions = [".flac", ".ogg"]
+derived_extension = ".derived"  # Virtual extension for notes pitch-shifted from a recorded neighbour
+stream_chunk_frames = 16384   # frames decoded per chunk when streaming a compressed sample
+
+# Sample data already converted to the mixer's format, keyed by (path, mixer format), so
+# envelope, effect and layer changes do not decode the files again. Each entry is a
+# float32 array of shape (frames, channels) in the range [-1, 1]; the least recently used
+# entries are dropped past Main.normalized_cache_mb.
+sample_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+# Onset and Tail Detection
+trim_window = 0.005        # seconds of audio per energy window
+onset_threshold_db = -40   # a sample starts at the first window this close to its loudest window
+tail_threshold_db = -60    # and ends after the last window this close to it
+onset_preroll = 0.002      # seconds kept before the onset so the transient is not clipped
+tail_release = 0.010       # seconds kept after the tail
+
+# Onset/end offsets in seconds per recorded sample, persisted in Main.onset_manifest_file
+onset_manifest = None
+_manifest_dirty = False
+_manifest_lock = threading.Lock()
+
+# Decoding threads started by stream_decode that may still be running
+stream_threads = []
+
+# Source files that needed conversion, mapping path to (source format, mixer format),
+# where a format is (frequency, bits, channels)
+conversions = {}
+
+# Mixer sample sizes as reported by pygame.mixer.get_init() and their NumPy types
+mixer_dtypes = {
+    8: np.uint8,
+    -8: np.int8,
+    16: np.uint16,
+    -16: np.int16,
+    32: np.float32
+}
+
+def mixer_format():
+    """Return the mixer's actual (frequency, size, channels)."""
+    return pygame.mixer.get_init()
+
+def is_compressed(path):
+    """Check whether a sample is stored in a compressed format."""
+    return os.path.splitext(path)[1].lower() in compressed_extensions
+
+def find_sample(folder, name):
+    """Return the path of the sample called name in folder, whichever supported format it uses."""
+    for extension in sample_extensions:
+        if extension in compressed_extensions and soundfile is None:
+            continue
+        path = os.path.join(folder, name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+def is_derived(path):
+    """Check whether a sample path refers to a note derived by pitch shifting."""
+    return path.endswith(derived_extension)
+
+def recorded_notes(folder):
+    """Map note numbers to the recorded sample paths in an instrument folder."""
+    import Library
+    indexed = Library.recorded_notes(folder)
+    if indexed is not None:
+        return indexed
+    notes = {}
+    for sound_file in os.listdir(folder):
+        name = os.path.splitext(sound_file)[0]
+        parsed = Helpers.parse_note_name(name)
+        if parsed:
+            path = find_sample(folder, name)
+            if path:
+                notes[Helpers.note_number(*parsed)] = path
+    return notes
+
+def nearest_recorded_sample(folder, name):
+    """Return the recorded sample closest in pitch to a note and how many semitones to shift it up."""
+    target = Helpers.note_number(*Helpers.parse_note_name(name))
+    notes = recorded_notes(folder)
+    if not notes:
+        return None, 0
+    # On a tie, shift a higher sample down rather than a lower one up, which keeps more of the sample
+    nearest = min(notes, key=lambda number: (abs(number - target), number < target))
+    return notes[nearest], target - nearest
+
+def resolve_sample(folder, name):
+    """Return the sample path for a note, or a derived path if it has to be pitch-shifted from a neighbour."""
+    path = find_sample(folder, name)
+    if path or not Main.derive_missing_notes or Helpers.parse_note_name(name) is None:
+        return path
+    if nearest_recorded_sample(folder, name)[0] is None:
+        return None
+    return os.path.join(folder, name + derived_extension)
+
+def derive_sample(path):
+    """Pitch-shift the nearest recorded sample to produce the note a derived path refers to."""
+    folder, sound_file = os.path.split(path)
+    source_path, semitones = nearest_recorded_sample(folder, os.path.splitext(sound_file)[0])
+    frames = load_normalized(source_path)
+    count = int(round(len(frames) / 2 ** (semitones / 12)))
+    return resample_to_length(frames, count, Main.pitch_shift_quality)
+
+def compressed_format(path):
+    """Return the (frequency, bits, channels) a compressed sample was encoded from."""
+    info = soundfile.info(path)
+    bits = {'PCM_S8': 8, 'PCM_24': 24, 'PCM_32': 32}.get(info.subtype, 16)
+    return info.samplerate, bits, info.channels
+
+def read_compressed_sample(path):
+    """Decode a whole FLAC or Ogg sample into float32 frames and its source format."""
+    frames = soundfile.read(path, dtype='float32', always_2d=True)[0]
+    return frames, compressed_format(path)
+
+def read_sample(path):
+    """Decode a sample file into float32 frames and its source (frequency, bits, channels)."""
+    if is_compressed(path):
+        return read_compressed_sample(path)
+
+    from pydub import AudioSegment  # Deferred so pydub is not imported before the window is shown
+
+    segment = AudioSegment.from_wav(path)
+    width = segment.sample_width
+    if width == 1:
+        data = (np.frombuffer(segment.raw_data, dtype=np.uint8).astype(np.float32) - 128) / 128
+    else:
+        dtype = np.int16 if width == 2 else np.int32
+        data = np.frombuffer(segment.raw_data, dtype=dtype).astype(np.float32) / float(2 ** (width * 8 - 1))
+    frames = data.reshape(-1, segment.channels)
+    return frames, (segment.frame_rate, width * 8, segment.channels)
+
+def fft_resize(frames, padded_length, padded_count, count):
+    """Band-limited resize of every channel at once, zero-padding frames to padded_length first."""
+    spectrum = np.fft.rfft(frames, n=padded_length, axis=0)
+    resized = np.fft.irfft(spectrum[:padded_count // 2 + 1], n=padded_count, axis=0)
+    resized *= padded_count / padded_length
+    return resized[:count].astype(np.float32)
+
+def resample(frames, source_rate, target_rate):
+    """Resample every channel at once with a band-limited FFT resampler."""
+    if source_rate == target_rate:
+        return frames
+    count = int(round(len(frames) * target_rate / source_rate))
+
+    # Pad with silence so the tail does not wrap into the attack, and to a length
+    # that maps onto a whole number of output frames
+    step = source_rate // math.gcd(source_rate, target_rate)
+    padded_length = -(-(len(frames) + source_rate // 100) // step) * step
+    padded_count = padded_length * target_rate // source_rate
+    return fft_resize(frames, padded_length, padded_count, count)
+
+def resample_to_length(frames, count, quality="high"):
+    """Stretch or squeeze every channel at once to count frames, shifting pitch by the length ratio."""
+    if quality == "fast":
+        # Linear interpolation: cheap, but aliases when shifting up
+        positions = np.arange(count) * ((len(frames) - 1) / max(count - 1, 1))
+        index = positions.astype(np.int64)
+        next_index = np.minimum(index + 1, len(frames) - 1)
+        fraction = (positions - index).astype(np.float32)[:, None]
+        return frames[index] * (1 - fraction) + frames[next_index] * fraction
+    padded_length = len(frames) + len(frames) // 100 + 1
+    padded_count = int(round(padded_length * count / len(frames)))
+    return fft_resize(frames, padded_length, padded_count, count)
+
+def remix(frames, channels):
+    """Convert frames to the given number of channels."""
+    if frames.shape[1] == channels:
+        return frames
+    mono = frames.mean(axis=1, keepdims=True) if frames.shape[1] > 1 else frames
+    return np.repeat(mono, channels, axis=1)
+
+def keep_normalized(cache_key, frames):
+    """Cache a sample's float frames for reprocessing, unless memory is kept compact."""
+    if Main.compact_memory:
+        return frames
+    with _cache_lock:
+        sample_cache[cache_key] = frames
+        sample_cache.move_to_end(cache_key)
+        total = sum(cached.nbytes for cached in sample_cache.values())
+        while total > Main.normalized_cache_mb * 2 ** 20 and len(sample_cache) > 1:
+            _, dropped = sample_cache.popitem(last=False)
+            total -= dropped.nbytes
+    return frames
+
+def load_normalized(path):
+    """Return a sample converted to the mixer's rate and channel count, converting it only once."""
+    target = mixer_format()
+    cache_key = (path, target)
+    with _cache_lock:
+        frames = sample_cache.get(cache_key)
+        if frames is not None:
+            sample_cache.move_to_end(cache_key)
+            return frames
+
+    if is_derived(path):
+        return keep_normalized(cache_key, derive_sample(path))
+
+    frames, source_format = read_sample(path)
+    frequency, size, channels = target
+    mixer_target = (frequency, abs(size), channels)
+    if source_format != mixer_target:
+        conversions[path] = (source_format, mixer_target)
+    frames = trim(path, remix(resample(frames, source_format[0], frequency), channels))
+    return keep_normalized(cache_key, frames)
+
+def detect_bounds(frames, frequency):
+    """Find where a sample really starts and ends, in seconds, from its short-time energy."""
+    duration = len(frames) / frequency
+    window = max(int(frequency * trim_window), 1)
+    count = len(frames) // window
+    if count == 0:
+        return 0.0, duration
+    energy = np.square(frames[:count * window]).reshape(count, window, -1).mean(axis=(1, 2))
+    peak = energy.max()
+    if peak <= 0:
+        return 0.0, duration
+
+    level_db = 10 * np.log10(np.maximum(energy / peak, 1e-12))
+    onset_window = np.flatnonzero(level_db > onset_threshold_db)[0]
+    tail_window = np.flatnonzero(level_db > tail_threshold_db)[-1]
+    onset = max(float(onset_window * window / frequency) - onset_preroll, 0.0)
+    end = min(float((tail_window + 1) * window / frequency) + tail_release, duration)
+    return onset, end
+
+def load_onset_manifest():
+    """Load the onset manifest from disk the first time it is needed."""
+    global onset_manifest
+    if onset_manifest is None:
+        onset_manifest = {}
+        if os.path.exists(Main.onset_manifest_file):
+            try:
+                with open(Main.onset_manifest_file) as f:
+                    onset_manifest = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Could not read onset manifest {Main.onset_manifest_file}: {e}")
+    return onset_manifest
+
+def save_onset_manifest():
+    """Write the onset manifest to disk if new samples were analysed."""
+    global _manifest_dirty
+    with _manifest_lock:
+        if not _manifest_dirty:
+            return
+        try:
+            with open(Main.onset_manifest_file, 'w') as f:
+                json.dump(onset_manifest, f, indent=1, sort_keys=True)
+            _manifest_dirty = False
+        except OSError as e:
+            print(f"Could not save onset manifest {Main.onset_manifest_file}: {e}")
+
+def sample_bounds(path, frames=None, frequency=None):
+    """Return a recorded sample's (onset, end) in seconds, analysing frames if the manifest has no entry.
+
+    Returns None when the sample is not in the manifest and no frames are given.
+    """
+    global _manifest_dirty
+    stat = os.stat(path)
+    with _manifest_lock:
+        manifest = load_onset_manifest()
+        entry = manifest.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['onset'], entry['end']
+    if frames is None:
+        return None
+    onset, end = detect_bounds(frames, frequency)
+    with _manifest_lock:
+        manifest[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'onset': onset, 'end': end}
+        _manifest_dirty = True
+    return onset, end
+
+def trim(path, frames):
+    """Cut the leading silence and silent tail from a sample at the mixer rate."""
+    if not Main.trim_silence:
+        return frames
+    frequency = mixer_format()[0]
+    onset, end = sample_bounds(path, frames, frequency)
+    return frames[int(onset * frequency):int(end * frequency)]
+
+def to_mixer_array(frames):
+    """Convert float frames to an array in the mixer's sample type and channel layout."""
+    frequency, size, channels = mixer_format()
+    clipped = np.clip(frames, -1.0, 1.0)
+    if size == 32:
+        data = clipped.astype(np.float32)
+    else:
+        half_range = 2 ** (abs(size) - 1)
+        data = np.round(clipped * (half_range - 1))
+        if size > 0:
+            data += half_range  # Unsigned formats are centred on half their range
+        data = data.astype(mixer_dtypes[size])
+    if channels == 1:
+        data = data[:, 0]
+    return np.ascontiguousarray(data)
+
+def sound_frames(sound):
+    """Return a pygame Sound's samples as float frames of shape (frames, channels)."""
+    frequency, size, channels = mixer_format()
+    data = pygame.sndarray.samples(sound).astype(np.float32)
+    if size != 32:
+        half_range = 2 ** (abs(size) - 1)
+        if size > 0:
+            data -= half_range
+        data /= half_range - 1
+    return data.reshape(len(data), channels)
+
+def make_sound(frames):
+    """Create a pygame Sound from float frames without another format conversion in SDL."""
+    return pygame.sndarray.make_sound(to_mixer_array(frames))
+
+def fade_gain(positions, length, fade_in, fade_out):
+    """Return the linear fade-in/fade-out gain at the given frame positions of a sound."""
+    gain = np.ones(len(positions), dtype=np.float32)
+    fade_in = min(fade_in, length)
+    fade_out = min(fade_out, length)
+    if fade_in > 1:
+        gain = np.minimum(gain, positions / (fade_in - 1))
+    elif fade_in == 1:
+        gain[positions == 0] = 0.0
+    if fade_out > 1:
+        gain = np.minimum(gain, (length - 1 - positions) / (fade_out - 1))
+    elif fade_out == 1:
+        gain[positions == length - 1] = 0.0
+    return gain.astype(np.float32)
+
+def apply_fades(frames, fade_in, fade_out):
+    """Return a copy of frames with linear fade-in and fade-out ramps given in frames."""
+    gain = fade_gain(np.arange(len(frames)), len(frames), fade_in, fade_out)
+    return frames * gain[:, None]
+
+def can_stream(path):
+    """Check whether a sample can be streamed without a whole-file resample."""
+    if soundfile is None or not is_compressed(path) or (path, mixer_format()) in sample_cache:
+        return False
+    return soundfile.info(path).samplerate == mixer_format()[0]
+
+def stream_region(path):
+    """Return the (start, end) frames of a streamable sample that are kept after trimming."""
+    frames = soundfile.info(path).frames
+    bounds = sample_bounds(path) if Main.trim_silence else None
+    if bounds is None:
+        return 0, frames
+    frequency = mixer_format()[0]
+    return int(bounds[0] * frequency), min(int(bounds[1] * frequency), frames)
+
+def stream_length(path):
+    """Return the number of frames a streamable sample decodes to."""
+    start, end = stream_region(path)
+    return end - start
+
+def blank_sound(frames):
+    """Create a silent pygame Sound of the given length in the mixer's format."""
+    frequency, size, channels = mixer_format()
+    return make_sound(np.zeros((max(frames, 1), channels), dtype=np.float32))
+
+def stream_decode(path, write_chunk):
+    """Decode a compressed sample in chunks on a background thread.
+
+    write_chunk(start, frames) is called for each decoded chunk in order, with frames
+    already in the mixer's channel layout and start counted from the trimmed onset.
+    The whole sample is cached once decoding ends. Returns the decoding thread.
+    """
+    region_start, region_end = stream_region(path)
+    analysed = region_start > 0 or region_end < soundfile.info(path).frames
+
+    def decode():
+        channels = mixer_format()[2]
+        chunks = []
+        start = 0
+        try:
+            blocks = soundfile.blocks(
+                path, blocksize=stream_chunk_frames, start=region_start, stop=region_end,
+                dtype='float32', always_2d=True
+            )
+            for block in blocks:
+                chunk = remix(block, channels)
+                write_chunk(start, chunk)
+                chunks.append(chunk)
+                start += len(chunk)
+        except RuntimeError as e:
+            print(f"Error decoding {path}: {e}")
+            return
+        source_format = compressed_format(path)
+        mixer_target = (mixer_format()[0], abs(mixer_format()[1]), channels)
+        if source_format != mixer_target:
+            conversions[path] = (source_format, mixer_target)
+        frames = np.concatenate(chunks) if chunks else np.zeros((0, channels), np.float32)
+        # Samples streamed before they were ever analysed are trimmed from now on
+        keep_normalized((path, mixer_format()), frames if analysed else trim(path, frames))
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+    stream_threads[:] = [t for t in stream_threads if t.is_alive()] + [thread]
+    return thread
+
+def wait_for_streams():
+    """Block until every streaming decode has finished."""
+    while stream_threads:
+        stream_threads.pop().join()
+
+def drop_derived():
+    """Remove derived notes from the cache so they are pitch-shifted again."""
+    with _cache_lock:
+        for cache_key in [key for key in sample_cache if is_derived(key[0])]:
+            del sample_cache[cache_key]
+
+def forget(paths):
+    """Remove samples from the cache, e.g. because they changed on disk."""
+    paths = set(paths)
+    with _cache_lock:
+        for cache_key in [key for key in sample_cache if key[0] in paths]:
+            del sample_cache[cache_key]
+    for path in paths:
+        conversions.pop(path, None)
+
+def ms_to_frames(milliseconds):
+    """Convert a duration in milliseconds to a frame count at the mixer's rate."""
+    return int(mixer_format()[0] * milliseconds / 1000)
+
+def describe_format(sample_format):
+    """Format a (frequency, bits, channels) tuple for display."""
+    frequency, bits, channels = sample_format
+    return f"{frequency} Hz/{bits}-bit/{channels}ch"
+
+def conversion_report():
+    """Describe the source files that had to be converted to the mixer's format."""
+    if not conversions:
+        return "All loaded samples already match the mixer format."
+    lines = [f"{len(conversions)} sample(s) converted at load time:"]
+    for path, (source_format, mixer_target) in sorted(conversions.items()):
+        lines.append(f"  {path}: {describe_format(source_format)} -> {describe_format(mixer_target)}")
+    return "\n".join(lines)
+
+def compress_instrument(instrument, output_folder, file_format="flac", frequency=None):
+    """Write an instrument's WAV samples as FLAC or Ogg, resampled to the mixer rate so they can stream."""
+    frequency = frequency or Main.mixer_frequency
+    source_folder = os.path.join(Main.base_folder, instrument)
+    os.makedirs(output_folder, exist_ok=True)
+    subtype = 'PCM_16' if file_format == "flac" else 'VORBIS'
+    for sound_file in sorted(os.listdir(source_folder)):
+        name, extension = os.path.splitext(sound_file)
+        if extension.lower() != ".wav":
+            continue
+        frames, source_format = read_sample(os.path.join(source_folder, sound_file))
+        frames = resample(frames, source_format[0], frequency)
+        soundfile.write(os.path.join(output_folder, f"{name}.{file_format}"), frames, frequency, subtype=subtype)
+    print(f"Compressed {instrument} to {output_folder} as {file_format} at {frequency} Hz")
+
+if __name__ == "__main__":
+    import Audio
+    import Helpers
+
+    parser = argparse.ArgumentParser(description="Laser Harp sample library tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    report_parser = commands.add_parser('report', help="load samples and list the ones that needed conversion")
+    report_parser.add_argument('instruments', nargs='*', help="instrument folders (default: all)")
+    compress_parser = commands.add_parser('compress', help="write an instrument folder as FLAC or Ogg")
+    compress_parser.add_argument('instrument')
+    compress_parser.add_argument('--format', choices=["flac", "ogg"], default="flac")
+    compress_parser.add_argument('--output', help="output folder (default: Compressed Samples/<instrument>)")
+    compress_parser.add_argument('--frequency', type=int, help="sample rate to store (default: the mixer rate)")
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        Audio.init_mixer()
+        instruments = args.instruments or Helpers.scan_instrument_folders()
+        for instrument in instruments:
+            folder = os.path.join(Main.base_folder, instrument)
+            for sound_file in sorted(os.listdir(folder)):
+                sound_path = find_sample(folder, os.path.splitext(sound_file)[0])
+                if sound_path:
+                    load_normalized(sound_path)
+        print(conversion_report())
+    elif soundfile is None:
+        print("Compressing samples requires the soundfile package (pip install soundfile).")
+    else:
+        output = args.output or os.path.join("Compressed Samples", args.instrument)
+        compress_instrument(args.instrument, output, args.format, args.frequency)
@@ -0,0 +1,198 @@
+# Session.py
+#
+# Keeps a snapshot of the live session in Main.session_folder so a crash or reboot
+# mid-show can be picked up where it left off. The instrument, key, octave, sustain mode,
+# volume and every looping note with its locks are written whenever they change, along
+# with the sample each loop and live key was playing; rendered phrases are kept beside
+# the snapshot. On launch restore_settings() puts the settings back before the menu is
+# drawn, preload() loads the saved samples on the warm thread, and restore() restarts the
+# loops on the Tk thread and reports any that now play a different sample.
+
+import json
+import os
+import re
+import Main
+
+_last_saved = None
+_task = None
+
+# Note fields saved per loop; instrument paths are stored as folder names
+LOOP_FIELDS = [
+    'key', 'slot', 'velocity', 'sustain_option', 'octave_locked', 'locked_octave',
+    'key_locked', 'locked_key', 'instrument_locked', 'locked_layers', 'created_octave'
+]
+
+def snapshot_path():
+    return os.path.join(Main.session_folder, "session.json")
+
+def phrase_path(note_id):
+    return os.path.join(Main.session_folder, f"{note_id}.npy")
+
+def folder_name(folder):
+    return os.path.basename(folder) if folder else None
+
+def instrument_path(name):
+    """Return the path of a saved instrument folder name, or None if it no longer exists."""
+    if name in Main.instrument_folders:
+        return os.path.join(Main.base_folder, name)
+    return None
+
+def loop_state(note_id, note_info):
+    """Describe one looping note so it can be started again as it was."""
+    state = {field: note_info.get(field) for field in LOOP_FIELDS}
+    state['note_id'] = note_id
+    state['locked_instrument'] = folder_name(note_info.get('locked_instrument'))
+    state['created_instrument'] = folder_name(note_info.get('created_instrument'))
+    state['sample'] = note_info.get('sound_path')
+    if note_info.get('phrase'):
+        state['phrase'] = note_info['phrase']
+    return state
+
+def snapshot():
+    """Return the current session as a JSON-serializable dict."""
+    return {
+        'running': Main.running,
+        'instrument': folder_name(Main.current_folder),
+        'key': Main.current_key,
+        'octave': Main.current_octave,
+        'sustain_option': Main.sustain_option,
+        'volume': Main.volume,
+        'live_samples': dict(Main.sound_paths),
+        'loops': [loop_state(note_id, note_info) for note_id, note_info in Main.looping_notes.items()]
+    }
+
+def save_phrases(loops):
+    """Write the audio of new phrase loops and remove that of phrases that stopped."""
+    import numpy as np
+    import Samples
+    kept = set()
+    for state in loops:
+        if not state.get('phrase'):
+            continue
+        path = phrase_path(state['note_id'])
+        kept.add(os.path.basename(path))
+        if not os.path.exists(path):
+            np.save(path, Samples.sound_frames(Main.looping_notes[state['note_id']]['sounds']['original']))
+    for name in os.listdir(Main.session_folder):
+        if name.endswith(".npy") and name not in kept:
+            os.remove(os.path.join(Main.session_folder, name))
+
+def save():
+    """Write the snapshot if the session changed since it was last written."""
+    global _last_saved
+    state = snapshot()
+    encoded = json.dumps(state, indent=1)
+    if encoded == _last_saved:
+        return
+    try:
+        os.makedirs(Main.session_folder, exist_ok=True)
+        save_phrases(state['loops'])
+        # Write a new file and swap it in so a crash never leaves half a snapshot
+        temporary = snapshot_path() + ".tmp"
+        with open(temporary, 'w') as f:
+            f.write(encoded)
+        os.replace(temporary, snapshot_path())
+        _last_saved = encoded
+    except OSError as e:
+        print(f"Could not save session to {Main.session_folder}: {e}")
+
+def autosave():
+    """Save the snapshot every Main.session_save_interval_ms."""
+    global _task
+    save()
+    _task = Main.root.after(Main.session_save_interval_ms, autosave)
+
+def load():
+    """Return the saved snapshot, or None if there is none or it cannot be read."""
+    if not os.path.exists(snapshot_path()):
+        return None
+    try:
+        with open(snapshot_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read session from {snapshot_path()}: {e}")
+        return None
+
+def restore_settings(state):
+    """Put the saved instrument, key, octave, sustain mode and volume back."""
+    instrument = instrument_path(state.get('instrument'))
+    if instrument:
+        Main.current_folder = instrument
+    if state.get('key') in Main.keys:
+        Main.current_key = state['key']
+    if state.get('octave') in Main.octave_range:
+        Main.current_octave = state['octave']
+    Main.sustain_option = bool(state.get('sustain_option', Main.sustain_option))
+    Main.volume = float(state.get('volume', Main.volume))
+
+def restore_loops(state):
+    """Start the saved looping notes again, loading only the samples they play."""
+    import numpy as np
+    import Looping
+    import Phrases
+    import Samples
+    restored = 0
+    for saved in state.get('loops', []):
+        note_id = saved['note_id']
+        if saved.get('phrase'):
+            if not os.path.exists(phrase_path(note_id)):
+                continue
+            sound = Samples.make_sound(np.load(phrase_path(note_id)))
+            sound.set_volume(Main.volume)
+            # Keep new phrase ids clear of the restored ones
+            Phrases._count = max(Phrases._count, int(re.sub(r"\D", "", note_id) or 0))
+            Looping.start_phrase_loop(note_id, sound, saved['phrase'])
+        else:
+            loop = {field: saved[field] for field in LOOP_FIELDS if field in saved}
+            loop['locked_instrument'] = instrument_path(saved.get('locked_instrument'))
+            loop['created_instrument'] = instrument_path(saved.get('created_instrument')) or Main.current_folder
+            if loop['instrument_locked'] and loop['locked_instrument'] is None:
+                loop['instrument_locked'] = False
+            Looping.start_looping_note(note_id, saved['key'], state=loop)
+        restored += 1
+    return restored
+
+def preload(state):
+    """Load the samples the saved session was playing; safe to run off the Tk thread.
+
+    Loops and keys that play instrument layers are left to restore(), as their sounds
+    are mixed from more than the saved sample.
+    """
+    import Audio
+    if not state.get('running'):
+        return
+    paths = []
+    for saved in state.get('loops', []):
+        layers = saved.get('locked_layers') if saved.get('instrument_locked') else Main.instrument_layers
+        if not layers:
+            paths.append(saved.get('sample'))
+    if not Main.instrument_layers:
+        paths.extend(state.get('live_samples', {}).values())
+    for path in dict.fromkeys(paths):
+        if path and os.path.exists(path):
+            Audio.load_note_sounds(path)
+
+def drift(state):
+    """List what plays a different sample than when the session was saved, as (what, saved, now)."""
+    changes = []
+    for saved in state.get('loops', []):
+        note_info = Main.looping_notes.get(saved['note_id'])
+        if note_info and saved.get('sample') and note_info.get('sound_path') != saved['sample']:
+            changes.append((f"loop {saved['note_id']}", saved['sample'], note_info.get('sound_path')))
+    for input_key, path in state.get('live_samples', {}).items():
+        if Main.sound_paths.get(input_key) != path:
+            changes.append((f"key {input_key}", path, Main.sound_paths.get(input_key)))
+    return changes
+
+def restore(state):
+    """Restore the loops of a saved session; returns True if the harp was running."""
+    if state is None or not state.get('running'):
+        return False
+    count = restore_loops(state)
+    print(f"Restored session: {count} looping note(s)")
+    return True
+
+def report_drift(state):
+    """Print the loops and keys whose sample changed on disk or in the library since the save."""
+    for what, saved, now in drift(state):
+        print(f"Restored {what} plays {now or 'nothing'} instead of {saved}")
@@ -0,0 +1,39 @@
+# Settings.py
+
+import json
+import os
+import Main
+
+# Settings persisted between runs, loaded from Main.settings_file
+settings = {}
+
+def load():
+    """Load the persisted settings, starting empty if the file is missing or unreadable."""
+    global settings
+    if not os.path.exists(Main.settings_file):
+        settings = {}
+        return settings
+    try:
+        with open(Main.settings_file) as f:
+            settings = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read settings from {Main.settings_file}: {e}")
+        settings = {}
+    return settings
+
+def save():
+    """Write the current settings to disk."""
+    try:
+        with open(Main.settings_file, 'w') as f:
+            json.dump(settings, f, indent=2)
+    except OSError as e:
+        print(f"Could not save settings to {Main.settings_file}: {e}")
+
+def get(name, default=None):
+    """Return a persisted setting."""
+    return settings.get(name, default)
+
+def update(**values):
+    """Change one or more settings and persist them."""
+    settings.update(values)
+    save()
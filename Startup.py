@@ -0,0 +1,155 @@
+# Startup.py
+
+import argparse
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import Main
+import Helpers
+import Library
+
+# Startup phase timings as (name, milliseconds), in the order they finished
+phase_timings = []
+profile_startup = False
+_launch_time = time.perf_counter()
+
+RESTORE_POLL_MS = 20
+_restored = queue.Queue()  # the saved session, handed over by the warm thread once preloaded
+
+@contextmanager
+def phase(name):
+    """Time a startup phase and record it for the startup report."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_timings.append((name, (time.perf_counter() - start) * 1000))
+
+def report():
+    """Print the time spent in each startup phase."""
+    print("Startup profile:")
+    for name, duration in phase_timings:
+        print(f"  {name:<20} {duration:8.1f} ms")
+    print(f"  {'total':<20} {(time.perf_counter() - _launch_time) * 1000:8.1f} ms")
+
+def warm_default_bank(state=None):
+    """Process the default instrument bank in the background so Start does not have to.
+
+    The saved session's samples come first; the session is handed to finish_restore()
+    as soon as they are loaded.
+    """
+    import Audio
+    import Samples
+    import Session
+    try:
+        if state:
+            with phase("preload session"):
+                Session.preload(state)
+    finally:
+        # Even a failed preload must hand over, or the session is never autosaved
+        _restored.put(state)
+    with phase("warm default bank"):
+        Audio.warm_bank(Main.current_folder)
+    with phase("analyse library"):
+        Library.analyse()
+    print(Library.report())
+    if profile_startup:
+        report()
+        print(Samples.conversion_report())
+
+def deferred_init():
+    """Load audio modules and the mixer once the main menu is already on screen."""
+    phase_timings.append(("first frame", (time.perf_counter() - _launch_time) * 1000))
+    import Audio
+    with phase("import audio"):
+        init_mixer = Audio.init_mixer
+    start = time.perf_counter()
+
+    def mixer_ready():
+        phase_timings.append(("mixer init", (time.perf_counter() - start) * 1000))
+        audio_ready()
+
+    # A first launch in low-latency mode tunes the buffer on a worker thread
+    init_mixer(on_ready=mixer_ready)
+
+def audio_ready():
+    """Index the library, start the watcher and warm the default bank once the mixer is open."""
+    import Audio
+    if Main.running:
+        # Start was pressed while the buffer was being tuned
+        Audio.preload_sounds()
+    with phase("index library"):
+        Library.index()
+    if Main.shared_pool:
+        import Pool
+        Pool.join()
+    if Main.watch_samples:
+        import Watcher
+        Watcher.start(Main.watch_poll_interval)
+    import Session
+    threading.Thread(target=warm_default_bank, args=(Session.load(),), daemon=True).start()
+    Main.root.after(RESTORE_POLL_MS, finish_restore)
+
+def finish_restore():
+    """Restart the saved session once the warm thread has its samples; runs on the Tk thread."""
+    import Session
+    try:
+        state = _restored.get_nowait()
+    except queue.Empty:
+        Main.root.after(RESTORE_POLL_MS, finish_restore)
+        return
+    with phase("restore session"):
+        if Session.restore(state):
+            # The loops are already playing; this preloads the live keys
+            import Gui
+            Gui.start_harp()
+            Session.report_drift(state)
+    # Only now, so the snapshot is not overwritten before it is restored
+    Session.autosave()
+
+def run(argv=None):
+    """Show the main menu first, then initialize audio and warm the default bank."""
+    parser = argparse.ArgumentParser(description="Laser Harp")
+    parser.add_argument('--profile-startup', action='store_true', help="print the time spent in each startup phase")
+    parser.add_argument('--telemetry', metavar='ADDRESS', help="publish metrics on unix:<path> or tcp:<host>:<port>")
+    parser.add_argument('--audio-engine', choices=["inline", "process"], help="run playback on the GUI thread or in its own process")
+    parser.add_argument('--layout', help="beam layout file, or its name in the layouts folder")
+    parser.add_argument('--compact-memory', action='store_true', help="mono 16-bit sounds with no float copies kept")
+    parser.add_argument('--compact-frequency', type=int, help="sample rate in compact memory mode, e.g. 22050")
+    parser.add_argument('--shared-pool', action='store_true', help="share processed sounds with other harp instances to save processing time")
+    args = parser.parse_args(argv)
+
+    global profile_startup
+    profile_startup = args.profile_startup
+
+    if args.audio_engine:
+        Main.audio_engine = args.audio_engine
+    if args.layout:
+        Main.layout = args.layout
+    if args.compact_memory:
+        Main.compact_memory = True
+    if args.compact_frequency:
+        Main.compact_frequency = args.compact_frequency
+    if args.shared_pool:
+        Main.shared_pool = True
+    if args.telemetry:
+        Main.telemetry_address = args.telemetry
+    if Main.telemetry_address:
+        import Telemetry
+        Telemetry.start_server(Main.telemetry_address)
+
+    with phase("scan instruments"):
+        Helpers.scan_instrument_folders()
+    if Main.layout:
+        with phase("load layout"):
+            import Layout
+            Layout.use(Main.layout)
+    with phase("restore settings"):
+        import Session
+        state = Session.load()
+        if state:
+            Session.restore_settings(state)
+    with phase("import gui"):
+        import Gui
+    Gui.main_menu(on_first_frame=deferred_init)
@@ -0,0 +1,136 @@
+# Telemetry.py
+#
+# Publishes runtime health in the Prometheus text exposition format on a local socket.
+# Each connection receives one snapshot and is closed, e.g.:
+#   socat - UNIX-CONNECT:/tmp/laser-harp.sock
+#   curl --http0.9 http://127.0.0.1:9310/
+
+import os
+import socket
+import socketserver
+import threading
+import Main
+
+# Counters, updated from the GUI thread and only read by the server thread
+notes_dropped = 0
+cache_hits = 0
+cache_misses = 0
+after_callbacks = 0
+after_lateness_sum = 0.0  # seconds
+after_lateness_max = 0.0
+preloads = 0
+preload_seconds_sum = 0.0
+preload_seconds_last = 0.0
+
+server = None
+
+def note_dropped():
+    """Count a note that could not be played because no channel was free."""
+    global notes_dropped
+    notes_dropped += 1
+
+def cache_lookup(hit):
+    """Count a sample cache lookup."""
+    global cache_hits, cache_misses
+    if hit:
+        cache_hits += 1
+    else:
+        cache_misses += 1
+
+def after_lateness(seconds):
+    """Record how late a scheduled Tk callback ran."""
+    global after_callbacks, after_lateness_sum, after_lateness_max
+    after_callbacks += 1
+    after_lateness_sum += seconds
+    after_lateness_max = max(after_lateness_max, seconds)
+
+def preload_duration(seconds):
+    """Record how long a preload of the sound banks took."""
+    global preloads, preload_seconds_sum, preload_seconds_last
+    preloads += 1
+    preload_seconds_sum += seconds
+    preload_seconds_last = seconds
+
+def active_voices():
+    """Count the mixer channels that are currently playing."""
+    import pygame
+    if not pygame.mixer.get_init():
+        return 0
+    return sum(pygame.mixer.Channel(i).get_busy() for i in range(pygame.mixer.get_num_channels()))
+
+def metrics():
+    """Return the current metrics as (name, type, help, value) tuples."""
+    lookups = cache_hits + cache_misses
+    return [
+        ('harp_channels', 'gauge', "Mixer channels allocated", Main.num_channels),
+        ('harp_active_voices', 'gauge', "Mixer channels currently playing", active_voices()),
+        ('harp_notes_dropped_total', 'counter', "Notes not played because no channel was free", notes_dropped),
+        ('harp_looping_notes', 'gauge', "Notes currently looping", len(Main.looping_notes)),
+        ('harp_after_callbacks_total', 'counter', "Scheduled Tk callbacks run", after_callbacks),
+        ('harp_after_lateness_seconds_sum', 'counter', "Total lateness of scheduled Tk callbacks", after_lateness_sum),
+        ('harp_after_lateness_seconds_max', 'gauge', "Worst lateness of a scheduled Tk callback", after_lateness_max),
+        ('harp_preloads_total', 'counter', "Sound bank preloads", preloads),
+        ('harp_preload_seconds_sum', 'counter', "Total time spent preloading sound banks", preload_seconds_sum),
+        ('harp_preload_seconds_last', 'gauge', "Duration of the last preload", preload_seconds_last),
+        ('harp_cache_hits_total', 'counter', "Sample cache hits", cache_hits),
+        ('harp_cache_misses_total', 'counter', "Sample cache misses", cache_misses),
+        ('harp_cache_hit_ratio', 'gauge', "Share of sample lookups served from the cache", cache_hits / lookups if lookups else 0.0),
+    ]
+
+def exposition():
+    """Format the current metrics in the text exposition format."""
+    lines = []
+    for name, metric_type, description, value in metrics():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class SnapshotHandler(socketserver.StreamRequestHandler):
+    """Send one metrics snapshot to each client."""
+
+    def handle(self):
+        body = exposition().encode('utf-8')
+        # Answer HTTP scrapers properly; anything else just gets the text
+        self.request.settimeout(0.05)
+        try:
+            request = self.request.recv(1024)
+        except (socket.timeout, OSError):
+            request = b""
+        if request.startswith(b"GET "):
+            header = f"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n"
+            body = header.encode('ascii') + body
+        self.wfile.write(body)
+
+class SnapshotTCPServer(socketserver.ThreadingTCPServer):
+    """Rebind a port still in TIME_WAIT from the last run, without changing other servers."""
+    allow_reuse_address = True
+
+def start_server(address):
+    """Serve metrics on 'unix:<path>' or 'tcp:<host>:<port>' from a background thread."""
+    global server
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = socketserver.ThreadingUnixStreamServer(path, SnapshotHandler)
+    elif address.startswith("tcp:"):
+        host, port = address[len("tcp:"):].rsplit(":", 1)
+        server = SnapshotTCPServer((host, int(port)), SnapshotHandler)
+    else:
+        print(f"Unknown telemetry address {address}; use unix:<path> or tcp:<host>:<port>")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Telemetry available on {address}")
+    return server
+
+def stop_server():
+    """Stop serving metrics."""
+    global server
+    if server:
+        server.shutdown()
+        server.server_close()
+        if isinstance(server.server_address, str) and os.path.exists(server.server_address):
+            os.remove(server.server_address)
+        server = None
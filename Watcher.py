@@ -0,0 +1,267 @@
+# Watcher.py
+#
+# Reloads samples that change on disk while the harp is running. Sample folders are
+# watched with inotify where it is available and polled otherwise. Changed files only
+# invalidate their own cache entries (plus the notes derived from their instrument);
+# the replacements are processed in the background and swapped into the live keys and
+# looping notes on the Tk thread.
+
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import threading
+import Main
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+settle_time = 0.3     # seconds to wait for more changes before reloading a batch
+apply_interval = 250  # milliseconds between checks for reloaded sounds on the Tk thread
+
+_threads = []
+_stop = threading.Event()
+_changes = queue.Queue()   # sets of changed paths from the inotify or polling thread
+_reloaded = queue.Queue()  # (instrument folders, changed paths) rebuilt, for the Tk thread
+
+def inotify_events(folders):
+    """Yield sets of changed paths as inotify reports them, or return None if inotify is unavailable."""
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    fd = libc.inotify_init1(os.O_NONBLOCK)
+    if fd < 0:
+        return None
+
+    watches = {}
+
+    def watch(folder):
+        wd = libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK)
+        if wd >= 0:
+            watches[wd] = folder
+
+    watch(Main.base_folder)
+    for folder in folders:
+        watch(folder)
+
+    def events():
+        try:
+            while not _stop.is_set():
+                if not select.select([fd], [], [], 0.5)[0]:
+                    continue
+                changed = set()
+                data = os.read(fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                    offset += EVENT_HEADER.size
+                    name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                    offset += length
+                    folder = watches.get(wd)
+                    if folder is None:
+                        continue
+                    path = os.path.join(folder, name) if name else folder
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        watch(path)
+                    changed.add(path)
+                yield changed
+        finally:
+            os.close(fd)
+
+    return events()
+
+def folder_state(folders):
+    """Return the size and modification time of every file in the watched folders."""
+    state = {}
+    for folder in [Main.base_folder] + folders:
+        try:
+            for entry in os.scandir(folder):
+                stat = entry.stat()
+                state[entry.path] = (stat.st_size, stat.st_mtime)
+        except OSError:
+            pass
+    return state
+
+def polled_events(folders, interval):
+    """Yield sets of changed paths found by comparing folder listings every interval seconds."""
+    # Take the first listing now so changes made before the thread starts are not missed
+    previous = folder_state(folders)
+
+    def events():
+        nonlocal previous
+        while not _stop.wait(interval):
+            watched = [os.path.join(Main.base_folder, f) for f in Main.instrument_folders]
+            current = folder_state(watched)
+            changed = {path for path in previous.keys() | current.keys() if previous.get(path) != current.get(path)}
+            previous = current
+            if changed:
+                yield changed
+
+    return events()
+
+def instrument_folder_of(path):
+    """Return the instrument folder a changed path belongs to."""
+    base = os.path.normpath(Main.base_folder)
+    path = os.path.normpath(path)
+    if os.path.dirname(path) == base:
+        return os.path.join(Main.base_folder, os.path.basename(path))
+    return os.path.join(Main.base_folder, os.path.basename(os.path.dirname(path)))
+
+def is_affected(path, folders, changed):
+    """Check whether a sample path was changed, or is a note derived in a reloaded folder."""
+    import Samples
+    if path is None:
+        return False
+    return path in changed or (Samples.is_derived(path) and os.path.dirname(path) in folders)
+
+def stale_live_keys(folders, changed):
+    """List the input keys whose sample or layers changed or now resolve to different files."""
+    import Audio
+    import Library
+    current = Main.current_folder in folders
+    layered = any(os.path.join(Main.base_folder, layer['instrument']) in folders for layer in Main.instrument_layers)
+    if not current and not layered:
+        return []
+    stale = []
+    for input_key in Main.input_to_note:
+        path = Main.sound_paths.get(input_key)
+        layer_sound_paths = Main.layer_sound_paths.get(input_key, [])
+        if is_affected(path, folders, changed) or any(is_affected(layer_path, folders, changed) for layer_path in layer_sound_paths):
+            stale.append(input_key)
+        elif current and path != Library.resolve(Main.current_folder, Main.current_key, Main.current_octave, input_key):
+            stale.append(input_key)
+        elif layered and layer_sound_paths != [
+            layer_path for layer_path, _ in Audio.layer_paths(Main.instrument_layers, Main.current_folder, Main.current_key, Main.current_octave, input_key)
+        ]:
+            stale.append(input_key)
+    return stale
+
+def stale_looping_notes(folders, changed):
+    """List the looping notes whose sample changed or now resolves to a different file."""
+    import Library
+    stale = []
+    for note_id, note_info in list(Main.looping_notes.items()):
+        path = note_info.get('sound_path')
+        folder, key, octave, input_key = note_info.get('resolved_as', (None,) * 4)
+        if folder in folders and (is_affected(path, folders, changed) or path != Library.resolve(folder, key, octave, input_key)):
+            stale.append(note_id)
+        elif any(is_affected(layer_path, folders, changed) for layer_path in note_info.get('layer_paths', [])):
+            stale.append(note_id)
+    return stale
+
+def invalidate(folders, changed):
+    """Drop the cache entries of changed samples and of every note derived in their folders."""
+    import Audio
+    import Samples
+    with Audio._cache_lock:
+        Audio.drop_cached([key for key in Main.sample_cache if any(is_affected(path, folders, changed) for path in Audio.cache_key_paths(key))])
+        Samples.forget([key[0] for key in list(Samples.sample_cache) if is_affected(key[0], folders, changed)])
+
+def reload(changed):
+    """Re-index the folders touched by a batch of changes and rebuild the sounds in use."""
+    import Audio
+    import Helpers
+    import Library
+    folders = {instrument_folder_of(path) for path in changed}
+    Helpers.scan_instrument_folders()
+    for folder in folders:
+        if os.path.isdir(folder):
+            Library.index_folder(folder)
+            Library.analyse([folder])
+            print(f"Reloaded samples in {os.path.basename(folder)}")
+        else:
+            Library.remove_folder(folder)
+            print(f"Instrument folder {os.path.basename(folder)} was removed")
+    invalidate(folders, changed)
+
+    # Process the replacements here so the Tk thread only has to swap them in
+    if Main.running:
+        for input_key in stale_live_keys(folders, changed):
+            path = Library.resolve(Main.current_folder, Main.current_key, Main.current_octave, input_key)
+            if path:
+                Audio.load_note_sounds(path)
+        for note_id in stale_looping_notes(folders, changed):
+            note_info = Main.looping_notes.get(note_id)
+            if note_info:
+                path = Library.resolve(*note_info['resolved_as'])
+                if path:
+                    Audio.load_note_sounds(path)
+    _reloaded.put((folders, changed))
+
+def apply_reloaded():
+    """Swap rebuilt sounds into the live keys and looping notes; runs on the Tk thread."""
+    import Audio
+    # Reloads wait for a mixer buffer tuning to finish
+    while not _reloaded.empty() and not Main.mixer_tuning:
+        folders, changed = _reloaded.get()
+        if not Main.running:
+            continue
+        for input_key in stale_live_keys(folders, changed):
+            Audio.load_key_sounds(input_key)
+        for note_id in stale_looping_notes(folders, changed):
+            note_info = Main.looping_notes[note_id]
+            Audio.preload_sound_for_looping_note(note_id, note_info['key'], instrument=note_info['resolved_as'][0])
+    if _threads:
+        Main.root.after(apply_interval, apply_reloaded)
+
+def collect(events):
+    """Pass changes from an event source to the reload thread."""
+    for changed in events:
+        _changes.put(changed)
+
+def watch():
+    """Gather changes until they settle, then reload them."""
+    while not _stop.is_set():
+        try:
+            pending = _changes.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        # Keep collecting the rest of a copy or an editor's save before reloading
+        while True:
+            try:
+                pending |= _changes.get(timeout=settle_time)
+            except queue.Empty:
+                break
+        try:
+            reload(pending)
+        except Exception as e:
+            print(f"Could not reload samples: {e}")
+
+def start(poll_interval=1.0):
+    """Start watching the sample folders in the background."""
+    if _threads:
+        return
+    _stop.clear()
+    folders = [os.path.join(Main.base_folder, f) for f in Main.instrument_folders]
+    events = inotify_events(folders)
+    method = "inotify"
+    if events is None:
+        events = polled_events(folders, poll_interval)
+        method = f"polling every {poll_interval:g} s"
+    _threads[:] = [
+        threading.Thread(target=collect, args=(events,), daemon=True),
+        threading.Thread(target=watch, daemon=True)
+    ]
+    for thread in _threads:
+        thread.start()
+    if Main.root is not None:
+        Main.root.after(apply_interval, apply_reloaded)
+    print(f"Watching {Main.base_folder} for sample changes ({method})")
+
+def stop():
+    """Stop watching the sample folders."""
+    _stop.set()
+    _threads.clear()